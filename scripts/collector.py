@@ -0,0 +1,632 @@
+#!/usr/bin/env python3
+"""
+collector.py — Scrape patched MLX servers on several hosts and serve a fleet view.
+
+Usage:
+    python3 collector.py                                        # this Mac (ports 8080-8090 + registry)
+    python3 collector.py --hosts studio1,studio2,studio3:8080-8085
+    python3 collector.py --hosts 127.0.0.1:18080-18082,127.0.0.2:18080 --port 9100
+
+Each target is `host[:ports]`, where ports is one or more ranges joined by
+`+` (e.g. `studio1:8080-8083+9000`); without ports, 8080-8090 are probed.
+Targets can also come from MLX_COCKPIT_HOSTS or one per line in
+~/.mlx-cockpit/hosts.
+
+Every host is scraped concurrently over persistent keep-alive connections.
+A host that stops answering is retried with exponential backoff while the
+others carry on, and its last known servers are kept (marked stale) so the
+fleet view degrades instead of flapping.  New request records feed mergeable
+quantile sketches per host, which are combined into fleet-wide quantiles.
+
+With --canary SECONDS (or MLX_COCKPIT_CANARY), every mlx-lm server also
+gets a small fixed request on that schedule: the same prompt, the same
+max_tokens, greedy decoding.  Its TTFT and decode tok/s form a separate
+series that, unlike real traffic, is comparable over time.  A probe is only
+sent while the server is idle (no new records, nothing in flight); each time one comes due while the server is
+busy the wait doubles (up to 8x), and a quiet probe resets it.  Patched
+servers leave canary requests out of their own metrics, alerts and baselines.
+
+Endpoints:
+    /v1/fleet     fleet-wide and per-host summary, sketches, canaries, and every server's /v1/metrics
+    /v1/services  the same servers in the shape the widget's mlx-scan.sh prints
+    /dashboard    the web dashboard, showing every host
+"""
+
+import argparse
+import collections
+import http.client
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_PORTS = list(range(8080, 8091))
+SCAN_INTERVAL = 60.0          # Full port-range rescan per host (known ports are probed every cycle)
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 300.0
+SKETCH_METRICS = ("latency", "tokens_per_sec", "ttft")
+CANARY_PROMPT = "Count from one to twenty in words, separated by commas."
+CANARY_MAX_TOKENS = 32
+CANARY_HEADER = "X-MLX-Cockpit-Canary"
+CANARY_TIMEOUT = 120.0
+CANARY_HISTORY = 500          # Probes kept per server
+CANARY_BACKOFF = 8            # Longest wait while busy, in canary intervals
+
+
+def parse_targets(spec):
+    """Parse 'host[:ports],...' into [(host, [ports])]."""
+    targets = []
+    for item in spec.replace("\n", ",").split(","):
+        item = item.strip()
+        if not item or item.startswith("#"):
+            continue
+        host, _, ports = item.partition(":")
+        if not ports:
+            targets.append((host, list(DEFAULT_PORTS)))
+            continue
+        expanded = []
+        for part in ports.split("+"):
+            low, _, high = part.partition("-")
+            expanded.extend(range(int(low), int(high or low) + 1))
+        targets.append((host, sorted(set(expanded))))
+    return targets
+
+
+def default_targets():
+    spec = os.environ.get("MLX_COCKPIT_HOSTS")
+    if not spec:
+        try:
+            with open(os.path.expanduser("~/.mlx-cockpit/hosts")) as f:
+                spec = f.read()
+        except OSError:
+            spec = "localhost"
+    return parse_targets(spec)
+
+
+class QuantileSketch:
+    """Log-bucketed quantile sketch with bounded relative error (DDSketch).
+
+    A value x lands in bucket ceil(log_gamma(x)); any quantile is then within
+    `alpha` of the true value, and two sketches merge exactly by adding
+    bucket counts — so per-host sketches combine into a fleet sketch (or
+    another collector's sketches) without keeping raw samples.
+    """
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, x):
+        self.count += 1
+        if x <= 0:
+            self.zeros += 1
+            return
+        i = math.ceil(math.log(x) / self._log_gamma)
+        self.bins[i] = self.bins.get(i, 0) + 1
+
+    def merge(self, other):
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.zeros += other.zeros
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if seen > rank:
+                return 2 * self.gamma ** i / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            **{f"p{int(q * 100)}": _round(self.quantile(q)) for q in (0.5, 0.9, 0.95, 0.99)},
+        }
+
+    def to_dict(self):
+        return {"alpha": self.alpha, "zeros": self.zeros, "bins": {str(i): n for i, n in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["alpha"])
+        sketch.bins = {int(i): n for i, n in data["bins"].items()}
+        sketch.zeros = data["zeros"]
+        sketch.count = sketch.zeros + sum(sketch.bins.values())
+        return sketch
+
+
+def _round(x):
+    return round(x, 3) if x is not None else None
+
+
+class _ConnectionPool:
+    """One persistent HTTP/1.1 connection per (host, port), reused across scrapes."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get_json(self, host, port, path):
+        with self._lock:
+            conn = self._idle.pop((host, port), None)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                conn = None
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection; retry once on a new one
+                reused = False
+                continue
+            except Exception:
+                conn.close()
+                raise
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle[(host, port)] = conn
+        if response.status != 200:
+            raise ValueError(f"HTTP {response.status} from {host}:{port}{path}")
+        return json.loads(body)
+
+
+def run_canary(host, port, model=None, timeout=CANARY_TIMEOUT):
+    """Send the canary request to one mlx-lm server and time it from the client side."""
+    body = {
+        "messages": [{"role": "user", "content": CANARY_PROMPT}],
+        "max_tokens": CANARY_MAX_TOKENS,
+        "temperature": 0.0,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+    if model:
+        body["model"] = model
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        start = time.perf_counter()
+        conn.request(
+            "POST", "/v1/chat/completions", json.dumps(body),
+            {"Content-Type": "application/json", CANARY_HEADER: "1"},
+        )
+        response = conn.getresponse()
+        if response.status != 200:
+            raise ValueError(f"HTTP {response.status} from {host}:{port}/v1/chat/completions")
+        first = last = None
+        chunks = 0
+        usage = None
+        for line in response:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+            event = json.loads(payload)
+            usage = event.get("usage") or usage
+            if any((c.get("delta") or {}).get("content") or c.get("text") for c in event.get("choices") or []):
+                last = time.perf_counter()
+                first = first or last
+                chunks += 1
+        end = time.perf_counter()
+    finally:
+        conn.close()
+    if first is None:
+        raise ValueError(f"no tokens streamed by {host}:{port}")
+    # Coalesced streams send several tokens per chunk, so prefer the server's count
+    tokens = (usage or {}).get("completion_tokens") or chunks
+    return {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "ttft": round(first - start, 3),
+        "decode_tps": round((tokens - 1) / (last - first), 2) if tokens > 1 and last > first else None,
+        "completion_tokens": tokens,
+        "latency": round(end - start, 3),
+    }
+
+
+class _Canary:
+    """Canary schedule and results for one server."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.delay = interval
+        self.next_at = 0.0
+        self.running = False
+        self.model = None
+        self.series = collections.deque(maxlen=CANARY_HISTORY)
+        self.skipped = 0
+        self.error = None
+
+    def due(self, now, busy):
+        """Whether to probe now; a busy server pushes the next attempt further out."""
+        if self.running or now < self.next_at:
+            return False
+        if busy:
+            self.delay = min(self.delay * 2, self.interval * CANARY_BACKOFF)
+            self.next_at = now + self.delay
+            self.skipped += 1
+            return False
+        self.running = True
+        return True
+
+    def finish(self, model, result, error):
+        self.running = False
+        self.delay = self.interval
+        self.next_at = time.time() + self.interval
+        self.error = str(error) if error else None
+        if result is None:
+            return
+        if model and self.model and model != self.model:
+            # Another model on this port: start a new series
+            self.series.clear()
+        self.model = model or self.model
+        self.series.append(result)
+
+    def to_dict(self, now):
+        def median(key):
+            values = sorted(p[key] for p in self.series if p[key] is not None)
+            return values[len(values) // 2] if values else None
+
+        return {
+            "model": self.model,
+            "interval": self.interval,
+            "next_in": round(max(0.0, self.next_at - now), 1) if not self.running else 0.0,
+            "skipped_busy": self.skipped,
+            "error": self.error,
+            "probes": len(self.series),
+            "ttft_p50": median("ttft"),
+            "decode_tps_p50": median("decode_tps"),
+            "last": self.series[-1] if self.series else None,
+            "series": list(self.series)[-120:],
+        }
+
+
+class _Host:
+    """Scrape state for one host: known servers, backoff, and its quantile sketches."""
+
+    def __init__(self, name, ports):
+        self.name = name
+        self.ports = ports
+        self.services = {}        # port -> service dict (last known)
+        self.registered = {}      # port -> registry entry
+        self.fingerprints = {}    # port -> last record already added to the sketches
+        self.fresh = {}           # port -> new records on the last scrape
+        self.canaries = {}        # port -> _Canary
+        self.sketches = {m: QuantileSketch() for m in SKETCH_METRICS}
+        self.requests = 0
+        self.status = "pending"
+        self.error = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_ok = None
+        self.last_scan = 0.0
+
+    def ports_to_probe(self, now):
+        if now - self.last_scan >= SCAN_INTERVAL or not self.services:
+            self.last_scan = now
+            return sorted(set(self.ports) | set(self.registered))
+        return sorted(set(self.services) | set(self.registered))
+
+    def add_records(self, port, records):
+        """Feed records not seen on the previous scrape of this port to the sketches; returns how many."""
+        last = self.fingerprints.get(port)
+        start = 0
+        if last is not None:
+            for i in range(len(records) - 1, -1, -1):
+                if json.dumps(records[i], sort_keys=True) == last:
+                    start = i + 1
+                    break
+        for record in records[start:]:
+            self.requests += 1
+            for metric, sketch in self.sketches.items():
+                x = record.get(metric)
+                if isinstance(x, (int, float)) and not isinstance(x, bool):
+                    sketch.add(x)
+        if records:
+            self.fingerprints[port] = json.dumps(records[-1], sort_keys=True)
+        return len(records) - start
+
+
+def _server_type(entry, metrics):
+    if entry and entry.get("type"):
+        return entry["type"]
+    summary = (metrics or {}).get("summary") or {}
+    if "total_audio_seconds" in summary:
+        return "STT"
+    if "image_requests" in summary:
+        return "Vision"
+    return "LLM"
+
+
+class Collector:
+    """Scrapes every host each `interval` seconds and keeps the merged view."""
+
+    def __init__(self, targets, interval=2.0, timeout=3.0, workers=32, canary=0.0):
+        self.hosts = [_Host(host, ports) for host, ports in targets]
+        self.interval = interval
+        self.pool = _ConnectionPool(timeout)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="mlx-collector")
+        self.canary = canary
+        self.canary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mlx-canary") if canary else None
+        self._lock = threading.Lock()
+
+    def _probe(self, host, port):
+        """One server's /v1/metrics; ('ok', data), ('refused', None) or ('error', exc)."""
+        try:
+            return "ok", self.pool.get_json(host.name, port, "/v1/metrics")
+        except ConnectionRefusedError:
+            return "refused", None
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            return "error", e
+
+    def _registry(self, host, port):
+        try:
+            return {e["port"]: e for e in self.pool.get_json(host.name, port, "/v1/registry")["services"]}
+        except (OSError, ValueError, KeyError, TypeError, http.client.HTTPException):
+            return None
+
+    def scrape(self):
+        now = time.time()
+        live = [h for h in self.hosts if h.retry_at <= now]
+        jobs = [(h, p) for h in live for p in h.ports_to_probe(now)]
+        results = dict(zip(jobs, self.executor.map(lambda job: self._probe(*job), jobs)))
+
+        # Registered servers outside the probed range (any port); one lookup per host per rescan
+        lookups = []
+        for h in live:
+            if h.last_scan == now:
+                port = next((p for (hh, p), (kind, _) in results.items() if hh is h and kind == "ok"), None)
+                if port is not None:
+                    lookups.append((h, port))
+        for (h, _), registry in zip(lookups, self.executor.map(lambda job: self._registry(*job), lookups)):
+            if registry is not None:
+                h.registered = registry
+                extra = [(h, p) for p in registry if (h, p) not in results]
+                results.update(zip(extra, self.executor.map(lambda job: self._probe(*job), extra)))
+
+        with self._lock:
+            for h in live:
+                self._update_host(h, {p: r for (hh, p), r in results.items() if hh is h}, now)
+            probes = self._due_canaries(live, now) if self.canary else []
+        for job in probes:
+            self.canary_executor.submit(self._probe_canary, *job)
+
+    def _due_canaries(self, hosts, now):
+        probes = []
+        for h in hosts:
+            for port in list(h.canaries):
+                if port not in h.services:
+                    del h.canaries[port]
+            for port, service in h.services.items():
+                # Vision and speech servers need image or audio input; only mlx-lm gets a text canary
+                if service["type"] != "LLM":
+                    continue
+                canary = h.canaries.setdefault(port, _Canary(self.canary))
+                # A scrape that timed out, brought new requests or reports a generation
+                # still in flight means real work is running
+                in_flight = (service["metrics"].get("summary") or {}).get("in_flight") or 0
+                busy = service["stale"] or h.fresh.get(port, 0) > 0 or in_flight > 0
+                if canary.due(now, busy):
+                    probes.append((h, port, service["model"], canary))
+        return probes
+
+    def _probe_canary(self, host, port, model, canary):
+        result, error = None, None
+        try:
+            result = run_canary(host.name, port, model)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            error = e
+            logging.warning(f"{host.name}:{port}: canary failed ({e})")
+        with self._lock:
+            canary.finish(model, result, error)
+
+    def _update_host(self, host, results, now):
+        answered = {p: data for p, (kind, data) in results.items() if kind == "ok"}
+        errors = [data for kind, data in results.values() if kind == "error"]
+        for port, data in answered.items():
+            if not isinstance(data, dict) or "summary" not in data:
+                continue
+            entry = host.registered.get(port)
+            known = port in host.fingerprints
+            added = host.add_records(port, data.get("requests") or [])
+            # A server's backlog on first sight is not current work
+            host.fresh[port] = added if known else 0
+            host.services[port] = {
+                "id": f"{host.name}:{port}",
+                "host": host.name,
+                "port": port,
+                "type": _server_type(entry, data),
+                "model": (entry or {}).get("model") or _latest_model(data),
+                "metrics": data,
+                "stale": False,
+            }
+        for port, (kind, _) in results.items():
+            if port in host.services and port not in answered:
+                if kind == "refused":
+                    # Server stopped; forget it
+                    del host.services[port]
+                    host.fingerprints.pop(port, None)
+                    host.fresh.pop(port, None)
+                else:
+                    # Busy or briefly unreachable: keep the last metrics, marked stale
+                    host.services[port]["stale"] = True
+
+        if answered or (results and not errors):
+            # Reachable (refusals still prove the host is up)
+            host.status = "up" if answered else "no servers"
+            host.error = None
+            host.failures = 0
+            host.retry_at = 0.0
+            host.last_ok = now
+        elif results:
+            host.failures += 1
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (host.failures - 1))
+            host.status = "unreachable"
+            host.error = str(errors[0]) if errors else None
+            host.retry_at = now + delay
+            for service in host.services.values():
+                service["stale"] = True
+            logging.warning(f"{host.name}: unreachable ({host.error}); retrying in {delay:.0f}s")
+
+    def run(self):
+        while True:
+            started = time.time()
+            try:
+                self.scrape()
+            except Exception:
+                logging.exception("Scrape failed")
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+
+    def fleet(self):
+        """Fleet-wide and per-host view (sketches merged across hosts)."""
+        now = time.time()
+        with self._lock:
+            fleet_sketches = {m: QuantileSketch() for m in SKETCH_METRICS}
+            hosts, services = [], []
+            for h in self.hosts:
+                for metric, sketch in h.sketches.items():
+                    fleet_sketches[metric].merge(sketch)
+                hosts.append({
+                    "host": h.name,
+                    "status": h.status,
+                    "error": h.error,
+                    "retry_in": round(h.retry_at - now, 1) if h.retry_at > now else None,
+                    "last_ok": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(h.last_ok)) if h.last_ok else None,
+                    "servers": len(h.services),
+                    "requests": h.requests,
+                    "quantiles": {m: s.summary() for m, s in h.sketches.items()},
+                    "sketches": {m: s.to_dict() for m, s in h.sketches.items()},
+                })
+                for p in sorted(h.services):
+                    canary = h.canaries.get(p)
+                    services.append(dict(h.services[p], canary=canary.to_dict(now) if canary else None))
+            return {
+                "generated": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "fleet": {
+                    "hosts": len(hosts),
+                    "hosts_up": sum(1 for h in hosts if h["status"] == "up"),
+                    "servers": len(services),
+                    "requests": sum(h["requests"] for h in hosts),
+                    "quantiles": {m: s.summary() for m, s in fleet_sketches.items()},
+                },
+                "hosts": hosts,
+                "services": services,
+            }
+
+    def services(self):
+        """Servers in the shape mlx-scan.sh prints for the widget."""
+        with self._lock:
+            return {"services": [
+                {
+                    "host": s["host"],
+                    "port": s["port"],
+                    "type": s["type"],
+                    "model": s["model"] or "unknown",
+                    "metrics": s["metrics"] if not s["stale"] else dict(s["metrics"], busy=True),
+                }
+                for h in self.hosts for s in (h.services[p] for p in sorted(h.services))
+            ]}
+
+
+def _latest_model(data):
+    requests = data.get("requests") or []
+    return requests[-1].get("model") if requests else data.get("health_model")
+
+
+def _load_dashboard_html():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dashboard", "index.html")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def make_handler(collector):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == "/v1/fleet":
+                data = collector.fleet()
+                host = parse_qs(url.query).get("host", [None])[0]
+                if host:
+                    data["hosts"] = [h for h in data["hosts"] if h["host"] == host]
+                    data["services"] = [s for s in data["services"] if s["host"] == host]
+                self._send(200, json.dumps(data).encode())
+            elif url.path == "/v1/services":
+                self._send(200, json.dumps(collector.services()).encode())
+            elif url.path in ("/", "/dashboard"):
+                self._send(200, _load_dashboard_html(), "text/html; charset=utf-8")
+            elif url.path == "/health":
+                self._send(200, b'{"status": "ok"}')
+            else:
+                self._send(404, b'{"error": "not found"}')
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scrape MLX servers on several hosts and serve a fleet view.")
+    parser.add_argument("--hosts", help="host[:ports],... (default: MLX_COCKPIT_HOSTS, ~/.mlx-cockpit/hosts, or localhost)")
+    parser.add_argument("--port", type=int, default=9100, help="port to serve /v1/fleet and /dashboard on (default 9100)")
+    parser.add_argument("--bind", default="0.0.0.0", help="address to listen on (default 0.0.0.0)")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between scrapes (default 2)")
+    parser.add_argument("--timeout", type=float, default=3.0, help="per-request timeout in seconds (default 3)")
+    parser.add_argument(
+        "--canary", type=float, default=float(os.environ.get("MLX_COCKPIT_CANARY") or 0),
+        help="seconds between canary requests to each idle mlx-lm server (default: MLX_COCKPIT_CANARY, or off)",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    targets = parse_targets(args.hosts) if args.hosts else default_targets()
+    collector = Collector(targets, interval=args.interval, timeout=args.timeout, canary=args.canary)
+    threading.Thread(target=collector.run, name="mlx-collector-scrape", daemon=True).start()
+
+    httpd = ThreadingHTTPServer((args.bind, args.port), make_handler(collector))
+    print(f"Collecting from {', '.join(h for h, _ in targets)}; "
+          f"dashboard at http://{socket.gethostname()}:{httpd.server_address[1]}/dashboard")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
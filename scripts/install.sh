@@ -37,6 +37,14 @@ else
   echo -e "${YELLOW}mlx_vlm not found (optional — vision model support).${NC}"
 fi
 
+# Find mlx_audio server.py
+MLX_AUDIO_SERVER=$(python3 -c "import mlx_audio; import os; print(os.path.join(os.path.dirname(mlx_audio.__file__), 'server.py'))" 2>/dev/null || echo "")
+if [ -n "$MLX_AUDIO_SERVER" ]; then
+  echo -e "${GREEN}Found mlx_audio server:${NC} $MLX_AUDIO_SERVER"
+else
+  echo -e "${YELLOW}mlx_audio not found (optional — speech-to-text support).${NC}"
+fi
+
 # --- Patch mlx_lm ---
 if [ -n "$MLX_LM_SERVER" ]; then
   echo ""
@@ -61,6 +69,18 @@ if [ -n "$MLX_VLM_SERVER" ]; then
   fi
 fi
 
+# --- Patch mlx_audio ---
+if [ -n "$MLX_AUDIO_SERVER" ]; then
+  echo ""
+  echo -e "${BOLD}Patching mlx_audio server with metrics endpoints...${NC}"
+  if grep -q "_stt_metrics_store" "$MLX_AUDIO_SERVER" 2>/dev/null; then
+    echo -e "${GREEN}Already patched — skipping.${NC}"
+  else
+    python3 "$(dirname "$0")/patch_mlx_stt.py" "$MLX_AUDIO_SERVER"
+    echo -e "${GREEN}Patched successfully.${NC}"
+  fi
+fi
+
 # --- Install scan script ---
 echo ""
 echo -e "${BOLD}Installing scan script...${NC}"
@@ -92,6 +112,7 @@ echo ""
 echo -e "  ${CYAN}Start your MLX servers (any port from 8080-8090):${NC}"
 echo -e "    python -m mlx_lm.server --model <model> --port 8080"
 echo -e "    python -m mlx_vlm.server --port 8081"
+echo -e "    python -m mlx_audio.server --port 8082"
 echo ""
 echo -e "  ${CYAN}Auto-discovery:${NC} scans ports 8080-8090 for running MLX servers"
 echo -e "  ${CYAN}Open dashboard:${NC} http://localhost:8080/dashboard"
@@ -10,7 +10,10 @@ Creates a .bak backup before modifying. Idempotent: skips if already patched.
 Validates all insertions succeeded; rolls back on failure.
 """
 
+import importlib.metadata
+import json
 import os
+import re
 import shutil
 import sys
 
@@ -24,6 +27,23 @@ def find_server_py():
         return None
 
 
+def print_baseline_versions():
+    """Say which earlier mlx-lm versions the patched server will be compared against."""
+    path = os.environ.get("MLX_COCKPIT_BASELINES") or "~/.mlx-cockpit/baselines.json"
+    if path == "off":
+        return
+    try:
+        with open(os.path.expanduser(path)) as f:
+            series = json.load(f).get("series", {}).values()
+        current = importlib.metadata.version("mlx-lm")
+    except (OSError, ValueError, importlib.metadata.PackageNotFoundError):
+        return
+    earlier = sorted({e["version"] for e in series if e["server"] == "mlx_lm" and e["version"] != current})
+    if earlier:
+        print(f"Baselines: mlx-lm {current} will be compared with {', '.join(earlier)} "
+              "once each model has served a few requests (see /v1/baselines)")
+
+
 def load_dashboard_html():
     """Load dashboard/index.html from the project tree."""
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -32,6 +52,34 @@ def load_dashboard_html():
         return f.read()
 
 
+def load_common_runtime():
+    """Load server-patches/_cockpit_common.py, the runtime shared by every patch."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    common_path = os.path.join(script_dir, "..", "server-patches", "_cockpit_common.py")
+    with open(common_path, "r") as f:
+        return f.read()
+
+
+def find_token_loop(code):
+    """Locate the per-token generation loop in _handle_completion().
+
+    Returns (loop_line_start, body_start, indent, loop_var) or None.  Handles
+    both `for gen in response:` (batched servers) and the older multi-line
+    `for gen_response in stream_generate(...):`.
+    """
+    start = code.find("def _handle_completion(")
+    end = code.find("def completion_usage_response", start)
+    if start == -1 or end == -1:
+        return None
+    match = re.compile(
+        r"^([ \t]+)for (\w+) in (?:response|stream_generate\(.*?\)):[ \t]*\n",
+        re.MULTILINE | re.DOTALL,
+    ).search(code, start, end)
+    if match is None:
+        return None
+    return match.start(), match.end(), match.group(1), match.group(2)
+
+
 def patch(server_path):
     with open(server_path, "r") as f:
         code = f.read()
@@ -46,7 +94,6 @@ def patch(server_path):
     shutil.copy2(server_path, backup_path)
     print(f"Backup created: {backup_path}")
 
-    original = code
     insertions = 0
 
     # ---------------------------------------------------------------
@@ -65,17 +112,1146 @@ def patch(server_path):
 
     dashboard_html = load_dashboard_html().replace('\\', '\\\\').replace('"""', '\\"\\"\\"')
 
+    store_snippet = "\n\n" + load_common_runtime() + '''
+
+import importlib.metadata
+import math
+import platform
+import re
+import select
+from urllib.parse import parse_qs, urlparse
+
+
+# Module-level store for recent request metrics (used by /dashboard and /v1/metrics).
+# Set MLX_COCKPIT_SHM=<name> to share one store between every server process on
+# the host (e.g. several workers behind one port); otherwise it is per-process.
+if os.environ.get("MLX_COCKPIT_SHM"):
+    _metrics_store = _SharedMetricsStore(
+        os.environ["MLX_COCKPIT_SHM"],
+        capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+    )
+else:
+    _metrics_store: deque = deque(maxlen=200)
+
+
+class _TracedTokenizer:
+    """Tokenizer proxy that reports chat templating and tokenization as separate spans.
+
+    Stock _tokenize() renders and encodes in one apply_chat_template(tokenize=True)
+    call; for a sampled request that call is split into rendering (tokenize=False)
+    and encode(add_special_tokens=False), which is what the tokenizer does inside.
+    """
+
+    def __init__(self, tokenizer, trace):
+        self._tokenizer = tokenizer
+        self._trace = trace
+
+    def apply_chat_template(self, *args, tokenize=True, **kwargs):
+        with self._trace.stage("chat_template"):
+            text = self._tokenizer.apply_chat_template(*args, tokenize=False, **kwargs)
+        if not tokenize:
+            return text
+        with self._trace.stage("tokenize"):
+            return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def encode(self, *args, **kwargs):
+        with self._trace.stage("tokenize"):
+            return self._tokenizer.encode(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._tokenizer, name)
+
+
+# id(request) -> trace while ResponseGenerator.generate() waits for the
+# generation thread to tokenize it (only sampled requests are entered)
+_tokenize_traces = {}
+
+
+class _StreamPolicy:
+    """How streamed tokens are pushed to the socket (per token, or coalesced)."""
+
+    def __init__(self, max_ms=0.0, max_bytes=0):
+        self.max_ms = max_ms
+        self.max_bytes = max_bytes
+        self.coalescing = max_ms > 0 or max_bytes > 0
+
+    def describe(self):
+        if not self.coalescing:
+            return {"mode": "per_token"}
+        return {"mode": "coalesce", "max_ms": self.max_ms, "max_bytes": self.max_bytes}
+
+
+_stream_policy = _StreamPolicy(
+    max_ms=float(os.environ.get("MLX_COCKPIT_STREAM_COALESCE_MS", "0")),
+    max_bytes=int(os.environ.get("MLX_COCKPIT_STREAM_COALESCE_BYTES", "0")),
+)
+
+
+class _StreamWriter:
+    """Stands in for the handler's wfile for the duration of one completion.
+
+    Every real socket write is timed, so time a slow or remote client spends
+    applying backpressure is reported as write time instead of being folded
+    into generation.  Under a coalescing policy, writes are buffered and
+    flush() only sends once `max_bytes` are pending or `max_ms` have passed
+    since the last send.  The first flush always goes out immediately so
+    headers and the first token are not delayed.  With `max_ms` set, a
+    flusher thread also sends whatever is still buffered once `max_ms` have
+    passed, so a stall between tokens does not hold back the tail.  Writes
+    from the handler, its keepalive callback and the flusher are serialized
+    by one lock.
+
+    A send that fails because the client hung up marks the writer
+    disconnected and later output is dropped; the token loop polls alive()
+    and abandons the generation instead of decoding to max_tokens.
+    """
+
+    CHECK_INTERVAL = 0.05
+
+    def __init__(self, wfile, policy, trace=None, connection=None, tokens=None):
+        self._wfile = wfile
+        self._policy = policy
+        self._trace = trace
+        self._connection = connection
+        self._tokens = tokens
+        self._lock = threading.RLock()
+        self._wake = threading.Condition(self._lock)
+        self._flusher = None
+        self._finished = False
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_send = None
+        self._next_check = 0.0
+        self.write_time = 0.0
+        self.max_write = 0.0
+        self.sends = 0
+        self.disconnected = None     # perf_counter() when the client was found gone
+        self.delivered = None        # perf_counter() of the last successful send
+        self.delivered_tokens = 0    # tokens generated by then
+
+    def write(self, data):
+        with self._lock:
+            if self._policy.coalescing:
+                self._pending.append(data)
+                self._pending_bytes += len(data)
+                if self._policy.max_ms > 0 and not self._finished:
+                    self._arm()
+                return len(data)
+            return self._send(data)
+
+    def flush(self):
+        with self._lock:
+            if self._pending and not self._due():
+                return
+            self.drain()
+
+    def drain(self):
+        """Send anything still buffered (end of request or error path)."""
+        with self._lock:
+            if self._pending:
+                data = b"".join(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+                self._send(data)
+
+    def finish(self):
+        """Drain and stop the flusher; the handler's own wfile takes over again."""
+        with self._lock:
+            self._finished = True
+            self._wake.notify()
+            self.drain()
+
+    def _arm(self):
+        """Start the deadline flusher, or wake it for newly buffered data; caller holds _lock."""
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_at_deadline, name="mlx-cockpit-stream-flush", daemon=True
+            )
+            self._flusher.start()
+        else:
+            self._wake.notify()
+
+    def _flush_at_deadline(self):
+        with self._lock:
+            while not self._finished:
+                if not self._pending or self._last_send is None:
+                    self._wake.wait()
+                    continue
+                remaining = self._policy.max_ms / 1000 - (time.perf_counter() - self._last_send)
+                if remaining > 0:
+                    self._wake.wait(remaining)
+                    continue
+                try:
+                    self.drain()
+                except OSError:
+                    self._finished = True
+
+    def _due(self):
+        if self._last_send is None:
+            return True
+        if self._policy.max_bytes and self._pending_bytes >= self._policy.max_bytes:
+            return True
+        return (time.perf_counter() - self._last_send) * 1000 >= self._policy.max_ms > 0
+
+    def _send(self, data):
+        if self.disconnected is not None:
+            return len(data)
+        start = time.perf_counter()
+        try:
+            written = self._wfile.write(data)
+            self._wfile.flush()
+            self.delivered = time.perf_counter()
+            self.delivered_tokens = self._tokens.count if self._tokens is not None else 0
+            return written
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            self.disconnected = time.perf_counter()
+            return len(data)
+        finally:
+            end = time.perf_counter()
+            self._last_send = end
+            self.sends += 1
+            self.write_time += end - start
+            self.max_write = max(self.max_write, end - start)
+            if self._trace is not None:
+                self._trace.add_span("socket_write", start, end, bytes=len(data))
+
+    def alive(self):
+        """False once the client has gone: a send failed or its socket reads EOF.
+
+        The socket is peeked at most every CHECK_INTERVAL, so a non-streaming
+        request (or a coalesced stream with nothing due) notices a hang-up
+        without waiting for its next send.
+        """
+        if self.disconnected is not None:
+            return False
+        now = time.perf_counter()
+        if self._connection is None or now < self._next_check:
+            return True
+        self._next_check = now + self.CHECK_INTERVAL
+        try:
+            readable, _, _ = select.select([self._connection], [], [], 0)
+            if readable and not self._connection.recv(1, socket.MSG_PEEK):
+                self.disconnected = now
+        except (OSError, ValueError):
+            self.disconnected = now
+        return self.disconnected is None
+
+    def slow_consumer(self, latency):
+        """A client is slow if one send blocked >=100ms or sends took >=10% of the request."""
+        return self.max_write >= 0.1 or (latency > 0 and self.write_time >= 0.1 * latency)
+
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
+
+
+class _TokenStats:
+    """Per-request token counters fed from the generation loop.
+
+    Tracks when the first and last tokens arrived (so decode speed can be
+    separated from prefill), how many tokens came from the draft model, and
+    the decode batch each token was generated in (batched servers only).
+    `draft_unknown` is set when a token arrives without a from_draft field,
+    so acceptance is reported as unknown rather than 0%.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.from_draft = 0
+        self.draft_unknown = False
+        self.first = None
+        self.last = None
+        self.prompt = None
+        self.batch_sum = 0
+        self.batch_samples = 0
+
+    def add(self, gen):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+        from_draft = getattr(gen, "from_draft", None)
+        if from_draft is None:
+            self.draft_unknown = True
+        elif from_draft:
+            self.from_draft += 1
+        batch = _batch_monitor.current()
+        if batch:
+            self.batch_sum += batch
+            self.batch_samples += 1
+
+    def avg_batch(self):
+        if not self.batch_samples:
+            return None
+        return round(self.batch_sum / self.batch_samples, 2)
+
+    def decode_tps(self):
+        if self.count < 2 or self.last <= self.first:
+            return None
+        return (self.count - 1) / (self.last - self.first)
+
+
+class _ClientDisconnected(ConnectionError):
+    """Raised from the token loop to abandon a generation nobody will read."""
+
+
+_TERMINATIONS = ("completed", "stop_sequence", "length", "client_disconnect", "error")
+
+
+def _termination(finish_reason, stop_condition=None):
+    """Map the stock handler's finish_reason onto a termination reason.
+
+    "stop" covers both EOS and stop sequences; only a stop sequence leaves a
+    suffix to trim off the output.
+    """
+    if finish_reason == "length":
+        return "length"
+    if getattr(stop_condition, "stop_met", False) and getattr(stop_condition, "trim_length", 0):
+        return "stop_sequence"
+    return "completed"
+
+
+def _prompt_length(scope):
+    """Prompt token count from the completion handler's locals (ctx.prompt or prompt)."""
+    ctx = scope.get("ctx")
+    prompt = getattr(ctx, "prompt", None) if ctx is not None else scope.get("prompt")
+    try:
+        return len(prompt)
+    except TypeError:
+        return None
+
+
+def _stop_generation(scope):
+    """Tell the generator behind the handler's token loop to stop.
+
+    Batched servers decode on their own thread, so leaving the loop is not
+    enough: ctx.stop() drops the request from the batch.  Closing the
+    response generator covers servers that generate inline.
+    """
+    for name, method in (("ctx", "stop"), ("response", "close")):
+        stop = getattr(scope.get(name), method, None)
+        if callable(stop):
+            try:
+                stop()
+            except Exception as e:
+                logging.debug(f"Stopping generation via {name}.{method}() failed: {e}")
+
+
+def _termination_summary(metrics):
+    """Requests per termination reason, and the compute spent on abandoned ones."""
+    counts = dict.fromkeys(_TERMINATIONS, 0)
+    for m in metrics:
+        reason = m.get("termination", "completed")
+        counts[reason] = counts.get(reason, 0) + 1
+    abandoned = [m for m in metrics if m.get("termination") == "client_disconnect"]
+    wasted_tokens = sum(m.get("wasted_tokens", 0) for m in abandoned)
+    total_completion = sum(m["completion_tokens"] for m in metrics)
+    return {
+        "terminations": counts,
+        "wasted": {
+            "requests": len(abandoned),
+            "tokens": wasted_tokens,
+            "generation_seconds": round(sum(m.get("wasted_time", 0) for m in abandoned), 3),
+            "share_of_completion_tokens": (
+                round(wasted_tokens / total_completion, 4) if total_completion else 0.0
+            ),
+        },
+    }
+
+
+def _model_provider(handler):
+    """The handler's ModelProvider (held directly, or by its ResponseGenerator)."""
+    provider = getattr(handler, "model_provider", None)
+    if provider is None:
+        provider = getattr(getattr(handler, "response_generator", None), "model_provider", None)
+    return provider
+
+
+def _draft_config(handler):
+    """Return (draft model name, num_draft_tokens), or (None, 0) without a draft model."""
+    provider = _model_provider(handler)
+    if provider is None or getattr(provider, "draft_model", None) is None:
+        return None, 0
+    cli_args = getattr(provider, "cli_args", None)
+    key = getattr(provider, "model_key", None) or ()
+    name = (key[2] if len(key) > 2 else None) or getattr(cli_args, "draft_model", None)
+    num_draft = getattr(handler, "num_draft_tokens", None)
+    if num_draft is None:
+        num_draft = getattr(cli_args, "num_draft_tokens", 0)
+    return (name or "draft").split("/")[-1], int(num_draft or 0)
+
+
+# Recent decode tok/s of non-speculative requests, per model; the baseline a
+# speculative request's speedup is measured against.
+_spec_baseline = {}
+_draft_unknown_logged = False
+
+
+def _speculative_fields(model, stats, draft_model, num_draft):
+    """Record fields describing speculative decoding for one request."""
+    decode_tps = stats.decode_tps()
+    fields = {
+        "decode_tps": round(decode_tps, 2) if decode_tps else None,
+        "speculative": draft_model is not None,
+    }
+    if draft_model is None:
+        if decode_tps:
+            _spec_baseline.setdefault(model, deque(maxlen=20)).append(decode_tps)
+        return fields
+    baseline = _spec_baseline.get(model)
+    baseline_tps = sum(baseline) / len(baseline) if baseline else None
+    if stats.draft_unknown:
+        # The tokens reached the handler without from_draft (e.g. a server
+        # whose Response dataclass the patch could not extend): counting them
+        # would report 0% acceptance for every request
+        global _draft_unknown_logged
+        if not _draft_unknown_logged:
+            _draft_unknown_logged = True
+            logging.warning("Generated tokens carry no from_draft flag; draft acceptance is not recorded")
+        proposed = accepted = None
+    else:
+        # Each verify round yields its accepted draft tokens plus one token from
+        # the main model, so main-model tokens count the rounds.  The final round
+        # may propose fewer than num_draft, making `proposed` an upper bound.
+        proposed = (stats.count - stats.from_draft) * num_draft
+        accepted = stats.from_draft
+    fields.update({
+        "draft_model": draft_model,
+        "num_draft_tokens": num_draft,
+        "draft_proposed": proposed,
+        "draft_accepted": accepted,
+        "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+        "baseline_tps": round(baseline_tps, 2) if baseline_tps else None,
+        "speculative_speedup": (
+            round(decode_tps / baseline_tps, 2) if decode_tps and baseline_tps else None
+        ),
+    })
+    return fields
+
+
+def _speculative_summary(metrics):
+    """Per-model speculative decoding aggregates for /v1/metrics."""
+    by_model = {}
+    for m in metrics:
+        by_model.setdefault(m["model"], []).append(m)
+    summary = {}
+    for model, records in by_model.items():
+        spec = [m for m in records if m.get("speculative")]
+        if not spec:
+            continue
+        plain = [m["decode_tps"] for m in records if not m.get("speculative") and m.get("decode_tps")]
+        counted = [m for m in spec if m.get("draft_accepted") is not None]
+        proposed = sum(m["draft_proposed"] for m in counted)
+        accepted = sum(m["draft_accepted"] for m in counted)
+        spec_tps = [m["decode_tps"] for m in spec if m.get("decode_tps")]
+        avg_tps = sum(spec_tps) / len(spec_tps) if spec_tps else None
+        if plain:
+            baseline_tps = sum(plain) / len(plain)
+        else:
+            recorded = [m["baseline_tps"] for m in spec if m.get("baseline_tps")]
+            baseline_tps = sum(recorded) / len(recorded) if recorded else None
+        summary[model] = {
+            "draft_model": spec[-1]["draft_model"],
+            "num_draft_tokens": spec[-1]["num_draft_tokens"],
+            "requests": len(spec),
+            "baseline_requests": len(plain),
+            "draft_proposed": proposed,
+            "draft_accepted": accepted,
+            "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+            "avg_decode_tps": round(avg_tps, 2) if avg_tps else None,
+            "baseline_tps": round(baseline_tps, 2) if baseline_tps else None,
+            "speedup": round(avg_tps / baseline_tps, 2) if avg_tps and baseline_tps else None,
+        }
+    return summary
+
+
+class _BatchMonitor:
+    """Decode-step sampling for servers that batch concurrent requests.
+
+    The patch routes the generation thread's `batch_generator.next()` through
+    step(), which times each call and counts the sequences that got a token
+    (the active batch) and those still in prefill.  Steps roll up into
+    BUCKET-second points for the occupancy time series, and pure decode
+    steps into per-batch-size totals, which show whether a bigger batch
+    still raises total tokens/s or only slows every request down.  Handler
+    threads read current() as each token arrives, so a record can carry the
+    batch size its request ran in.
+    """
+
+    BUCKET = 5.0     # seconds per time-series point
+    BUCKETS = 180    # 15 minutes of points
+    FRESH = 1.0      # no step for this long means no batch is running
+
+    def __init__(self):
+        self.capacity = None
+        self._active = 0
+        self._updated = 0.0
+        self._series = deque(maxlen=self.BUCKETS)
+        self._by_size = {}   # batch size -> [decode steps, seconds]
+        self._lock = threading.Lock()
+
+    def step(self, generator):
+        """Call generator.next() and account for the step it ran."""
+        start = time.perf_counter()
+        result = generator.next()
+        end = time.perf_counter()
+        # Newer BatchGenerators return (prompt responses, generation responses)
+        if isinstance(result, tuple) and len(result) == 2:
+            prefill, decoded = len(result[0]), len(result[1])
+        else:
+            prefill, decoded = 0, len(result)
+        if self.capacity is None:
+            self.capacity = getattr(generator, "completion_batch_size", None)
+        self._active, self._updated = decoded, end
+        elapsed = end - start
+        key = int(time.time() // self.BUCKET * self.BUCKET)
+        with self._lock:
+            if not self._series or self._series[-1][0] != key:
+                # time, steps, decode steps, batch sum, max batch, tokens, busy s, decode s
+                self._series.append([key, 0, 0, 0, 0, 0, 0.0, 0.0])
+            point = self._series[-1]
+            point[1] += 1
+            point[5] += decoded
+            point[6] += elapsed
+            if decoded:
+                point[2] += 1
+                point[3] += decoded
+                point[4] = max(point[4], decoded)
+                point[7] += elapsed
+                if not prefill:
+                    totals = self._by_size.setdefault(decoded, [0, 0.0])
+                    totals[0] += 1
+                    totals[1] += elapsed
+        return result
+
+    def current(self):
+        """Sequences in the latest decode step, or 0 when no batch is running."""
+        if time.perf_counter() - self._updated > self.FRESH:
+            return 0
+        return self._active
+
+    def report(self):
+        """Occupancy time series and tokens/step for /v1/metrics (None if never batched)."""
+        with self._lock:
+            series = [list(p) for p in self._series]
+            by_size = sorted((size, list(t)) for size, t in self._by_size.items())
+        if not series:
+            return None
+        points = []
+        for key, steps, decode_steps, batch_sum, max_batch, tokens, busy, decode_time in series:
+            points.append({
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(key)),
+                "steps": steps,
+                "avg_batch": round(batch_sum / decode_steps, 2) if decode_steps else 0,
+                "max_batch": max_batch,
+                "occupancy": (
+                    round(batch_sum / decode_steps / self.capacity, 3)
+                    if decode_steps and self.capacity else None
+                ),
+                "tokens": tokens,
+                "step_ms": round(decode_time / decode_steps * 1000, 2) if decode_steps else None,
+                "busy": round(min(1.0, busy / self.BUCKET), 3),
+            })
+        decode_steps = sum(p[2] for p in series)
+        tokens = sum(p[5] for p in series)
+        decode_time = sum(p[7] for p in series)
+        return {
+            "capacity": self.capacity,
+            "bucket_seconds": self.BUCKET,
+            "tokens_per_step": round(tokens / decode_steps, 2) if decode_steps else None,
+            "avg_step_ms": round(decode_time / decode_steps * 1000, 2) if decode_steps else None,
+            "tokens_per_sec": round(tokens / decode_time, 1) if decode_time else None,
+            "by_batch_size": [
+                {
+                    "batch_size": size,
+                    "steps": steps,
+                    "step_ms": round(seconds / steps * 1000, 2),
+                    # Whole batch vs. what each sequence in it sees
+                    "tokens_per_sec": round(size * steps / seconds, 1) if seconds else None,
+                    "per_request_tps": round(steps / seconds, 1) if seconds else None,
+                }
+                for size, (steps, seconds) in by_size
+            ],
+            "series": points,
+        }
+
+
+_batch_monitor = _BatchMonitor()
+
+
+# Config fields that give a model's trained context length, most specific first
+_CONTEXT_KEYS = (
+    "max_position_embeddings", "max_sequence_length", "max_seq_len",
+    "seq_length", "n_positions", "n_ctx",
+)
+
+
+def _config_value(config, *names):
+    """First of `names` set on a model config (object or dict), or on its text_config."""
+    sources = [config]
+    nested = config.get("text_config") if isinstance(config, dict) else getattr(config, "text_config", None)
+    if nested is not None:
+        sources.append(nested)
+    for source in sources:
+        for name in names:
+            value = source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+            if value:
+                return value
+    return None
+
+
+class _KVCacheProfile:
+    """KV-cache footprint of a loaded model, from its config and cache layout.
+
+    Per token, each attention layer keeps keys and values for every KV head:
+    kv_heads x (head_dim + v_head_dim) elements in the model's float dtype,
+    or `kv_bits` bits plus a scale and bias per `kv_group_size` elements
+    once a --kv-bits cache passes --quantized-kv-start.  Caches grow in
+    STEP-token blocks; sliding-window layers (RotatingKVCache) stop at their
+    window, and recurrent-state layers (ArraysCache) are a fixed size and
+    left out.  An estimate of what a request's context occupies, not a
+    measurement of the allocator.
+    """
+
+    STEP = 256
+
+    def __init__(self, model, cli_args=None):
+        config = getattr(model, "args", None) or getattr(model, "config", None)
+        heads = _config_value(config, "num_attention_heads", "n_heads")
+        hidden = _config_value(config, "hidden_size", "dim")
+        self.kv_heads = _config_value(config, "num_key_value_heads", "n_kv_heads") or heads
+        self.head_dim = _config_value(config, "head_dim") or (hidden // heads if heads and hidden else None)
+        self.v_head_dim = _config_value(config, "v_head_dim") or self.head_dim
+        self.max_context = _config_value(config, *_CONTEXT_KEYS)
+        self.dtype_bytes = self._dtype_bytes(model)
+        self.full_layers, self.windows = self._layout(model)
+        self.kv_bits = getattr(cli_args, "kv_bits", None)
+        self.kv_group_size = getattr(cli_args, "kv_group_size", None) or 64
+        self.quantized_start = getattr(cli_args, "quantized_kv_start", None) or 0
+
+    @staticmethod
+    def _dtype_bytes(model):
+        """Bytes per element of the model's float dtype (keys/values are kept in it)."""
+        try:
+            import mlx.core as mx
+            from mlx.utils import tree_flatten
+            for _, p in tree_flatten(model.parameters()):
+                if mx.issubdtype(p.dtype, mx.floating):
+                    return p.dtype.size
+        except Exception:
+            pass
+        return 2
+
+    @staticmethod
+    def _layout(model):
+        """(layers whose cache grows with the context, window sizes of the bounded ones)."""
+        try:
+            caches = model.make_cache() if hasattr(model, "make_cache") else [None] * len(model.layers)
+        except Exception:
+            caches = [None] * len(getattr(model, "layers", ()))
+        full, windows = 0, []
+        pending = list(caches)
+        while pending:
+            cache = pending.pop()
+            kind = type(cache).__name__
+            if kind == "CacheList":
+                pending.extend(getattr(cache, "caches", ()))
+            elif kind in ("ArraysCache", "MambaCache"):
+                continue
+            elif getattr(cache, "max_size", None):
+                windows.append(cache.max_size)
+            else:
+                full += 1
+        return full, windows
+
+    def kv_bytes(self, tokens):
+        """Estimated KV-cache bytes for a context of `tokens` positions."""
+        if not (self.kv_heads and self.head_dim) or tokens <= 0:
+            return None
+        elements = self.kv_heads * (self.head_dim + self.v_head_dim)
+        if self.kv_bits and tokens >= self.quantized_start:
+            per_element = self.kv_bits / 8 + 2 * self.dtype_bytes / self.kv_group_size
+        else:
+            per_element = self.dtype_bytes
+        allocated = -(-tokens // self.STEP) * self.STEP
+        positions = self.full_layers * allocated + sum(min(allocated, w) for w in self.windows)
+        return int(positions * elements * per_element)
+
+
+_kv_profiles = {}   # id(model) -> (model, _KVCacheProfile); replaced when models swap
+
+
+def _kv_profile(handler):
+    """The _KVCacheProfile of the model the provider has loaded, built on first use."""
+    provider = _model_provider(handler)
+    model = getattr(provider, "model", None)
+    if model is None:
+        return None
+    entry = _kv_profiles.get(id(model))
+    if entry is None or entry[0] is not model:
+        try:
+            profile = _KVCacheProfile(model, getattr(provider, "cli_args", None))
+        except Exception as e:
+            logging.debug(f"KV-cache profile unavailable: {e}")
+            profile = None
+        # Only the loaded model matters; don't keep swapped-out ones alive
+        _kv_profiles.clear()
+        entry = _kv_profiles[id(model)] = (model, profile)
+    return entry[1]
+
+
+def _context_fields(handler, context_tokens):
+    """Record fields: context length, its share of the model's max, and KV-cache bytes."""
+    profile = _kv_profile(handler)
+    max_context = profile.max_context if profile else None
+    return {
+        "context_tokens": context_tokens,
+        "max_context": max_context,
+        "context_utilization": round(context_tokens / max_context, 4) if max_context else None,
+        "kv_cache_bytes": profile.kv_bytes(context_tokens) if profile else None,
+    }
+
+
+# Upper edges of the context-utilization histogram buckets
+_UTILIZATION_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+
+def _context_summary(metrics):
+    """Per-model context length, KV-cache peak and utilization histogram for /v1/metrics."""
+    labels, lower = [], 0
+    for upper in _UTILIZATION_BUCKETS:
+        labels.append(f"{round(lower * 100)}-{round(upper * 100)}%")
+        lower = upper
+    labels.append(f">{round(lower * 100)}%")
+    by_model = {}
+    for m in metrics:
+        if m.get("context_tokens") is not None:
+            by_model.setdefault(m["model"], []).append(m)
+    summary = {}
+    for model, records in by_model.items():
+        contexts = sorted(m["context_tokens"] for m in records)
+        kv = [m["kv_cache_bytes"] for m in records if m.get("kv_cache_bytes")]
+        histogram = dict.fromkeys(labels, 0)
+        for m in records:
+            u = m.get("context_utilization")
+            if u is None:
+                continue
+            i = 0
+            while i < len(_UTILIZATION_BUCKETS) and u > _UTILIZATION_BUCKETS[i]:
+                i += 1
+            histogram[labels[i]] += 1
+        summary[model] = {
+            "requests": len(records),
+            "max_context": records[-1].get("max_context"),
+            "avg_context_tokens": round(sum(contexts) / len(contexts)),
+            "p95_context_tokens": contexts[int(round(0.95 * (len(contexts) - 1)))],
+            "max_context_tokens": contexts[-1],
+            "peak_kv_cache_bytes": max(kv) if kv else None,
+            "utilization": histogram if any(histogram.values()) else None,
+        }
+    return summary
+
+
+class _WarmUp:
+    """Optional startup warm-up (MLX_COCKPIT_WARMUP=<max tokens>).
+
+    Once the server is bound, a background thread sends it one short chat
+    completion so the first real request finds kernels compiled and buffers
+    allocated; /health answers 503 until that request has finished.  The
+    warm-up is not recorded and does not count as a cold request.
+    """
+
+    HEADER = "X-MLX-Cockpit-Warmup"
+    TIMEOUT = 600
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.running = False
+        self.state = "off" if tokens <= 0 else "pending"
+        self.seconds = None
+
+    def start(self, address):
+        if self.tokens <= 0:
+            return
+        self.running = True
+        threading.Thread(target=self._run, args=(address,), name="mlx-cockpit-warmup", daemon=True).start()
+
+    def _run(self, address):
+        host, port = address[0], address[1]
+        # A wildcard bind is reachable on loopback
+        host = {"": "127.0.0.1", "0.0.0.0": "127.0.0.1", "::": "::1"}.get(host, host)
+        if ":" in host:
+            host = f"[{host}]"
+        body = json.dumps({
+            "messages": [{"role": "user", "content": "Hello"}],
+            "max_tokens": self.tokens,
+            "temperature": 0.0,
+        }).encode()
+        request = urllib.request.Request(
+            f"http://{host}:{port}/v1/chat/completions", data=body,
+            headers={"Content-Type": "application/json", self.HEADER: "1"},
+        )
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(request, timeout=self.TIMEOUT).read()
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            logging.warning(f"Warm-up request failed ({e}); reporting healthy anyway")
+        finally:
+            self.seconds = round(time.perf_counter() - start, 3)
+            self.running = False
+        if self.state == "done":
+            logging.info(f"Warm-up finished in {self.seconds:.2f}s")
+
+    def describe(self):
+        if self.tokens <= 0:
+            return None
+        return {
+            "max_tokens": self.tokens,
+            "state": "running" if self.running else self.state,
+            "seconds": self.seconds,
+        }
+
+
+_warmup = _WarmUp(tokens=int(os.environ.get("MLX_COCKPIT_WARMUP", "0")))
+
+
+def _synthetic(headers):
+    """A collector canary or the startup warm-up rather than real traffic."""
+    return bool(headers.get("X-MLX-Cockpit-Canary") or headers.get(_WarmUp.HEADER))
+
+
+class _InFlight:
+    """Real completions still being generated, reported as summary["in_flight"].
+
+    Finished records only show work that is over; the collector's canary
+    (collector.py --canary) also waits while this is non-zero, so a long
+    generation still running defers the probe instead of sharing the GPU
+    with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def enter(self):
+        with self._lock:
+            self.count += 1
+
+    def exit(self):
+        with self._lock:
+            self.count -= 1
+
+
+_in_flight = _InFlight()
+
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_lm")
+
+
+class _BaselineStore:
+    """Persistent speed baselines per (model, server version, hardware) and prompt-length bucket.
+
+    Prefill and decode tok/s are accumulated as Welford (n, mean, M2) triples
+    in ~/.mlx-cockpit/baselines.json, so they survive restarts and upgrades.
+    Once both sides have MIN_SAMPLES, the current environment is compared
+    with the most recently seen other version of the same model on the same
+    hardware (Welch's t), or failing that with another quantization of the
+    same base model (a quantization swap); within a version a two-sided CUSUM flags sustained
+    shifts as change points.  Each process merges only what it added since
+    its last save into the file, under an flock, so workers sharing a host
+    don't overwrite each other.
+    """
+
+    BUCKETS = (256, 1024, 4096, 16384)
+    METRICS = ("prefill_tps", "decode_tps")
+    MIN_SAMPLES = 5
+    T_SIGNIFICANT = 3.0      # |Welch t| needed to call a difference real
+    MIN_CHANGE = 0.03        # ...and at least a 3% change in the mean
+    CUSUM_K = 0.5            # slack, in standard deviations
+    CUSUM_H = 5.0            # alarm level, in standard deviations
+    SAVE_INTERVAL = 30.0
+    QUANT_SUFFIX = re.compile(r"[-_]([0-9.]+bit|bf16|fp16|f16|dwq|mxfp[0-9]+|awq|gptq|q[0-9]).*$", re.I)
+
+    def __init__(self, path, server, package):
+        self.path = path
+        self.env = {
+            "server": server,
+            "version": self._package_version(package),
+            "mlx": self._package_version("mlx"),
+            "hardware": self._hardware(),
+        }
+        self._series = {}    # series key -> entry as stored on disk
+        self._pending = {}   # (series key, bucket, metric) -> Welford triple not yet saved
+        self._cusum = {}     # (series key, bucket, metric) -> CUSUM state
+        self.change_points = collections.deque(maxlen=50)
+        self._lock = threading.Lock()
+        if self.path:
+            self._series = self._read().get("series", {})
+            threading.Thread(target=self._save_loop, name="mlx-cockpit-baselines", daemon=True).start()
+            atexit.register(self.save)
+
+    @staticmethod
+    def _package_version(package):
+        try:
+            return importlib.metadata.version(package)
+        except Exception:
+            return "unknown"
+
+    @staticmethod
+    def _hardware():
+        if sys.platform == "darwin":
+            try:
+                chip = subprocess.run(
+                    ["sysctl", "-n", "machdep.cpu.brand_string", "hw.memsize"],
+                    capture_output=True, text=True, timeout=2,
+                ).stdout.splitlines()
+                return f"{chip[0].strip()} {int(chip[1]) // 2**30}GB"
+            except Exception:
+                pass
+        return platform.processor() or platform.machine() or "unknown"
+
+    @classmethod
+    def bucket(cls, prompt_tokens):
+        lower = 0
+        for upper in cls.BUCKETS:
+            if prompt_tokens < upper:
+                return f"{lower}-{upper - 1}"
+            lower = upper
+        return f"{lower}+"
+
+    @staticmethod
+    def _merge(a, b):
+        """Combine two Welford (n, mean, M2) triples (Chan et al.)."""
+        n = a[0] + b[0]
+        if n == 0:
+            return [0, 0.0, 0.0]
+        delta = b[1] - a[1]
+        return [n, a[1] + delta * b[0] / n, a[2] + b[2] + delta * delta * a[0] * b[0] / n]
+
+    @staticmethod
+    def _stats(triple):
+        n, mean, m2 = triple
+        std = math.sqrt(m2 / (n - 1)) if n > 1 else 0.0
+        return {"n": n, "mean": round(mean, 2), "std": round(std, 2)}
+
+    def _key(self, model):
+        return "|".join((model, self.env["server"], self.env["version"], self.env["hardware"]))
+
+    def observe(self, record):
+        """Add one warm request's prefill/decode speeds to the current environment's baseline."""
+        if record.get("cold"):
+            return
+        model = record.get("model") or "unknown"
+        bucket = self.bucket(record.get("prompt_tokens") or 0)
+        key = self._key(model)
+        with self._lock:
+            entry = self._series.setdefault(key, {
+                "model": model,
+                "server": self.env["server"],
+                "version": self.env["version"],
+                "mlx": self.env["mlx"],
+                "hardware": self.env["hardware"],
+                "buckets": {},
+            })
+            entry["last_seen"] = time.time()
+            for metric in self.METRICS:
+                x = record.get(metric)
+                if not x:
+                    continue
+                stored = entry["buckets"].setdefault(bucket, {}).setdefault(metric, [0, 0.0, 0.0])
+                self._detect_change(model, key, bucket, metric, stored, x)
+                one = [1, float(x), 0.0]
+                stored[:] = self._merge(stored, one)
+                pending = self._pending.get((key, bucket, metric), [0, 0.0, 0.0])
+                self._pending[(key, bucket, metric)] = self._merge(pending, one)
+
+    def _detect_change(self, model, key, bucket, metric, stored, x):
+        # Two-sided CUSUM on values standardised against the baseline so far
+        n, mean, m2 = stored
+        if n < 2 * self.MIN_SAMPLES:
+            return
+        state = self._cusum.setdefault((key, bucket, metric), {
+            "ref": mean, "relearn": None, "hi": 0.0, "lo": 0.0,
+        })
+        if state["relearn"] is not None:
+            # After an alarm the next samples define the new level; report it then
+            state["relearn"].append(x)
+            if len(state["relearn"]) < 2 * self.MIN_SAMPLES:
+                return
+            before, state["ref"] = state["ref"], sum(state["relearn"]) / len(state["relearn"])
+            state["relearn"] = None
+            after = state["ref"]
+            if abs(after - before) >= self.MIN_CHANGE * abs(before):
+                self.change_points.append({
+                    "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "model": model,
+                    "bucket": bucket,
+                    "metric": metric,
+                    "direction": "faster" if after > before else "slower",
+                    "before": round(before, 2),
+                    "after": round(after, 2),
+                })
+                logging.warning(
+                    f"Baseline change point: {model} {metric} ({bucket} prompt tokens) "
+                    f"{before:.1f} -> {after:.1f} tok/s"
+                )
+            return
+        # Floor the spread at 1% of the mean so a very steady series doesn't alarm on noise
+        std = max(math.sqrt(m2 / (n - 1)), 0.01 * abs(mean))
+        if std <= 0:
+            return
+        z = (x - state["ref"]) / std
+        state["hi"] = max(0.0, state["hi"] + z - self.CUSUM_K)
+        state["lo"] = max(0.0, state["lo"] - z - self.CUSUM_K)
+        if max(state["hi"], state["lo"]) >= self.CUSUM_H:
+            state.update(relearn=[], hi=0.0, lo=0.0)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Merge this process's new samples into the baselines file."""
+        if not self.path:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            local = {key: dict(entry, buckets={}) for key, entry in self._series.items()}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                series = self._read().get("series", {})
+                for (key, bucket, metric), triple in pending.items():
+                    entry = series.setdefault(key, local[key])
+                    entry["last_seen"] = max(entry.get("last_seen", 0), local[key]["last_seen"])
+                    stored = entry["buckets"].setdefault(bucket, {}).get(metric, [0, 0.0, 0.0])
+                    entry["buckets"][bucket][metric] = self._merge(stored, triple)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"version": 1, "series": series}, f)
+                os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save baselines to {self.path}: {e}")
+            with self._lock:
+                for k, triple in pending.items():
+                    self._pending[k] = self._merge(self._pending.get(k, [0, 0.0, 0.0]), triple)
+            return
+        with self._lock:
+            # Adopt other workers' samples too, plus anything recorded here meanwhile
+            new_keys = set(self._series) - set(series)
+            for key in new_keys:
+                series[key] = self._series[key]
+            for (key, bucket, metric), triple in self._pending.items():
+                if key not in new_keys:
+                    metrics = series[key]["buckets"].setdefault(bucket, {})
+                    metrics[metric] = self._merge(metrics.get(metric, [0, 0.0, 0.0]), triple)
+            self._series = series
+
+    def _save_loop(self):
+        while True:
+            time.sleep(self.SAVE_INTERVAL)
+            self.save()
+
+    def verdicts(self):
+        """Current environment vs. the previous version of each model on this hardware."""
+        results = []
+        with self._lock:
+            for key, entry in self._series.items():
+                if key != self._key(entry["model"]):
+                    continue
+                previous = self._previous(entry)
+                by_size = sorted(entry["buckets"].items(), key=lambda b: int(b[0].split("-")[0].rstrip("+")))
+                for bucket, metrics in by_size:
+                    for metric, triple in sorted(metrics.items()):
+                        results.append(self._verdict(entry, previous, bucket, metric, triple))
+        return results
+
+    def _previous(self, entry):
+        """Same model under another server version, else another quantization of it."""
+        family = self.QUANT_SUFFIX.sub("", entry["model"].split("/")[-1])
+        upgrade, swap = None, None
+        for e in self._series.values():
+            if e is entry or e["server"] != entry["server"] or e["hardware"] != entry["hardware"]:
+                continue
+            if e["model"] == entry["model"]:
+                if upgrade is None or e.get("last_seen", 0) > upgrade.get("last_seen", 0):
+                    upgrade = e
+            elif self.QUANT_SUFFIX.sub("", e["model"].split("/")[-1]) == family:
+                if swap is None or e.get("last_seen", 0) > swap.get("last_seen", 0):
+                    swap = e
+        return upgrade or swap
+
+    def _verdict(self, entry, previous, bucket, metric, triple):
+        result = {
+            "model": entry["model"],
+            "bucket": bucket,
+            "metric": metric,
+            "version": entry["version"],
+            "current": self._stats(triple),
+            "previous": None,
+            "change_pct": None,
+            "t": None,
+            "verdict": "no previous version",
+        }
+        before = previous["buckets"].get(bucket, {}).get(metric) if previous else None
+        if not before:
+            return result
+        result["previous"] = dict(self._stats(before), model=previous["model"], version=previous["version"])
+        if triple[0] < self.MIN_SAMPLES or before[0] < self.MIN_SAMPLES:
+            result["verdict"] = "collecting"
+            return result
+        (n1, m1, v1), (n0, m0, v0) = triple, before
+        var = v1 / (n1 - 1) / n1 + v0 / (n0 - 1) / n0
+        change = (m1 - m0) / m0 if m0 else 0.0
+        t = (m1 - m0) / math.sqrt(var) if var > 0 else math.copysign(math.inf, m1 - m0)
+        result["change_pct"] = round(change * 100, 1)
+        result["t"] = round(t, 2) if math.isfinite(t) else None
+        significant = abs(t) >= self.T_SIGNIFICANT and abs(change) >= self.MIN_CHANGE
+        result["verdict"] = ("faster" if change > 0 else "slower") if significant else "no change"
+        return result
+
+    def report(self):
+        """Everything /v1/baselines returns."""
+        return {
+            "environment": self.env,
+            "verdicts": self.verdicts(),
+            "change_points": list(self.change_points),
+        }
+
+
+# MLX_COCKPIT_BASELINES=<file> moves the baselines file; MLX_COCKPIT_BASELINES=off disables it.
+_baselines = _BaselineStore(
+    None if os.environ.get("MLX_COCKPIT_BASELINES") == "off"
+    else os.path.expanduser(os.environ.get("MLX_COCKPIT_BASELINES") or "~/.mlx-cockpit/baselines.json"),
+    "mlx_lm",
+    "mlx-lm",
+)
+
+
+# Requests record through _recorder; alert rules and baselines see each record on its tick.
+_recorder = _MetricsRecorder(
+    _metrics_store, observers=(_alerts.observe, _baselines.observe, _clients.observe)
+)
+'''
+
     metrics_block = (
-        "\n\n"
-        "# Module-level store for recent request metrics (used by /dashboard and /v1/metrics)\n"
-        "_metrics_store: deque = deque(maxlen=200)\n"
-        "\n"
-        '_DASHBOARD_HTML = """' + dashboard_html + '"""\n'
+        store_snippet
+        + "\n"
+        + '_DASHBOARD_HTML = """' + dashboard_html + '"""\n'
     )
 
     code = code[:eol + 1] + metrics_block + code[eol + 1:]
     insertions += 1
-    print("  [1/4] Inserted _metrics_store + _DASHBOARD_HTML after imports")
+    print("  [1/11] Inserted _metrics_store (+ shared-memory store), service registry, alert rules, baselines, client accounting, recorder, batch monitor, KV-cache profile, cold-start tracker, warm-up, in-flight counter + _DASHBOARD_HTML after imports")
 
     # ---------------------------------------------------------------
     # 2. Insert metrics recording at end of handle_completion()
@@ -103,33 +1279,69 @@ def patch(server_path):
 
     metrics_snippet = '''
 
-        # Log per-request metrics
-        latency = time.perf_counter() - start_time
-        prompt_tokens = len(ctx.prompt)
-        completion_tokens = len(tokens)
-        total_tokens = prompt_tokens + completion_tokens
-        tps = completion_tokens / latency if latency > 0 else 0
-        logging.info(
-            f"prompt={prompt_tokens} completion={completion_tokens} "
-            f"total={total_tokens} | latency={latency:.1f}s | {tps:.2f} tok/s"
-        )
-        _metrics_store.append({
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "model": self.requested_model,
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": total_tokens,
-            "latency": round(latency, 2),
-            "tokens_per_sec": round(tps, 2),
-        })
+        # Push out any coalesced tail before measuring the request
+        self.wfile.drain()
+        if self.wfile.disconnected is not None:
+            termination = "client_disconnect"
+        else:
+            termination = _termination(finish_reason, locals().get("stop_condition"))
+        self._record_completion(self._cockpit_start, len(ctx.prompt), len(tokens), termination)
 '''
 
     code = code[:eol_flush + 1] + metrics_snippet + code[eol_flush + 1:]
     insertions += 1
-    print("  [2/4] Inserted metrics recording in handle_completion()")
+    print("  [2/11] Inserted metrics recording (with termination reason) in handle_completion()")
 
     # ---------------------------------------------------------------
-    # 3. Insert /v1/metrics and /dashboard routes in do_GET()
+    # 3. Move the stock handle_completion() behind a tracing wrapper
+    # ---------------------------------------------------------------
+    # The stock method is renamed to _handle_completion(); the wrapper
+    # inserted in step 6 keeps the public name so do_POST is unchanged.
+    anchor_completion = "    def handle_completion("
+    if code.count(anchor_completion) != 1:
+        print("ERROR: Could not find a single 'def handle_completion('")
+        _rollback(server_path, backup_path)
+        return False
+    code = code.replace(anchor_completion, "    def _handle_completion(", 1)
+    insertions += 1
+    print("  [3/11] Renamed stock handle_completion() to _handle_completion()")
+
+    # ---------------------------------------------------------------
+    # 4. Hook the token loop (token stats, trace boundaries, disconnects)
+    # ---------------------------------------------------------------
+    # Optional: older/newer servers spell the loop differently.  Without the
+    # hooks, traces still show the whole request and socket writes, but
+    # decode speed and draft-token acceptance are not recorded, and a client
+    # that hangs up is only noticed when the final response fails to send.
+    loop = find_token_loop(code)
+    if loop is None:
+        print("  [4/11] WARNING: token loop not found; traces will not split prefill/decode,")
+        print("         decode_tps / speculative decoding stats will be empty and")
+        print("         generation will not stop early when a client disconnects")
+    else:
+        loop_start, body_start, indent, var = loop
+        before_snippet = (
+            f"{indent}self._cockpit_tokens.prompt = _prompt_length(locals())\n"
+            f"{indent}if self._cockpit_trace is not None:\n"
+            f"{indent}    self._cockpit_trace.mark(\"generate\")\n"
+        )
+        body_snippet = (
+            f"{indent}    self._cockpit_tokens.add({var})\n"
+            f"{indent}    if self._cockpit_trace is not None:\n"
+            f"{indent}        self._cockpit_trace.token()\n"
+            f"{indent}    if not self.wfile.alive():\n"
+            f"{indent}        _stop_generation(locals())\n"
+            f"{indent}        raise _ClientDisconnected()\n"
+        )
+        code = (
+            code[:loop_start] + before_snippet + code[loop_start:body_start]
+            + body_snippet + code[body_start:]
+        )
+        print("  [4/11] Inserted token-stats, trace and disconnect hooks around the token loop")
+    insertions += 1
+
+    # ---------------------------------------------------------------
+    # 5. Insert /v1/metrics, /v1/trace, /v1/profile, /v1/registry and /dashboard routes in do_GET()
     # ---------------------------------------------------------------
     # Find the else/404 block in do_GET and insert before it
     # Pattern: '        elif self.path == "/health":\n            self.handle_health_check()\n        else:'
@@ -145,16 +1357,26 @@ def patch(server_path):
     route_snippet = (
         '        elif self.path == "/v1/metrics":\n'
         '            self.handle_metrics_request()\n'
+        '        elif urlparse(self.path).path == "/v1/metrics/clients":\n'
+        '            self.handle_clients_request()\n'
+        '        elif self.path == "/v1/trace":\n'
+        '            self.handle_trace_request()\n'
+        '        elif self.path.startswith("/v1/profile"):\n'
+        '            self.handle_profile_request()\n'
+        '        elif self.path == "/v1/registry":\n'
+        '            self.handle_registry_request()\n'
+        '        elif self.path == "/v1/baselines":\n'
+        '            self.handle_baselines_request()\n'
         '        elif self.path == "/dashboard":\n'
         '            self.handle_dashboard_request()\n'
     )
 
     code = code[:insert_pos] + route_snippet + code[insert_pos:]
     insertions += 1
-    print("  [3/4] Inserted /v1/metrics and /dashboard routes in do_GET()")
+    print("  [5/11] Inserted /v1/metrics, /v1/metrics/clients, /v1/trace, /v1/profile, /v1/registry, /v1/baselines and /dashboard routes in do_GET()")
 
     # ---------------------------------------------------------------
-    # 4. Insert handle_metrics_request() and handle_dashboard_request()
+    # 6. Insert handle_completion() wrapper and the new GET handlers
     # ---------------------------------------------------------------
     # Insert after do_GET method — find "def handle_health_check"
     anchor_health = "def handle_health_check(self):"
@@ -164,12 +1386,130 @@ def patch(server_path):
         _rollback(server_path, backup_path)
         return False
 
-    # Insert before handle_health_check
-    methods_snippet = '''    def handle_metrics_request(self):
+    # The stock health check moves behind a wrapper that holds /health at
+    # 503 during the startup warm-up
+    code = code[:idx_health] + "def _handle_health_check(self):" + code[idx_health + len(anchor_health):]
+
+    # Insert before the (renamed) health check, at the start of its line so
+    # the snippet's own indentation is used
+    idx_health = code.rfind("\n", 0, idx_health) + 1
+    methods_snippet = '''    def handle_completion(self, *args, **kwargs):
+        """Run the stock handler (_handle_completion) with socket timing, token stats and tracing.
+
+        Requests the stock handler does not finish are recorded here: a
+        client that hung up (generation is abandoned at the next token) and
+        an exception escaping generation.
+        """
+        # Stock handlers keep no start time of their own (mlx-lm 0.29+); record from here
+        self._cockpit_start = start = time.perf_counter()
+        trace = _tracer.begin("completion", path=self.path)
+        self._cockpit_trace = trace
+        trace_token = _current_trace.set(trace)
+        self._cockpit_generation = _cold.generation
+        self._cockpit_tokens = _TokenStats()
+        wfile = self.wfile
+        self.wfile = _StreamWriter(
+            wfile, _stream_policy, trace, connection=self.connection, tokens=self._cockpit_tokens
+        )
+        synthetic = _synthetic(self.headers)
+        if not synthetic:
+            _in_flight.enter()
+        try:
+            return self._handle_completion(*args, **kwargs)
+        except _ClientDisconnected:
+            self.close_connection = True
+            tokens = self._cockpit_tokens
+            self._record_completion(start, tokens.prompt or 0, tokens.count, "client_disconnect")
+        except Exception:
+            tokens = self._cockpit_tokens
+            try:
+                self._record_completion(start, tokens.prompt or 0, tokens.count, "error")
+            except Exception as e:
+                logging.debug(f"Could not record failed completion: {e}")
+            raise
+        finally:
+            if not synthetic:
+                _in_flight.exit()
+            try:
+                self.wfile.finish()
+            except OSError:
+                pass
+            self.wfile = wfile
+            self._cockpit_trace = None
+            _current_trace.reset(trace_token)
+            if trace is not None:
+                trace.phase("prepare", "start", "generate")
+                trace.phase("prefill", "generate", "first_token")
+                trace.phase("decode", "first_token", "last_token")
+                _tracer.end(trace)
+
+    def _record_completion(self, start_time, prompt_tokens, completion_tokens, termination):
+        """Build the request record, log it and hand it to the recorder."""
+        latency = time.perf_counter() - start_time
+        total_tokens = prompt_tokens + completion_tokens
+        tps = completion_tokens / latency if latency > 0 else 0
+        write_time = self.wfile.write_time
+        first = self._cockpit_tokens.first
+        ttft = first - start_time if first else None
+        logging.info(
+            f"prompt={prompt_tokens} completion={completion_tokens} "
+            f"total={total_tokens} | latency={latency:.1f}s | {tps:.2f} tok/s "
+            f"| socket={write_time:.2f}s | {termination}"
+        )
+        if self._cockpit_trace is not None:
+            self._cockpit_trace.args.update(
+                model=self.requested_model,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                termination=termination,
+            )
+        # Canary probes (collector.py --canary) are timed by the collector as
+        # their own series, and the startup warm-up is not traffic at all; keep
+        # both out of the real-traffic metrics, the cold-request count and the
+        # speculative-decoding baseline
+        if _synthetic(self.headers):
+            return
+        draft_model, num_draft = _draft_config(self)
+        speculative = _speculative_fields(
+            self.requested_model, self._cockpit_tokens, draft_model, num_draft
+        )
+        record = {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "model": self.requested_model,
+            "client": _client_identity(self.headers.get, self.client_address[0]),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "latency": round(latency, 2),
+            "tokens_per_sec": round(tps, 2),
+            "ttft": round(ttft, 3) if ttft else None,
+            "prefill_tps": round(prompt_tokens / ttft, 1) if ttft else None,
+            "generation_time": round(latency - write_time, 3),
+            "write_time": round(write_time, 3),
+            "max_write_ms": round(self.wfile.max_write * 1000, 1),
+            "socket_writes": self.wfile.sends,
+            "slow_consumer": self.wfile.slow_consumer(latency),
+            "chunking": _stream_policy.describe() if self.stream else None,
+            "termination": termination,
+            "avg_batch_size": self._cockpit_tokens.avg_batch(),
+            **_context_fields(self, total_tokens),
+            **speculative,
+            **_cold.claim(self._cockpit_generation),
+        }
+        if termination == "client_disconnect":
+            # Tokens (and seconds) produced after the client was last reached:
+            # for a stream, since the last successful send; for a buffered
+            # response, all of it, since nothing was ever delivered
+            last_reached = self.wfile.delivered or start_time
+            record["wasted_tokens"] = completion_tokens - self.wfile.delivered_tokens
+            record["wasted_time"] = round(max(0.0, start_time + latency - last_reached), 3)
+        _recorder.append(record)
+
+    def handle_metrics_request(self):
         """Return recent request metrics as JSON."""
         self._set_completion_headers(200)
         self.end_headers()
-        metrics = list(_metrics_store)
+        metrics = _recorder.snapshot()
         total_requests = len(metrics)
         avg_tps = (
             sum(m["tokens_per_sec"] for m in metrics) / total_requests
@@ -178,6 +1518,7 @@ def patch(server_path):
         )
         total_prompt = sum(m["prompt_tokens"] for m in metrics)
         total_completion = sum(m["completion_tokens"] for m in metrics)
+        batched = [m["avg_batch_size"] for m in metrics if m.get("avg_batch_size")]
         data = {
             "requests": metrics,
             "summary": {
@@ -185,11 +1526,46 @@ def patch(server_path):
                 "avg_tokens_per_sec": round(avg_tps, 2),
                 "total_prompt_tokens": total_prompt,
                 "total_completion_tokens": total_completion,
+                "total_write_time": round(sum(m.get("write_time", 0) for m in metrics), 3),
+                "slow_consumer_requests": sum(1 for m in metrics if m.get("slow_consumer")),
+                "stream_chunking": _stream_policy.describe(),
+                "speculative": _speculative_summary(metrics),
+                **_termination_summary(metrics),
+                "avg_batch_size": round(sum(batched) / len(batched), 2) if batched else None,
+                "context": _context_summary(metrics),
+                "cold_start": {**_cold.summary(metrics), "warmup": _warmup.describe()},
+                "in_flight": _in_flight.count,
             },
+            "batching": _batch_monitor.report(),
+            "alerts": _alerts.snapshot(),
+            "baselines": _baselines.report(),
+            "clients": _clients.report(top=5, windows=("15m",)),
         }
         self.wfile.write(json.dumps(data).encode())
         self.wfile.flush()
 
+    def handle_clients_request(self):
+        """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+        try:
+            top = int(parse_qs(urlparse(self.path).query).get("top", ["10"])[0])
+        except ValueError:
+            top = 10
+        self._set_completion_headers(200)
+        self.end_headers()
+        report = _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+        self.wfile.write(json.dumps(report).encode())
+        self.wfile.flush()
+
+    def handle_health_check(self):
+        """Answer 503 while the startup warm-up runs, then defer to the stock check."""
+        if _warmup.running:
+            self._set_completion_headers(503)
+            self.end_headers()
+            self.wfile.write(json.dumps({"status": "warming up"}).encode())
+            self.wfile.flush()
+            return
+        return self._handle_health_check()
+
     def handle_dashboard_request(self):
         """Serve a live HTML dashboard that polls /v1/metrics."""
         self.send_response(200)
@@ -199,17 +1575,244 @@ def patch(server_path):
         self.wfile.write(html.encode())
         self.wfile.flush()
 
-    '''
+    def handle_trace_request(self):
+        """Return sampled request traces as Chrome trace-event JSON."""
+        self._set_completion_headers(200)
+        self.end_headers()
+        self.wfile.write(json.dumps(_tracer.export()).encode())
+        self.wfile.flush()
+
+    def handle_registry_request(self):
+        """Return the MLX servers registered on this host (self-registration)."""
+        self._set_completion_headers(200)
+        self.end_headers()
+        self.wfile.write(json.dumps({"services": _registry.live()}).encode())
+        self.wfile.flush()
+
+    def handle_baselines_request(self):
+        """Return per-version speed baselines, regression verdicts and change points."""
+        self._set_completion_headers(200)
+        self.end_headers()
+        self.wfile.write(json.dumps(_baselines.report()).encode())
+        self.wfile.flush()
+
+    def handle_profile_request(self):
+        """Sample every thread's stack for ?seconds=N&hz=M (MLX_COCKPIT_PROFILE=1)."""
+        query = parse_qs(urlparse(self.path).query)
+        if not _profiler.enabled:
+            status, data = 403, {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"}
+        else:
+            try:
+                seconds = float(query.get("seconds", ["10"])[0])
+                hz = int(query.get("hz", ["100"])[0])
+            except ValueError:
+                seconds = hz = None
+            if seconds is None:
+                status, data = 400, {"error": "seconds and hz must be numbers"}
+            else:
+                data = _profiler.run(seconds=seconds, hz=hz)
+                status = 200 if data is not None else 409
+                if data is None:
+                    data = {"error": "A profile is already running"}
+        if status == 200 and query.get("format", ["json"])[0] == "collapsed":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self._set_cors_headers()
+            self.end_headers()
+            self.wfile.write(data["collapsed"].encode())
+        else:
+            self._set_completion_headers(status)
+            self.end_headers()
+            self.wfile.write(json.dumps(data).encode())
+        self.wfile.flush()
+
+'''
 
     code = code[:idx_health] + methods_snippet + code[idx_health:]
     insertions += 1
-    print("  [4/4] Inserted handle_metrics_request() and handle_dashboard_request()")
+    print("  [6/11] Inserted handle_completion() and handle_health_check() wrappers and metrics/trace/profile/registry/dashboard handlers")
+
+    # ---------------------------------------------------------------
+    # 7. Register the server and start the warm-up once it is bound (in run())
+    # ---------------------------------------------------------------
+    # Optional: without it the dashboard and widget fall back to scanning
+    # ports 8080-8090, and MLX_COCKPIT_WARMUP has no effect.
+    anchor_serve = "httpd.serve_forever()"
+    idx_serve = code.find(anchor_serve)
+    if idx_serve == -1:
+        print("  [7/11] WARNING: httpd.serve_forever() not found; server will not self-register")
+        print("         or run the MLX_COCKPIT_WARMUP request")
+    else:
+        line_start = code.rfind("\n", 0, idx_serve) + 1
+        indent = code[line_start:idx_serve]
+        # run() has model_provider; mlx-lm 0.31 serves from _run_http_server(),
+        # which only gets the response_generator that owns it
+        enclosing = code[code.rfind("\ndef ", 0, idx_serve):idx_serve]
+        if "model_provider" in enclosing:
+            provider = "model_provider"
+        elif "response_generator" in enclosing:
+            provider = "response_generator.model_provider"
+        else:
+            provider = None
+        served_model = (
+            f"getattr(getattr({provider}, \"cli_args\", None), \"model\", None)" if provider else "None"
+        )
+        register_snippet = (
+            f"{indent}_registry.register(\n"
+            f"{indent}    \"mlx_lm\", \"LLM\", httpd.server_address[1],\n"
+            f"{indent}    {served_model},\n"
+            f"{indent})\n"
+            f"{indent}_warmup.start(httpd.server_address)\n"
+        )
+        code = code[:line_start] + register_snippet + code[line_start:]
+        print("  [7/11] Inserted service registration and warm-up start before httpd.serve_forever()")
+    insertions += 1
+
+    # ---------------------------------------------------------------
+    # 8. Time the batched generation loop's steps
+    # ---------------------------------------------------------------
+    # Optional: only servers with continuous batching call
+    # batch_generator.next() in ResponseGenerator; routing it through
+    # _batch_monitor.step() samples batch size and decode step time.
+    start_rg = code.find("class ResponseGenerator")
+    end_rg = code.find("class APIHandler", start_rg)
+    anchor_step = "batch_generator.next()"
+    steps = code.count(anchor_step, start_rg, end_rg) if start_rg != -1 and end_rg != -1 else 0
+    if steps == 0:
+        print("  [8/11] WARNING: batch_generator.next() not found; this server does not batch,")
+        print("         so batch occupancy and tokens/step will not be recorded")
+    else:
+        region = code[start_rg:end_rg].replace(anchor_step, "_batch_monitor.step(batch_generator)")
+        code = code[:start_rg] + region + code[end_rg:]
+        print(f"  [8/11] Routed {steps} batch_generator.next() call(s) through _batch_monitor")
+    insertions += 1
+
+    # ---------------------------------------------------------------
+    # 9. Time model loads (ModelProvider.load)
+    # ---------------------------------------------------------------
+    # Optional: the stock load() is renamed to _load_model() behind a
+    # wrapper that reports each load that swaps the model in to _cold.
+    start_mp = code.find("class ModelProvider")
+    end_mp = code.find("\nclass ", start_mp + 1) if start_mp != -1 else -1
+    anchor_load = "    def load(self, "
+    if start_mp == -1 or end_mp == -1 or code.count(anchor_load, start_mp, end_mp) != 1:
+        print("  [9/11] WARNING: ModelProvider.load() not found; model load time and weight size")
+        print("         will not be recorded (cold requests are still flagged)")
+    else:
+        idx_load = code.find(anchor_load, start_mp, end_mp)
+        load_snippet = '''    def load(self, *args, **kwargs):
+        """Run the stock loader (_load_model), timing it whenever it swaps a model in."""
+        before = getattr(self, "model", None)
+        start = time.perf_counter()
+        result = self._load_model(*args, **kwargs)
+        if self.model is not None and self.model is not before:
+            name = (getattr(self, "model_key", None) or (None,))[0]
+            if name in (None, "default_model"):
+                name = getattr(self.cli_args, "model", None) or "default_model"
+            _cold.loaded(
+                name,
+                time.perf_counter() - start,
+                _weight_bytes(self.model, getattr(self, "draft_model", None)),
+            )
+        return result
+
+    def _load_model(self, '''
+        code = code[:idx_load] + load_snippet + code[idx_load + len(anchor_load):]
+        print("  [9/11] Moved stock ModelProvider.load() behind a load-timing wrapper")
+    insertions += 1
+
+    # ---------------------------------------------------------------
+    # 10. Trace chat templating and tokenization (ResponseGenerator)
+    # ---------------------------------------------------------------
+    # Optional: the stock generate() and _tokenize() are renamed behind
+    # wrappers that carry a sampled request's trace to the generation
+    # thread, where _tokenize() runs, and hand it a _TracedTokenizer.
+    start_rg = code.find("class ResponseGenerator")
+    end_rg = code.find("\nclass ", start_rg + 1) if start_rg != -1 else -1
+    anchor_generate = "    def generate(\n        self,"
+    anchor_generate_flat = "    def generate(self, "
+    anchor_tokenize = "    def _tokenize(self, "
+    if start_rg == -1 or end_rg == -1:
+        found = False
+    else:
+        region = code[start_rg:end_rg]
+        found = region.count(anchor_tokenize) == 1 and (
+            region.count(anchor_generate) + region.count(anchor_generate_flat) == 1
+        )
+    if not found:
+        print("  [10/11] WARNING: ResponseGenerator._tokenize() not found; traces will not")
+        print("          split chat_template and tokenize out of prepare")
+    else:
+        generate_snippet = '''    def generate(self, request, *args, **kwargs):
+        """Run the stock generate (_stock_generate); a sampled request's trace follows it to _tokenize()."""
+        trace = _current_trace.get()
+        if trace is None:
+            return self._stock_generate(request, *args, **kwargs)
+        _tokenize_traces[id(request)] = trace
+        try:
+            return self._stock_generate(request, *args, **kwargs)
+        finally:
+            _tokenize_traces.pop(id(request), None)
+
+'''
+        tokenize_snippet = '''    def _tokenize(self, tokenizer, request, *args):
+        """Run the stock tokenizer step (_stock_tokenize) with chat_template/tokenize spans when sampled."""
+        trace = _tokenize_traces.get(id(request))
+        if trace is not None:
+            tokenizer = _TracedTokenizer(tokenizer, trace)
+        return self._stock_tokenize(tokenizer, request, *args)
+
+'''
+        region = region.replace(anchor_tokenize, tokenize_snippet + "    def _stock_tokenize(self, ", 1)
+        if anchor_generate in region:
+            region = region.replace(anchor_generate, generate_snippet + "    def _stock_generate(\n        self,", 1)
+        else:
+            region = region.replace(anchor_generate_flat, generate_snippet + "    def _stock_generate(self, ", 1)
+        code = code[:start_rg] + region + code[end_rg:]
+        print("  [10/11] Moved stock ResponseGenerator.generate() and _tokenize() behind tracing wrappers")
+    insertions += 1
+
+    # ---------------------------------------------------------------
+    # 11. Carry from_draft through ResponseGenerator's Response dataclass
+    # ---------------------------------------------------------------
+    # Servers with a ResponseGenerator copy each stream_generate() result
+    # into a Response that has no from_draft field, so the token loop would
+    # count 0 accepted draft tokens.  Add the field (defaulting to False, as
+    # the batched path never runs a draft model) and fill it in from every
+    # `Response(<gen>.text, ...)` call.  Older servers iterate
+    # stream_generate() in the handler and need nothing.
+    match_response = re.search(r"^class Response:\n((?:    .*\n)+)", code, re.M)
+    if match_response is None:
+        print("  [11/11] No Response dataclass; the token loop reads from_draft from stream_generate()")
+    else:
+        fields_end = match_response.end(1)
+        code = code[:fields_end] + "    from_draft: bool = False\n" + code[fields_end:]
+        calls = list(re.finditer(r"Response\(\n([ \t]+)(\w+)\.text,\n", code))
+        for call in reversed(calls):
+            depth = 0
+            for idx_close in range(call.start() + len("Response"), len(code)):
+                if code[idx_close] == "(":
+                    depth += 1
+                elif code[idx_close] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+            line_start = code.rfind("\n", 0, idx_close) + 1
+            arg = f'{call.group(1)}from_draft=getattr({call.group(2)}, "from_draft", False),\n'
+            code = code[:line_start] + arg + code[line_start:]
+        if not calls:
+            print("ERROR: Response dataclass found but no Response(<gen>.text, ...) call to")
+            print("       pass from_draft through; draft acceptance would always read 0%. Rolling back.")
+            _rollback(server_path, backup_path)
+            return False
+        print(f"  [11/11] Added Response.from_draft and passed it through {len(calls)} Response(...) call(s)")
+    insertions += 1
 
     # ---------------------------------------------------------------
     # Validate
     # ---------------------------------------------------------------
-    if insertions != 4:
-        print(f"ERROR: Expected 4 insertions, got {insertions}. Rolling back.")
+    if insertions != 11:
+        print(f"ERROR: Expected 11 insertions, got {insertions}. Rolling back.")
         _rollback(server_path, backup_path)
         return False
 
@@ -217,9 +1820,26 @@ def patch(server_path):
     checks = [
         ("_metrics_store", "_metrics_store declaration"),
         ("_DASHBOARD_HTML", "dashboard HTML string"),
+        ("_recorder.append(record)", "metrics recording"),
+        ("self._record_completion(self._cockpit_start", "completion record call"),
+        ("_alerts.observe, _baselines.observe", "alert rule evaluation and baselines"),
+        ('"batching": _batch_monitor.report()', "batch occupancy report"),
+        ("**_cold.claim(self._cockpit_generation)", "cold request flag"),
+        ("def _handle_health_check(self):", "renamed stock health check"),
         ("handle_metrics_request", "metrics request handler"),
+        ("handle_clients_request", "client accounting handler"),
+        ('"/v1/metrics/clients"', "/v1/metrics/clients route"),
         ("handle_dashboard_request", "dashboard request handler"),
+        ("handle_trace_request", "trace request handler"),
+        ("handle_profile_request", "profile request handler"),
+        ("handle_registry_request", "registry request handler"),
+        ("def _handle_completion(", "renamed stock completion handler"),
         ('"/v1/metrics"', "/v1/metrics route"),
+        ('"/v1/trace"', "/v1/trace route"),
+        ('"/v1/profile"', "/v1/profile route"),
+        ('"/v1/registry"', "/v1/registry route"),
+        ('"/v1/baselines"', "/v1/baselines route"),
+        ("handle_baselines_request", "baselines request handler"),
         ('"/dashboard"', "/dashboard route"),
     ]
     for needle, label in checks:
@@ -258,6 +1878,7 @@ def main():
     print(f"Patching: {server_path}")
     if not patch(server_path):
         sys.exit(1)
+    print_baseline_versions()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+"""
+patch_mlx_stt.py — Patch mlx_audio/server.py with /v1/metrics and /dashboard endpoints.
+
+Usage:
+    python3 patch_mlx_stt.py <path-to-mlx_audio-server.py>
+    python3 patch_mlx_stt.py                                # auto-discovers via import
+
+Records audio duration, decode time, real-time factor, segments and output
+tokens for every transcription/translation request.
+
+Creates a .bak backup before modifying. Idempotent: skips if already patched.
+Validates all insertions succeeded; rolls back on failure.
+"""
+
+import os
+import shutil
+import sys
+
+
+def find_server_py():
+    """Auto-discover mlx_audio/server.py via import."""
+    try:
+        import mlx_audio
+        return os.path.join(os.path.dirname(mlx_audio.__file__), "server.py")
+    except ImportError:
+        return None
+
+
+def load_dashboard_html():
+    """Load dashboard/index.html from the project tree."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    html_path = os.path.join(script_dir, "..", "dashboard", "index.html")
+    with open(html_path, "r") as f:
+        return f.read()
+
+
+def load_common_runtime():
+    """Load server-patches/_cockpit_common.py, the runtime shared by every patch."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    common_path = os.path.join(script_dir, "..", "server-patches", "_cockpit_common.py")
+    with open(common_path, "r") as f:
+        return f.read()
+
+
+def patch(server_path):
+    with open(server_path, "r") as f:
+        code = f.read()
+
+    # --- Idempotent check ---
+    if "_stt_metrics_store" in code:
+        print(f"Already patched: {server_path}")
+        return True
+
+    # --- Create backup ---
+    backup_path = server_path + ".bak"
+    shutil.copy2(server_path, backup_path)
+    print(f"Backup created: {backup_path}")
+
+    # mlx-audio 0.5+ decodes on an inference broker thread; only its STT adapter is hooked
+    unhooked_broker = "InferenceBroker" in code and "class STTExecutionAdapter" not in code
+
+    insertions = 0
+
+    # ---------------------------------------------------------------
+    # 1a. Ensure HTMLResponse import exists
+    # ---------------------------------------------------------------
+    if "from fastapi.responses import HTMLResponse" not in code:
+        anchor_resp = "from fastapi.responses import"
+        idx_resp = code.find(anchor_resp)
+        if idx_resp != -1:
+            eol_resp = code.index("\n", idx_resp)
+            code = code[:eol_resp + 1] + "from fastapi.responses import HTMLResponse\n" + code[eol_resp + 1:]
+        else:
+            # Insert after "from fastapi import" line
+            anchor_fi = "from fastapi import"
+            idx_fi = code.find(anchor_fi)
+            if idx_fi != -1:
+                eol_fi = code.index("\n", idx_fi)
+                code = code[:eol_fi + 1] + "from fastapi.responses import HTMLResponse\n" + code[eol_fi + 1:]
+        print("  Inserted HTMLResponse import")
+
+    # ---------------------------------------------------------------
+    # 1b. Ensure CORSMiddleware import exists
+    # ---------------------------------------------------------------
+    if "from fastapi.middleware.cors import CORSMiddleware" not in code:
+        # Insert after "from fastapi" line
+        anchor = "from fastapi import"
+        idx = code.find(anchor)
+        if idx == -1:
+            print("ERROR: Could not find 'from fastapi import'")
+            _rollback(server_path, backup_path)
+            return False
+        eol = code.index("\n", idx)
+        code = code[:eol + 1] + "from fastapi.middleware.cors import CORSMiddleware\n" + code[eol + 1:]
+        print("  Inserted CORSMiddleware import")
+
+    # ---------------------------------------------------------------
+    # 2. Insert CORS middleware after app = FastAPI(...)
+    # ---------------------------------------------------------------
+    if "app.add_middleware" not in code:
+        # Find end of app = FastAPI(...) block
+        anchor_app = "app = FastAPI("
+        idx_app = code.find(anchor_app)
+        if idx_app == -1:
+            print("ERROR: Could not find 'app = FastAPI('")
+            _rollback(server_path, backup_path)
+            return False
+
+        # Find the closing paren of FastAPI(...)
+        # Look for the line starting with ")" after app = FastAPI(
+        search_start = idx_app
+        paren_depth = 0
+        i = code.index("(", search_start)
+        for i in range(i, len(code)):
+            if code[i] == "(":
+                paren_depth += 1
+            elif code[i] == ")":
+                paren_depth -= 1
+                if paren_depth == 0:
+                    break
+        eol_app = code.index("\n", i)
+
+        cors_snippet = (
+            "\n"
+            "app.add_middleware(\n"
+            '    CORSMiddleware,\n'
+            '    allow_origins=["*"],\n'
+            '    allow_methods=["GET"],\n'
+            '    allow_headers=["*"],\n'
+            ")\n"
+        )
+        code = code[:eol_app + 1] + cors_snippet + code[eol_app + 1:]
+        insertions += 1
+        print("  [1/4] Inserted CORS middleware")
+    else:
+        insertions += 1
+        print("  [1/4] CORS middleware already present")
+
+    # ---------------------------------------------------------------
+    # 3. Insert metrics store, request middleware and model
+    #    instrumentation before the first route
+    # ---------------------------------------------------------------
+    idx_route = code.find("\n@app.")
+    if idx_route == -1:
+        print("ERROR: Could not find any '@app.' route")
+        _rollback(server_path, backup_path)
+        return False
+    idx_route += 1
+
+    dashboard_html = load_dashboard_html().replace('\\', '\\\\').replace('"""', '\\"\\"\\"')
+
+    store_snippet = "\n\n" + load_common_runtime() + '''
+
+import asyncio
+import functools
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+
+# --- Metrics store (mirrors mlx_lm server format) ---
+# Set MLX_COCKPIT_SHM=<name> to share one store between all uvicorn workers on
+# the host; otherwise each worker only sees the requests it served itself.
+if os.environ.get("MLX_COCKPIT_SHM"):
+    _stt_metrics_store = _SharedMetricsStore(
+        os.environ["MLX_COCKPIT_SHM"],
+        capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+    )
+else:
+    _stt_metrics_store: deque = deque(maxlen=200)
+
+_STT_PATHS = ("/audio/transcriptions", "/audio/translations")
+_STT_SAMPLE_RATE = 16000  # what STT models resample to; used for raw arrays
+
+_current_stt = contextvars.ContextVar("mlx_cockpit_stt", default=None)
+
+
+class _STTStats:
+    """What one transcription request decoded, filled in by the model wrapper."""
+
+    __slots__ = ("model", "client", "audio_duration", "decode_time", "result", "calls", "chunks", "trace")
+
+    def __init__(self):
+        self.model = None
+        self.client = None
+        self.audio_duration = 0.0
+        self.decode_time = 0.0
+        self.result = None
+        self.calls = 0
+        self.chunks = 0
+        self.trace = None  # sampled _Trace; rides with the stats onto decode threads
+
+
+def _audio_duration(audio):
+    """Seconds of audio in a file path or a raw sample array, or None."""
+    if isinstance(audio, (str, os.PathLike)):
+        try:
+            import soundfile
+            return soundfile.info(audio).duration
+        except Exception:
+            pass
+        try:
+            import wave
+            with wave.open(os.fspath(audio), "rb") as w:
+                return w.getnframes() / w.getframerate()
+        except Exception:
+            return None
+    shape = getattr(audio, "shape", None)
+    if shape:
+        return max(shape) / _STT_SAMPLE_RATE
+    return None
+
+
+def _transcript_fields(result):
+    """Segments, output tokens, language and covered duration of an STT result."""
+    get = result.get if isinstance(result, dict) else (lambda key: getattr(result, key, None))
+    segments = [s for s in (get("segments") or []) if isinstance(s, dict)]
+    return {
+        "segments": len(segments),
+        "output_tokens": sum(len(s.get("tokens") or []) for s in segments),
+        "language": get("language"),
+        "end": max((s.get("end") or 0.0 for s in segments), default=0.0),
+    }
+
+
+def _record_stt_metric(stats, latency):
+    """Append one transcription request's metrics to the ring buffer."""
+    fields = _transcript_fields(stats.result)
+    # Fall back to the last segment's end when the input could not be measured
+    audio = stats.audio_duration or fields["end"]
+    decode = stats.decode_time
+    # Streamed text carries no token ids: count its chunks instead
+    tokens = fields["output_tokens"] or stats.chunks
+    record = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": (stats.model.split("/")[-1] if stats.model else "unknown"),
+        "client": stats.client,
+        "prompt_tokens": 0,
+        "completion_tokens": tokens,
+        "total_tokens": tokens,
+        "latency": round(latency, 2),
+        "tokens_per_sec": round(tokens / decode, 2) if decode > 0 else 0,
+        "audio_duration": round(audio, 2),
+        "decode_time": round(decode, 3),
+        "rtf": round(decode / audio, 3) if audio > 0 else None,
+        "segments": fields["segments"],
+        "language": fields["language"],
+    }
+    _stt_recorder.append(record)
+    _registry.set_model(stats.model)
+
+
+class _STTMiddleware:
+    """ASGI middleware giving each transcription request its own stats, recorded on success."""
+
+    _unseen_logged = False
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+            # No --port on the command line: register from the first request's socket
+            _registry.register("mlx_audio", "STT", scope["server"][1])
+        if (
+            scope["type"] != "http"
+            or scope.get("method") != "POST"
+            or not scope.get("path", "").endswith(_STT_PATHS)
+        ):
+            return await self.app(scope, receive, send)
+        stats = _STTStats()
+        stats.client = _scope_client(scope)
+        stats.trace = trace = _tracer.begin("request", path=scope.get("path"))
+        status = {}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            if trace is None or message["type"] != "http.response.body":
+                return await send(message)
+            sent = time.perf_counter()
+            try:
+                await send(message)
+            finally:
+                trace.add_span(
+                    "socket_write", sent, time.perf_counter(),
+                    bytes=len(message.get("body", b"")),
+                )
+
+        start = time.perf_counter()
+        token = _current_stt.set(stats)
+        try:
+            await self.app(scope, receive, capture_send)
+        finally:
+            _current_stt.reset(token)
+            _tracer.end(trace)
+        if status.get("code", 500) >= 400:
+            return
+        if stats.calls:
+            _record_stt_metric(stats, time.perf_counter() - start)
+        elif not _STTMiddleware._unseen_logged:
+            _STTMiddleware._unseen_logged = True
+            logging.warning(
+                f"mlx-cockpit: {scope['path']} finished without an instrumented generate() "
+                "call; this server version decodes somewhere the patch does not reach, "
+                "so transcriptions are not recorded"
+            )
+
+
+app.add_middleware(_STTMiddleware)
+
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_audio")
+
+
+# Recording never blocks the event loop; alert rules see each record on the recorder's tick.
+_stt_recorder = _MetricsRecorder(_stt_metrics_store, observers=(_alerts.observe, _clients.observe))
+
+
+def _timed_stream(chunks, stats):
+    """Pass a streaming generate() result through, timing each decode step.
+
+    Streaming models return a generator and decode as it is consumed, so the
+    time spent in generate() itself is only setup. The chunks seen are kept as
+    the request's result once the stream ends or is abandoned.
+    """
+    segments = []
+    language = None
+    first = last = None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                last = time.perf_counter()
+                first = first or start
+                stats.decode_time += last - start
+            stats.chunks += 1
+            if not isinstance(chunk, str):
+                language = getattr(chunk, "language", None) or language
+                if getattr(chunk, "is_final", True) is not False:
+                    segments.append({
+                        "start": getattr(chunk, "start_time", None),
+                        "end": getattr(chunk, "end_time", None),
+                        "tokens": list(getattr(chunk, "tokens", None) or []),
+                    })
+            yield chunk
+    finally:
+        stats.result = {"segments": segments, "language": language}
+        if stats.trace is not None and first is not None:
+            stats.trace.add_span("decode", first, last, chunks=stats.chunks)
+
+
+def _instrument_stt_model(model, name):
+    """Time model.generate() and keep its result for the current request."""
+    if model is None or getattr(model, "_cockpit_timed", False) or not hasattr(model, "generate"):
+        return
+    base = type(model)
+
+    # wraps() keeps generate()'s signature visible: servers filter kwargs by it
+    @functools.wraps(base.generate)
+    def generate(self, audio, *args, **kwargs):
+        stats = _current_stt.get()
+        if stats is None:
+            return base.generate(self, audio, *args, **kwargs)
+        duration = _audio_duration(audio)
+        start = time.perf_counter()
+        result = base.generate(self, audio, *args, **kwargs)
+        end = time.perf_counter()
+        stats.decode_time += end - start
+        if stats.trace is not None:
+            stats.trace.add_span("generate", start, end, audio_seconds=duration)
+        stats.audio_duration += duration or 0.0
+        stats.model = stats.model or self._cockpit_model_name
+        stats.calls += 1
+        if hasattr(result, "__next__"):
+            return _timed_stream(result, stats)
+        stats.result = result
+        return result
+
+    model.__class__ = type(base.__name__, (base,), {"generate": generate, "_cockpit_timed": True})
+    model._cockpit_model_name = name
+
+
+def _instrument_stt_broker():
+    """Carry request stats across the inference broker (mlx-audio 0.5+).
+
+    The broker decodes on its own worker thread, which the request's context
+    never reaches: the stats ride on the submitted payload and are restored
+    around the STT adapter's run.
+    """
+    broker = globals().get("InferenceBroker")
+    submit = getattr(broker, "submit", None)
+    if submit is not None:
+        def submit_with_stats(self, *args, **kwargs):
+            stats = _current_stt.get()
+            payload = kwargs.get("payload")
+            if stats is not None and payload is not None:
+                try:
+                    payload._cockpit_stt = stats
+                except AttributeError:
+                    pass  # slotted payload: the request goes unrecorded
+            return submit(self, *args, **kwargs)
+        broker.submit = submit_with_stats
+
+    adapter = globals().get("STTExecutionAdapter")
+    run_serial = getattr(adapter, "run_serial", None)
+    if run_serial is not None:
+        def run_serial_with_stats(self, request, *args, **kwargs):
+            token = _current_stt.set(getattr(getattr(request, "payload", None), "_cockpit_stt", None))
+            try:
+                return run_serial(self, request, *args, **kwargs)
+            finally:
+                _current_stt.reset(token)
+        adapter.run_serial = run_serial_with_stats
+
+
+def _instrument_stt_models():
+    """Wrap the server's model loaders so every loaded model is timed (called at module end)."""
+    def first_str(args):
+        return next((a for a in args if isinstance(a, str)), None)
+
+    _instrument_stt_broker()
+
+    provider = globals().get("ModelProvider")
+    method = getattr(provider, "load_model", None)
+    if method is not None:
+        def load_model(self, *args, **kwargs):
+            model = method(self, *args, **kwargs)
+            _instrument_stt_model(model, first_str(args) or kwargs.get("model_name"))
+            return model
+        provider.load_model = load_model
+
+    for name in ("load_model", "load_stt_model"):
+        loader = globals().get(name)
+        if not callable(loader):
+            continue
+
+        def instrumented(*args, _loader=loader, **kwargs):
+            model = _loader(*args, **kwargs)
+            _instrument_stt_model(model, first_str(args))
+            return model
+        globals()[name] = instrumented
+
+
+_STT_DASHBOARD_HTML = """''' + dashboard_html + '''"""
+
+
+'''
+    code = code[:idx_route] + store_snippet + code[idx_route:]
+    insertions += 1
+    print("  [2/4] Inserted _stt_metrics_store (+ shared-memory store), request middleware + tracing, alert rules, client accounting, recorder + model instrumentation")
+
+    # ---------------------------------------------------------------
+    # 4. Insert /v1/metrics and /dashboard endpoints
+    # ---------------------------------------------------------------
+    # Straight after the snippet above, i.e. before the server's first route
+    idx_route += len(store_snippet)
+
+    metrics_route = '''@app.get("/v1/metrics")
+async def metrics_endpoint():
+    """Return recent transcription metrics and summary."""
+    # Merging may wait on the shared-memory flock; keep it off the event loop
+    requests_list = await asyncio.to_thread(_stt_recorder.snapshot)
+    total = len(requests_list)
+    audio = sum(r["audio_duration"] for r in requests_list)
+    decode = sum(r["decode_time"] for r in requests_list)
+    return {
+        "requests": requests_list,
+        "summary": {
+            "total_requests": total,
+            "avg_tokens_per_sec": (
+                round(sum(r["tokens_per_sec"] for r in requests_list) / total, 2) if total else 0
+            ),
+            "total_prompt_tokens": 0,
+            "total_completion_tokens": sum(r["completion_tokens"] for r in requests_list),
+            "total_audio_seconds": round(audio, 2),
+            "total_decode_time": round(decode, 3),
+            # Aggregate RTF (decode seconds per audio second); <1 is faster than real time
+            "avg_rtf": round(decode / audio, 3) if audio > 0 else None,
+            "total_segments": sum(r["segments"] for r in requests_list),
+        },
+        "alerts": _alerts.snapshot(),
+        "clients": _clients.report(top=5, windows=("15m",)),
+    }
+
+
+@app.get("/v1/metrics/clients")
+async def clients_endpoint(top: int = 10):
+    """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+    return _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+
+
+@app.get("/v1/trace")
+async def trace_endpoint():
+    """Return sampled request traces as Chrome trace-event JSON."""
+    return _tracer.export()
+
+
+@app.get("/v1/profile")
+async def profile_endpoint(seconds: float = 10.0, hz: int = 100, format: str = "json"):
+    """Sample every thread's stack (MLX_COCKPIT_PROFILE=1); format=collapsed for flamegraphs."""
+    if not _profiler.enabled:
+        return JSONResponse(
+            {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"},
+            status_code=403,
+        )
+    # Sample from a worker thread so the event loop itself shows up in the profile
+    data = await asyncio.to_thread(_profiler.run, seconds, hz)
+    if data is None:
+        return JSONResponse({"error": "A profile is already running"}, status_code=409)
+    if format == "collapsed":
+        return PlainTextResponse(data["collapsed"])
+    return data
+
+
+@app.get("/v1/registry")
+async def registry_endpoint():
+    """Return the MLX servers registered on this host (self-registration)."""
+    return {"services": _registry.live()}
+
+
+@app.get("/dashboard", response_class=HTMLResponse)
+async def dashboard_endpoint():
+    """Serve a live HTML dashboard that polls /v1/metrics."""
+    return _STT_DASHBOARD_HTML
+
+
+'''
+    code = code[:idx_route] + metrics_route + code[idx_route:]
+    insertions += 1
+    print("  [3/4] Inserted /v1/metrics, /v1/metrics/clients, /v1/trace, /v1/profile and /dashboard endpoints")
+
+    # ---------------------------------------------------------------
+    # 5. Instrument model loading once the module is fully defined
+    # ---------------------------------------------------------------
+    tail_snippet = (
+        "# Time every STT model's generate() per request\n"
+        "_instrument_stt_models()\n"
+        "\n"
+        "# Publish this server in the service registry (see _ServiceRegistry)\n"
+        "_registry.register(\"mlx_audio\", \"STT\", _cli_port())\n"
+        "\n\n"
+    )
+    idx_main = code.find('\nif __name__ == "__main__":')
+    if idx_main == -1:
+        code = code.rstrip("\n") + "\n\n" + tail_snippet.rstrip("\n") + "\n"
+    else:
+        code = code[:idx_main + 1] + tail_snippet + code[idx_main + 1:]
+    insertions += 1
+    print("  [4/4] Inserted STT model instrumentation at module end")
+    if unhooked_broker:
+        print("  WARNING: server decodes on an InferenceBroker without an STTExecutionAdapter;")
+        print("           transcriptions will not be recorded (a warning is logged at runtime)")
+
+    # ---------------------------------------------------------------
+    # Validate
+    # ---------------------------------------------------------------
+    if insertions != 4:
+        print(f"ERROR: Expected 4 insertions, got {insertions}. Rolling back.")
+        _rollback(server_path, backup_path)
+        return False
+
+    checks = [
+        ("_stt_metrics_store", "metrics store"),
+        ("_STT_DASHBOARD_HTML", "dashboard HTML"),
+        ("app.add_middleware(_STTMiddleware)", "request middleware"),
+        ("_stt_recorder.append(record)", "metrics recording"),
+        ("_alerts.observe, _clients.observe", "alert rule evaluation and client accounting"),
+        ("/v1/metrics/clients", "client accounting route"),
+        ("_instrument_stt_models()", "model instrumentation"),
+        ("_instrument_stt_broker()", "inference broker instrumentation"),
+        ("/v1/metrics", "metrics route"),
+        ("/v1/trace", "trace route"),
+        ("/v1/profile", "profile route"),
+        ("/v1/registry", "registry route"),
+        ("/dashboard", "dashboard route"),
+        ("CORSMiddleware", "CORS middleware"),
+    ]
+    for needle, label in checks:
+        if needle not in code:
+            print(f"ERROR: Validation failed — missing {label}. Rolling back.")
+            _rollback(server_path, backup_path)
+            return False
+
+    with open(server_path, "w") as f:
+        f.write(code)
+
+    print(f"Patched successfully: {server_path}")
+    return True
+
+
+def _rollback(server_path, backup_path):
+    """Restore backup on failure."""
+    if os.path.exists(backup_path):
+        shutil.copy2(backup_path, server_path)
+        print(f"Rolled back to backup: {backup_path}")
+
+
+def main():
+    if len(sys.argv) > 1:
+        server_path = sys.argv[1]
+    else:
+        server_path = find_server_py()
+        if not server_path:
+            print("ERROR: Could not find mlx_audio/server.py. Pass the path as an argument.")
+            sys.exit(1)
+
+    if not os.path.isfile(server_path):
+        print(f"ERROR: File not found: {server_path}")
+        sys.exit(1)
+
+    print(f"Patching: {server_path}")
+    if not patch(server_path):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
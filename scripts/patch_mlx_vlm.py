@@ -32,6 +32,14 @@ def load_dashboard_html():
         return f.read()
 
 
+def load_common_runtime():
+    """Load server-patches/_cockpit_common.py, the runtime shared by every patch."""
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    common_path = os.path.join(script_dir, "..", "server-patches", "_cockpit_common.py")
+    with open(common_path, "r") as f:
+        return f.read()
+
+
 def patch(server_path):
     with open(server_path, "r") as f:
         code = f.read()
@@ -118,10 +126,10 @@ def patch(server_path):
         )
         code = code[:eol_app + 1] + cors_snippet + code[eol_app + 1:]
         insertions += 1
-        print("  [1/3] Inserted CORS middleware")
+        print("  [1/4] Inserted CORS middleware")
     else:
         insertions += 1
-        print("  [1/3] CORS middleware already present")
+        print("  [1/4] CORS middleware already present")
 
     # ---------------------------------------------------------------
     # 3. Insert metrics store + recording function after model_cache
@@ -141,28 +149,309 @@ def patch(server_path):
 
     dashboard_html = load_dashboard_html().replace('\\', '\\\\').replace('"""', '\\"\\"\\"')
 
-    store_snippet = '''
+    store_snippet = "\n\n" + load_common_runtime() + '''
+
+import asyncio
+from fastapi.responses import JSONResponse, PlainTextResponse
+
 
 # --- Metrics store (mirrors mlx_lm server format) ---
-_vlm_metrics_store: deque = deque(maxlen=200)
+# Set MLX_COCKPIT_SHM=<name> to share one store between all uvicorn workers on
+# the host; otherwise each worker only sees the requests it served itself.
+if os.environ.get("MLX_COCKPIT_SHM"):
+    _vlm_metrics_store = _SharedMetricsStore(
+        os.environ["MLX_COCKPIT_SHM"],
+        capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+    )
+else:
+    _vlm_metrics_store: deque = deque(maxlen=200)
+
+
+class _RequestMiddleware:
+    """ASGI middleware giving each POST its own vision stats (and trace, if sampled)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+            # No --port on the command line: register from the first request's socket
+            _registry.register("mlx_vlm", "Vision", scope["server"][1])
+        if scope["type"] != "http" or scope.get("method") != "POST":
+            return await self.app(scope, receive, send)
+        trace = _tracer.begin("request", path=scope.get("path"))
+        if trace is not None:
+            send = self._traced_send(send, trace)
+        vision_token = _current_vision.set(_VisionStats())
+        client_token = _current_client.set(_scope_client(scope))
+        trace_token = _current_trace.set(trace)
+        load_token = _current_load.set(_cold.generation)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_load.reset(load_token)
+            _current_trace.reset(trace_token)
+            _current_client.reset(client_token)
+            _current_vision.reset(vision_token)
+            if trace is not None:
+                trace.phase("prefill", "generate", "first_token")
+                trace.phase("decode", "first_token", "last_token")
+                _tracer.end(trace)
+
+    @staticmethod
+    def _traced_send(send, trace):
+        async def traced_send(message):
+            start = time.perf_counter()
+            try:
+                await send(message)
+            finally:
+                if message["type"] == "http.response.body":
+                    trace.add_span(
+                        "socket_write", start, time.perf_counter(),
+                        bytes=len(message.get("body", b"")),
+                    )
+        return traced_send
+
+
+app.add_middleware(_RequestMiddleware)
+
+
+_current_vision = contextvars.ContextVar("mlx_cockpit_vision", default=None)
+_current_client = contextvars.ContextVar("mlx_cockpit_client", default=None)
+# Load generation (see _ColdStart) when the request arrived; no default, so
+# requests outside the middleware count as arriving after the latest load
+_current_load = contextvars.ContextVar("mlx_cockpit_load")
+
+
+class _VisionStats:
+    """Images and vision-pipeline stage timings for one request."""
+
+    __slots__ = ("image_count", "image_bytes", "image_pixels", "image_dims", "stages")
+
+    MAX_DIMS = 8
+
+    def __init__(self):
+        self.image_count = 0
+        self.image_bytes = 0
+        self.image_pixels = 0
+        self.image_dims = []
+        self.stages = {}
+
+    def add_image(self, image, nbytes=None):
+        self.image_count += 1
+        if nbytes:
+            self.image_bytes += nbytes
+        size = getattr(image, "size", None)
+        if isinstance(size, tuple) and len(size) == 2:
+            self.image_pixels += size[0] * size[1]
+            if len(self.image_dims) < self.MAX_DIMS:
+                self.image_dims.append(f"{size[0]}x{size[1]}")
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def fields(self):
+        if not self.image_count and not self.stages:
+            return {}
+        return {
+            "image_count": self.image_count,
+            "image_bytes": self.image_bytes,
+            "image_pixels": self.image_pixels,
+            "image_dims": self.image_dims,
+            "image_load_time": round(self.stages.get("image_load", 0.0), 3),
+            "preprocess_time": round(self.stages.get("preprocess", 0.0), 3),
+            "vision_encode_time": round(self.stages.get("vision_encode", 0.0), 3),
+        }
+
+
+def _traced_tokens(trace, chunks):
+    """Pass stream_generate() output through, marking the request's first and last token."""
+    trace.mark("generate")
+    for chunk in chunks:
+        trace.token()
+        yield chunk
+
+
+@contextmanager
+def _vision_stage(name):
+    """Time a vision stage into the current request (and its trace, if sampled)."""
+    stats = _current_vision.get()
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if stats is not None:
+            stats.add_time(name, end - start)
+        if trace is not None:
+            trace.add_span(name, start, end)
+
+
+def _vision_images(images):
+    """Manual hook: count already-loaded images (PIL) for the current request."""
+    stats = _current_vision.get()
+    if stats is not None:
+        for image in images or []:
+            stats.add_image(image)
+
+
+def _image_source_bytes(source):
+    """Encoded size of an image argument: raw bytes, a local path or a base64 data URI."""
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, str):
+        if source.startswith("data:"):
+            return len(source.partition(",")[2]) * 3 // 4
+        if os.path.isfile(source):
+            return os.path.getsize(source)
+    read = getattr(source, "getbuffer", None)
+    return read().nbytes if read is not None else None
+
+
+def _replace_function(original, replacement):
+    """Rebind every mlx_vlm module global (and ours) that still points at `original`."""
+    modules = [m for name, m in list(sys.modules.items()) if name.startswith("mlx_vlm")]
+    for module in modules + [sys.modules[__name__]]:
+        for attr, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attr, replacement)
+
+
+def _instrument_vision_tower(model):
+    """Time the vision encoder by evaluating its output eagerly (MLX is lazy)."""
+    tower = getattr(model, "vision_tower", None) or getattr(model, "vision_model", None)
+    if tower is None or getattr(tower, "_cockpit_timed", False):
+        return
+    base = type(tower)
+
+    def __call__(self, *args, **kwargs):
+        with _vision_stage("vision_encode"):
+            out = base.__call__(self, *args, **kwargs)
+            import mlx.core as mx
+            mx.eval(out)
+        return out
+
+    tower.__class__ = type(base.__name__, (base,), {"__call__": __call__, "_cockpit_timed": True})
+
+
+def _instrument_vision_pipeline():
+    """Wrap image loading, preprocessing, model loading and generation (called at module end).
+
+    Every wrapper times into the request's _VisionStats and, for sampled
+    requests, its trace, so the endpoints need no manual _trace_stage() hooks.
+    """
+    try:
+        from mlx_vlm import utils as vlm_utils
+    except ImportError:
+        return
+    load_image = getattr(vlm_utils, "load_image", None)
+    if load_image is not None:
+        def timed_load_image(source, *args, **kwargs):
+            with _vision_stage("image_load"):
+                image = load_image(source, *args, **kwargs)
+            stats = _current_vision.get()
+            if stats is not None:
+                stats.add_image(image, _image_source_bytes(source))
+            return image
+        _replace_function(load_image, timed_load_image)
+
+    prepare_inputs = getattr(vlm_utils, "prepare_inputs", None)
+    if prepare_inputs is not None:
+        def timed_prepare_inputs(*args, **kwargs):
+            # prepare_inputs() loads images itself; report preprocessing net of that
+            stats = _current_vision.get()
+            loaded = stats.stages.get("image_load", 0.0) if stats is not None else 0.0
+            trace = _current_trace.get()
+            start = time.perf_counter()
+            try:
+                return prepare_inputs(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                if stats is not None:
+                    stats.add_time("preprocess", end - start - (stats.stages.get("image_load", 0.0) - loaded))
+                if trace is not None:
+                    trace.add_span("preprocess", start, end)
+        _replace_function(prepare_inputs, timed_prepare_inputs)
+
+    # Loads are timed at the outermost loader: get_cached_model() only loads
+    # when the requested model differs from the cached one
+    timed = "get_cached_model" if "get_cached_model" in globals() else "load_model_resources"
+    for name in ("get_cached_model", "load_model_resources"):
+        loader = globals().get(name)
+        if loader is None:
+            continue
+
+        def instrumented(*args, _loader=loader, _timed=(name == timed), **kwargs):
+            before = (globals().get("model_cache") or {}).get("model")
+            start = time.perf_counter()
+            with _trace_stage("load_model") if _timed else nullcontext():
+                result = _loader(*args, **kwargs)
+            model = result[0] if isinstance(result, tuple) else result
+            if _timed and model is not None and model is not before:
+                path = args[0] if args else kwargs.get("model_path")
+                _cold.loaded(path or "unknown", time.perf_counter() - start, _weight_bytes(model))
+            _instrument_vision_tower(model)
+            return result
+        globals()[name] = instrumented
+
+    # The endpoints call these through this module's globals; mlx_vlm's own
+    # generate() -> stream_generate() call is left alone so nothing is counted twice
+    chat_template = globals().get("apply_chat_template")
+    if callable(chat_template):
+        def traced_chat_template(*args, **kwargs):
+            with _trace_stage("chat_template"):
+                return chat_template(*args, **kwargs)
+        globals()["apply_chat_template"] = traced_chat_template
+
+    stream = globals().get("stream_generate")
+    if callable(stream):
+        def traced_stream_generate(*args, **kwargs):
+            trace = _current_trace.get()
+            chunks = stream(*args, **kwargs)
+            return _traced_tokens(trace, chunks) if trace is not None else chunks
+        globals()["stream_generate"] = traced_stream_generate
+
+    generate = globals().get("generate")
+    if callable(generate):
+        def traced_generate(*args, **kwargs):
+            with _trace_stage("generate"):
+                return generate(*args, **kwargs)
+        globals()["generate"] = traced_generate
+
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_vlm")
+
+
+# Recording never blocks the event loop; alert rules see each record on the recorder's tick.
+_vlm_recorder = _MetricsRecorder(_vlm_metrics_store, observers=(_alerts.observe, _clients.observe))
+
 
 _VLM_DASHBOARD_HTML = """''' + dashboard_html + '''"""
 
 
 def _record_vlm_metric(model, prompt_tokens, completion_tokens, latency, tokens_per_sec):
-    _vlm_metrics_store.append({
+    record = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "model": (model.split("/")[-1] if model else "unknown"),
+        "client": _current_client.get(),
         "prompt_tokens": int(prompt_tokens or 0),
         "completion_tokens": int(completion_tokens or 0),
         "total_tokens": int((prompt_tokens or 0) + (completion_tokens or 0)),
         "latency": round(latency, 2),
         "tokens_per_sec": round(tokens_per_sec or 0, 2),
-    })
+    }
+    vision = _current_vision.get()
+    if vision is not None:
+        record.update(vision.fields())
+    record.update(_cold.claim(_current_load.get(_cold.generation)))
+    _vlm_recorder.append(record)
+    _registry.set_model(record["model"])
 '''
     code = code[:eol_cache + 1] + store_snippet + code[eol_cache + 1:]
     insertions += 1
-    print("  [2/3] Inserted _vlm_metrics_store + _record_vlm_metric()")
+    print("  [2/4] Inserted _vlm_metrics_store (+ shared-memory store), tracer, profiler, vision stats, cold-start tracker, alert rules, client accounting, recorder + _record_vlm_metric()")
 
     # ---------------------------------------------------------------
     # 4. Insert /v1/metrics endpoint
@@ -188,7 +477,8 @@ def _record_vlm_metric(model, prompt_tokens, completion_tokens, latency, tokens_
 @app.get("/v1/metrics")
 async def metrics_endpoint():
     """Return recent request metrics and summary."""
-    requests_list = list(_vlm_metrics_store)
+    # Merging may wait on the shared-memory flock; keep it off the event loop
+    requests_list = await asyncio.to_thread(_vlm_recorder.snapshot)
     total = len(requests_list)
     if total > 0:
         avg_tps = sum(r["tokens_per_sec"] for r in requests_list) / total
@@ -198,6 +488,11 @@ async def metrics_endpoint():
         avg_tps = 0
         total_prompt = 0
         total_completion = 0
+    vision = [r for r in requests_list if r.get("image_count")]
+
+    def vision_avg(key):
+        return round(sum(r.get(key, 0) for r in vision) / len(vision), 3) if vision else 0
+
     return {
         "requests": requests_list,
         "summary": {
@@ -205,10 +500,54 @@ async def metrics_endpoint():
             "avg_tokens_per_sec": round(avg_tps, 2),
             "total_prompt_tokens": total_prompt,
             "total_completion_tokens": total_completion,
+            "image_requests": len(vision),
+            "total_images": sum(r["image_count"] for r in vision),
+            "avg_image_pixels": int(vision_avg("image_pixels")),
+            "avg_image_load_time": vision_avg("image_load_time"),
+            "avg_preprocess_time": vision_avg("preprocess_time"),
+            "avg_vision_encode_time": vision_avg("vision_encode_time"),
+            "cold_start": _cold.summary(requests_list),
         },
+        "alerts": _alerts.snapshot(),
+        "clients": _clients.report(top=5, windows=("15m",)),
     }
 
 
+@app.get("/v1/metrics/clients")
+async def clients_endpoint(top: int = 10):
+    """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+    return _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+
+
+@app.get("/v1/trace")
+async def trace_endpoint():
+    """Return sampled request traces as Chrome trace-event JSON."""
+    return _tracer.export()
+
+
+@app.get("/v1/profile")
+async def profile_endpoint(seconds: float = 10.0, hz: int = 100, format: str = "json"):
+    """Sample every thread's stack (MLX_COCKPIT_PROFILE=1); format=collapsed for flamegraphs."""
+    if not _profiler.enabled:
+        return JSONResponse(
+            {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"},
+            status_code=403,
+        )
+    # Sample from a worker thread so the event loop itself shows up in the profile
+    data = await asyncio.to_thread(_profiler.run, seconds, hz)
+    if data is None:
+        return JSONResponse({"error": "A profile is already running"}, status_code=409)
+    if format == "collapsed":
+        return PlainTextResponse(data["collapsed"])
+    return data
+
+
+@app.get("/v1/registry")
+async def registry_endpoint():
+    """Return the MLX servers registered on this host (self-registration)."""
+    return {"services": _registry.live()}
+
+
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_endpoint():
     """Serve a live HTML dashboard that polls /v1/metrics."""
@@ -218,13 +557,34 @@ async def dashboard_endpoint():
 '''
     code = code[:idx_route] + metrics_route + code[idx_route:]
     insertions += 1
-    print("  [3/3] Inserted /v1/metrics and /dashboard endpoints")
+    print("  [3/4] Inserted /v1/metrics, /v1/metrics/clients, /v1/trace, /v1/profile and /dashboard endpoints")
+
+    # ---------------------------------------------------------------
+    # 5. Instrument the vision pipeline once the module is fully defined
+    # ---------------------------------------------------------------
+    # Must run after the model loading helpers are defined, so it goes just
+    # before the __main__ guard (or at the very end of the file).
+    tail_snippet = (
+        "# Time image loading, preprocessing and vision encoding per request\n"
+        "_instrument_vision_pipeline()\n"
+        "\n"
+        "# Publish this server in the service registry (see _ServiceRegistry)\n"
+        "_registry.register(\"mlx_vlm\", \"Vision\", _cli_port())\n"
+        "\n\n"
+    )
+    idx_main = code.find('\nif __name__ == "__main__":')
+    if idx_main == -1:
+        code = code.rstrip("\n") + "\n\n" + tail_snippet.rstrip("\n") + "\n"
+    else:
+        code = code[:idx_main + 1] + tail_snippet + code[idx_main + 1:]
+    insertions += 1
+    print("  [4/4] Inserted vision pipeline instrumentation at module end")
 
     # ---------------------------------------------------------------
     # Validate
     # ---------------------------------------------------------------
-    if insertions != 3:
-        print(f"ERROR: Expected 3 insertions, got {insertions}. Rolling back.")
+    if insertions != 4:
+        print(f"ERROR: Expected 4 insertions, got {insertions}. Rolling back.")
         _rollback(server_path, backup_path)
         return False
 
@@ -232,7 +592,15 @@ async def dashboard_endpoint():
         ("_vlm_metrics_store", "metrics store"),
         ("_VLM_DASHBOARD_HTML", "dashboard HTML"),
         ("_record_vlm_metric", "recording function"),
+        ("_vlm_recorder.append(record)", "metrics recording"),
+        ("_alerts.observe, _clients.observe", "alert rule evaluation and client accounting"),
+        ("/v1/metrics/clients", "client accounting route"),
+        ("_instrument_vision_pipeline()", "vision pipeline instrumentation"),
+        ("_cold.claim(_current_load.get(", "cold request flag"),
         ("/v1/metrics", "metrics route"),
+        ("/v1/trace", "trace route"),
+        ("/v1/profile", "profile route"),
+        ("/v1/registry", "registry route"),
         ("/dashboard", "dashboard route"),
         ("CORSMiddleware", "CORS middleware"),
     ]
@@ -41,6 +41,18 @@ elif [ -n "$MLX_VLM_SERVER" ]; then
   echo -e "${YELLOW}No backup found for mlx_vlm — skipping.${NC}"
 fi
 
+# --- Restore mlx_audio server.py ---
+MLX_AUDIO_SERVER=$(python3 -c "import mlx_audio; import os; print(os.path.join(os.path.dirname(mlx_audio.__file__), 'server.py'))" 2>/dev/null || echo "")
+if [ -n "$MLX_AUDIO_SERVER" ] && [ -f "${MLX_AUDIO_SERVER}.bak" ]; then
+  echo -e "${BOLD}Restoring mlx_audio server...${NC}"
+  cp "${MLX_AUDIO_SERVER}.bak" "$MLX_AUDIO_SERVER"
+  rm "${MLX_AUDIO_SERVER}.bak"
+  echo -e "${GREEN}Restored: $MLX_AUDIO_SERVER${NC}"
+  restored=$((restored + 1))
+elif [ -n "$MLX_AUDIO_SERVER" ]; then
+  echo -e "${YELLOW}No backup found for mlx_audio — skipping.${NC}"
+fi
+
 # --- Remove scan script ---
 if [ -d "$HOME/.mlx-cockpit" ]; then
   echo -e "${BOLD}Removing ~/.mlx-cockpit/...${NC}"
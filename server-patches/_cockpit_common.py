@@ -0,0 +1,995 @@
+# ---------------------------------------------------------------------------
+# MLX Cockpit shared runtime  (server-patches/_cockpit_common.py)
+# ---------------------------------------------------------------------------
+# Everything the mlx_lm, mlx_vlm and mlx_audio patches have in common: the
+# shared-memory metrics store, request tracing, the sampling profiler, the
+# service registry, alert rules, per-client accounting, the contention-free
+# recorder and cold-start tracking.  Each patch script reads this file and
+# inserts it into the server it patches, ahead of its server-specific code,
+# which then creates the per-server instances (metrics store, `_alerts`,
+# recorder).  Keep it standard-library only and free of server-specific names.
+
+import atexit
+import collections
+import contextvars
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from multiprocessing import shared_memory
+
+
+class _SharedMetricsStore:
+    """Fixed-size ring of JSON records in shared memory, shared by every worker.
+
+    The write index lives in the segment header and is only advanced under an
+    flock on a sidecar lock file, so writers in different processes never claim
+    the same slot.  Readers take no lock: each slot carries a sequence number
+    (odd while a write is in progress) that is checked before and after copying
+    the payload, and torn or overwritten slots are simply skipped.
+    """
+
+    _MAGIC = b"MLXCKPT1"
+    _HEADER = struct.Struct("<8sQQQ")  # magic, write index, capacity, slot size
+    _SLOT = struct.Struct("<QI")  # sequence, payload length
+
+    def __init__(self, name, capacity=200, slot_size=4096):
+        self._thread_lock = threading.Lock()
+        lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self._HEADER.size + capacity * slot_size
+        with self._locked():
+            try:
+                self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=name)
+            # The segment must outlive whichever worker created it, so keep
+            # the resource tracker from unlinking it when that worker exits.
+            try:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+            except Exception:
+                pass
+            buf = self._shm.buf
+            magic, _, cap, slot = self._HEADER.unpack_from(buf, 0)
+            if magic != self._MAGIC:
+                self._HEADER.pack_into(buf, 0, self._MAGIC, 0, capacity, slot_size)
+                cap, slot = capacity, slot_size
+        self.capacity = cap
+        self.slot_size = slot
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _write_index(self):
+        return self._HEADER.unpack_from(self._shm.buf, 0)[1]
+
+    def append(self, record):
+        payload = json.dumps(record).encode()
+        if len(payload) > self.slot_size - self._SLOT.size:
+            logging.warning(f"Metrics record too large for shared slot ({len(payload)} bytes), dropped")
+            return
+        buf = self._shm.buf
+        with self._locked():
+            idx = self._write_index()
+            off = self._HEADER.size + (idx % self.capacity) * self.slot_size
+            self._SLOT.pack_into(buf, off, 2 * idx + 1, 0)
+            start = off + self._SLOT.size
+            buf[start:start + len(payload)] = payload
+            self._SLOT.pack_into(buf, off, 2 * idx + 2, len(payload))
+            struct.pack_into("<Q", buf, 8, idx + 1)
+
+    def __iter__(self):
+        buf = self._shm.buf
+        end = self._write_index()
+        records = []
+        for idx in range(max(0, end - self.capacity), end):
+            off = self._HEADER.size + (idx % self.capacity) * self.slot_size
+            seq, length = self._SLOT.unpack_from(buf, off)
+            if seq != 2 * idx + 2:
+                continue
+            start = off + self._SLOT.size
+            payload = bytes(buf[start:start + length])
+            if self._SLOT.unpack_from(buf, off)[0] != seq:
+                continue
+            try:
+                records.append(json.loads(payload))
+            except ValueError:
+                continue
+        return iter(records)
+
+    def __len__(self):
+        return min(self._write_index(), self.capacity)
+
+
+class _Trace:
+    """Stage timings for one sampled request (perf_counter seconds)."""
+
+    __slots__ = ("name", "args", "tid", "start", "marks", "spans")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        self.marks = {}
+        self.spans = []
+
+    def mark(self, name):
+        """Record the first time `name` happened."""
+        self.marks.setdefault(name, time.perf_counter())
+
+    def token(self):
+        """Per-token hook: first call ends prefill, every call extends decode."""
+        now = time.perf_counter()
+        self.marks.setdefault("first_token", now)
+        self.marks["last_token"] = now
+
+    def add_span(self, name, start, end, **args):
+        self.spans.append((name, start, end, args))
+
+    @contextmanager
+    def stage(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.perf_counter(), args))
+
+    def phase(self, name, start_mark, end_mark):
+        """Turn two marks into a span, if both were reached."""
+        start = self.start if start_mark == "start" else self.marks.get(start_mark)
+        end = self.marks.get(end_mark)
+        if start is not None and end is not None and end >= start:
+            self.spans.append((name, start, end, {}))
+
+
+class _Tracer:
+    """Sampled request tracing, exported as Chrome trace-event JSON.
+
+    Unsampled requests get `None` from begin() and every hook is guarded by a
+    `is not None` check, so with MLX_COCKPIT_TRACE_SAMPLE=0 (the default) the
+    cost is one comparison per request.  Finished traces are flattened into a
+    bounded deque of events and served from /v1/trace (open in Perfetto or
+    chrome://tracing).
+    """
+
+    def __init__(self, sample_rate=0.0, max_events=20000):
+        self.sample_rate = sample_rate
+        self._events = deque(maxlen=max_events)
+        self._pid = os.getpid()
+
+    def begin(self, name, **args):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return _Trace(name, args)
+
+    def end(self, trace):
+        if trace is None:
+            return
+        end = time.perf_counter()
+        events = [self._event(trace.name, "request", trace.start, end, trace.tid, trace.args)]
+        for name, start, stop, args in trace.spans:
+            events.append(self._event(name, "stage", start, stop, trace.tid, args))
+        self._events.extend(events)
+
+    def _event(self, name, cat, start, end, tid, args):
+        return {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round(start * 1e6, 1),
+            "dur": round((end - start) * 1e6, 1),
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        }
+
+    def export(self):
+        return {
+            "traceEvents": list(self._events),
+            "displayTimeUnit": "ms",
+            "otherData": {"sample_rate": self.sample_rate},
+        }
+
+
+_tracer = _Tracer(
+    sample_rate=float(os.environ.get("MLX_COCKPIT_TRACE_SAMPLE", "0")),
+    max_events=int(os.environ.get("MLX_COCKPIT_TRACE_EVENTS", "20000")),
+)
+
+
+_current_trace = contextvars.ContextVar("mlx_cockpit_trace", default=None)
+
+
+def _trace_stage(name, **args):
+    """`with _trace_stage("chat_template"):` -- a no-op unless the request is sampled."""
+    trace = _current_trace.get()
+    return trace.stage(name, **args) if trace is not None else nullcontext()
+
+
+def _trace_mark(name):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark(name)
+
+
+def _trace_token():
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.token()
+
+
+class _SamplingProfiler:
+    """On-demand wall-clock sampler over every thread's Python stack.
+
+    A background thread reads sys._current_frames() at `hz` for `seconds` and
+    counts stacks keyed by code objects; labels are only formatted once at the
+    end, so a 30s run at 100 Hz costs a few milliseconds of GIL time per second.
+    Only one profile runs at a time.
+    """
+
+    MAX_SECONDS = 120.0
+    MAX_HZ = 1000
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._busy = threading.Lock()
+
+    def run(self, seconds=10.0, hz=100):
+        """Sample for `seconds`; returns None if a profile is already running."""
+        seconds = min(max(float(seconds), 0.1), self.MAX_SECONDS)
+        hz = min(max(int(hz), 1), self.MAX_HZ)
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            result = {}
+            # The calling thread just waits on join(); leave it out of the profile
+            sampler = threading.Thread(
+                target=self._sample, args=(seconds, hz, threading.get_ident(), result),
+                name="mlx-cockpit-profiler", daemon=True,
+            )
+            sampler.start()
+            sampler.join()
+            return self._summarize(seconds, hz, result)
+        finally:
+            self._busy.release()
+
+    def _sample(self, seconds, hz, caller, result):
+        skip = {threading.get_ident(), caller}
+        names = {}
+        counts = {}
+        interval = 1.0 / hz
+        samples = 0
+        next_tick = time.perf_counter()
+        deadline = next_tick + seconds
+        while next_tick < deadline:
+            for tid, frame in sys._current_frames().items():
+                if tid in skip:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                if tid not in names:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                key = (names.get(tid, str(tid)), tuple(reversed(codes)))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+            next_tick += interval
+            delay = next_tick - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_tick = time.perf_counter()
+        result["samples"] = samples
+        result["counts"] = counts
+
+    @staticmethod
+    def _label(code):
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _summarize(self, seconds, hz, result, top=30):
+        labels = {}
+        collapsed = []
+        self_counts = {}
+        total_counts = {}
+        stack_samples = 0
+        for (thread, codes), count in result["counts"].items():
+            frames = []
+            for code in codes:
+                if code not in labels:
+                    labels[code] = self._label(code)
+                frames.append(labels[code])
+            collapsed.append((";".join([thread] + frames), count))
+            stack_samples += count
+            if frames:
+                self_counts[frames[-1]] = self_counts.get(frames[-1], 0) + count
+            for label in set(frames):
+                total_counts[label] = total_counts.get(label, 0) + count
+        collapsed.sort(key=lambda item: -item[1])
+        ranked = sorted(self_counts, key=lambda label: -self_counts[label])[:top]
+        return {
+            "seconds": seconds,
+            "hz": hz,
+            "samples": result["samples"],
+            "stack_samples": stack_samples,
+            "collapsed": "\n".join(f"{stack} {count}" for stack, count in collapsed),
+            "top": [
+                {
+                    "function": label,
+                    "self": self_counts[label],
+                    "total": total_counts[label],
+                    "self_pct": round(100 * self_counts[label] / stack_samples, 2),
+                    "total_pct": round(100 * total_counts[label] / stack_samples, 2),
+                }
+                for label in ranked
+            ],
+        }
+
+
+# Off unless MLX_COCKPIT_PROFILE=1: /v1/profile lets anyone who can reach the
+# port see code paths and stall the answering thread for up to MAX_SECONDS.
+_profiler = _SamplingProfiler(enabled=os.environ.get("MLX_COCKPIT_PROFILE") == "1")
+
+
+class _ServiceRegistry:
+    """Self-registration under ~/.mlx-cockpit/registry so discovery needs no port scan.
+
+    Each server process writes <port>-<pid>.json (atomically, via rename) once
+    it knows its port, rewrites it every HEARTBEAT seconds and removes it at
+    exit.  Readers drop entries whose process is gone or whose heartbeat is
+    older than STALE seconds, deleting the file as they go.
+    """
+
+    HEARTBEAT = 10.0
+    STALE = 45.0
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entry = None
+        self._path = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def register(self, server, kind, port, model=None):
+        """Publish this process (once); later calls only update the model."""
+        with self._lock:
+            if self.entry is not None or not self.directory or not port:
+                return
+            now = time.time()
+            self.entry = {
+                "port": int(port),
+                "pid": os.getpid(),
+                "server": server,
+                "type": kind,
+                "model": model,
+                "started": now,
+                "heartbeat": now,
+            }
+            self._path = os.path.join(self.directory, f"{int(port)}-{os.getpid()}.json")
+        self._write()
+        atexit.register(self.unregister)
+        threading.Thread(target=self._beat, name="mlx-cockpit-registry", daemon=True).start()
+
+    def set_model(self, model):
+        if self.entry is not None and model:
+            self.entry["model"] = model
+
+    def unregister(self):
+        self._closed = True
+        try:
+            os.remove(self._path)
+        except (OSError, TypeError):
+            pass
+
+    def _write(self):
+        if self._closed:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self.entry["heartbeat"] = time.time()
+            tmp = f"{self._path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.entry, f)
+            os.replace(tmp, self._path)
+        except OSError as e:
+            logging.debug(f"Service registry write failed: {e}")
+
+    def _beat(self):
+        while not self._closed:
+            time.sleep(self.HEARTBEAT)
+            self._write()
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, TypeError, ValueError):
+            return pid is not None
+        return True
+
+    def live(self):
+        """Live servers on this host, one entry per port; stale files are removed."""
+        try:
+            names = os.listdir(self.directory)
+        except (OSError, TypeError):
+            return []
+        now = time.time()
+        by_port = {}
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path) as f:
+                    entry = json.load(f)
+                port = int(entry["port"])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if now - entry.get("heartbeat", 0) > self.STALE or not self._alive(entry.get("pid")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            current = by_port.get(port)
+            if current is None or entry["heartbeat"] > current["heartbeat"]:
+                by_port[port] = entry
+        return [by_port[port] for port in sorted(by_port)]
+
+
+# MLX_COCKPIT_REGISTRY=<dir> moves the registry; MLX_COCKPIT_REGISTRY=off disables it.
+_registry = _ServiceRegistry(
+    None if os.environ.get("MLX_COCKPIT_REGISTRY") == "off"
+    else os.path.expanduser(os.environ.get("MLX_COCKPIT_REGISTRY") or "~/.mlx-cockpit/registry")
+)
+
+
+def _cli_port():
+    """--port from the command line (uvicorn workers inherit it), or None."""
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        value = arg.partition("=")[2] if arg.startswith("--port=") else None
+        if arg == "--port" and i + 1 < len(args):
+            value = args[i + 1]
+        if value is not None:
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+class _AlertEngine:
+    """Threshold and rate-of-change alert rules, evaluated on every new record.
+
+    A rule watches one numeric record field per model over the last `window`
+    records, reduced by `stat` (mean, p50, p95, min or max).  With `baseline`
+    set, the value compared is the ratio to the same stat over the `baseline`
+    records before the window (frozen while the alert fires), so "tok/s fell
+    to half" needs no absolute number.  An alert fires after `for`
+    consecutive breaches of `threshold` and resolves only once the value is
+    back past `clear` (hysteresis).  Only transitions are delivered, to
+    MLX_COCKPIT_ALERT_WEBHOOK (POST) and/or MLX_COCKPIT_ALERT_COMMAND (event
+    JSON on stdin), from a background thread.
+    """
+
+    DEFAULT_RULES = [
+        {"name": "throughput_drop", "metric": "tokens_per_sec", "stat": "mean", "window": 10,
+         "baseline": 100, "op": "<", "threshold": 0.5, "clear": 0.7, "for": 3},
+        {"name": "latency_spike", "metric": "latency", "stat": "p95", "window": 20,
+         "baseline": 200, "op": ">", "threshold": 3.0, "clear": 2.0, "for": 3},
+        {"name": "slower_than_realtime", "metric": "rtf", "stat": "mean", "window": 5,
+         "op": ">", "threshold": 1.0, "clear": 0.8, "for": 2},
+    ]
+    HISTORY = 50
+
+    def __init__(self, server, rules, webhook=None, command=None):
+        self.server = server
+        self.rules = [self._rule(r) for r in rules]
+        self.webhook = webhook
+        self.command = shlex.split(command) if command else None
+        self._series = {}   # (rule name, model) -> (window deque, baseline deque)
+        self._state = {}    # (rule name, model) -> alert state dict
+        self._events = collections.deque(maxlen=self.HISTORY)
+        self._outbox = queue.Queue(maxsize=1000)
+        self._lock = threading.Lock()
+        if self.webhook or self.command:
+            threading.Thread(target=self._send_loop, name="mlx-cockpit-alerts", daemon=True).start()
+
+    @classmethod
+    def from_env(cls, server):
+        spec = os.environ.get("MLX_COCKPIT_ALERTS")
+        rules = cls.DEFAULT_RULES
+        if spec == "off":
+            rules = []
+        elif spec:
+            try:
+                with open(os.path.expanduser(spec)) as f:
+                    rules = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.warning(f"MLX_COCKPIT_ALERTS: cannot load {spec} ({e}); using default rules")
+        return cls(
+            server,
+            rules,
+            webhook=os.environ.get("MLX_COCKPIT_ALERT_WEBHOOK"),
+            command=os.environ.get("MLX_COCKPIT_ALERT_COMMAND"),
+        )
+
+    @staticmethod
+    def _rule(spec):
+        rule = {"stat": "mean", "window": 10, "baseline": 0, "op": ">", "for": 1}
+        rule.update(spec)
+        rule.setdefault("name", f"{rule['metric']}_{rule['stat']}")
+        rule.setdefault("clear", rule["threshold"])
+        return rule
+
+    @staticmethod
+    def _reduce(values, stat):
+        if stat == "mean":
+            return sum(values) / len(values)
+        if stat == "min":
+            return min(values)
+        if stat == "max":
+            return max(values)
+        ordered = sorted(values)
+        q = float(stat.lstrip("p")) / 100
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    def observe(self, record):
+        """Feed one request record to every rule watching one of its fields."""
+        if record.get("cold"):
+            # Requests right after a model load are expected to be slow
+            return
+        model = record.get("model") or "unknown"
+        events = []
+        with self._lock:
+            for rule in self.rules:
+                x = record.get(rule["metric"])
+                if not isinstance(x, (int, float)) or isinstance(x, bool):
+                    continue
+                event = self._update(rule, model, float(x))
+                if event is not None:
+                    events.append(event)
+            self._events.extend(events)
+        for event in events:
+            logging.warning(
+                f"Alert {event['status']}: {event['rule']} on {model} "
+                f"({event['metric']} {event['stat']} = {event['value']})"
+            )
+            self._deliver(event)
+
+    def _update(self, rule, model, x):
+        key = (rule["name"], model)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = (
+                collections.deque(maxlen=int(rule["window"])),
+                collections.deque(maxlen=int(rule["baseline"]) or 1),
+            )
+        window, baseline = series
+        state = self._state.setdefault(key, {"firing": False, "streak": 0})
+        if len(window) == window.maxlen and not state["firing"]:
+            baseline.append(window[0])
+        window.append(x)
+        if len(window) < window.maxlen:
+            return None
+
+        value = self._reduce(window, rule["stat"])
+        reference = None
+        if rule["baseline"]:
+            if len(baseline) < window.maxlen:
+                return None
+            reference = self._reduce(baseline, rule["stat"])
+            if reference <= 0:
+                return None
+            compared = value / reference
+        else:
+            compared = value
+        below = rule["op"] == "<"
+        if state["firing"]:
+            # Resolve only once past the clear level, not merely back under threshold
+            ok = compared > rule["clear"] if below else compared < rule["clear"]
+        else:
+            ok = not (compared < rule["threshold"] if below else compared > rule["threshold"])
+        state["value"] = round(compared, 3)
+        # Count consecutive evaluations that point to the other state
+        state["streak"] = 0 if ok != state["firing"] else state["streak"] + 1
+        if state["streak"] < int(rule["for"]):
+            return None
+
+        state["firing"] = not state["firing"]
+        state["streak"] = 0
+        state["since"] = time.time()
+        return {
+            "status": "firing" if state["firing"] else "resolved",
+            "rule": rule["name"],
+            "server": self.server,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "model": model,
+            "metric": rule["metric"],
+            "stat": rule["stat"],
+            "value": round(compared, 3),
+            "op": rule["op"],
+            "threshold": rule["threshold"],
+            "clear": rule["clear"],
+            "baseline": round(reference, 3) if reference is not None else None,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+    def _deliver(self, event):
+        if not (self.webhook or self.command):
+            return
+        try:
+            self._outbox.put_nowait(event)
+        except queue.Full:
+            logging.warning(f"Alert delivery queue full; dropped {event['rule']} {event['status']}")
+
+    def _send_loop(self):
+        while True:
+            event = self._outbox.get()
+            body = json.dumps(event).encode()
+            if self.webhook:
+                try:
+                    request = urllib.request.Request(
+                        self.webhook, data=body, headers={"Content-Type": "application/json"}
+                    )
+                    urllib.request.urlopen(request, timeout=5).close()
+                except Exception as e:
+                    logging.warning(f"Alert webhook {self.webhook} failed: {e}")
+            if self.command:
+                try:
+                    subprocess.run(self.command, input=body, timeout=30, check=False)
+                except Exception as e:
+                    logging.warning(f"Alert command {self.command[0]} failed: {e}")
+
+    def snapshot(self):
+        """Alert state for /v1/metrics: what is firing now plus recent transitions."""
+        with self._lock:
+            rules = {r["name"]: r for r in self.rules}
+            firing = []
+            for (name, model), state in self._state.items():
+                if state["firing"]:
+                    rule = rules[name]
+                    firing.append({
+                        "rule": name,
+                        "model": model,
+                        "metric": rule["metric"],
+                        "stat": rule["stat"],
+                        "value": state["value"],
+                        "op": rule["op"],
+                        "threshold": rule["threshold"],
+                        "since": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(state["since"])),
+                    })
+            return {"rules": len(self.rules), "firing": firing, "events": list(self._events)}
+
+
+# MLX_COCKPIT_CLIENT_HEADER=<header> names a header (e.g. X-Tenant) that identifies the client.
+_CLIENT_HEADER = os.environ.get("MLX_COCKPIT_CLIENT_HEADER")
+
+
+def _client_identity(header, remote):
+    """Who sent a request: the tenant header, else a hash of the API key, else the remote address.
+
+    `header(name)` looks a request header up case-insensitively.
+    """
+    if _CLIENT_HEADER:
+        tenant = (header(_CLIENT_HEADER) or "").strip()
+        if tenant:
+            return "tenant:" + tenant[:64]
+    key = (header("Authorization") or "").strip()
+    if key[:7].lower() == "bearer ":
+        key = key[7:].strip()
+    key = key or (header("X-API-Key") or "").strip()
+    if key:
+        # Never keep the key itself; a short hash still tells clients apart
+        return "key:" + hashlib.sha256(key.encode()).hexdigest()[:12]
+    return "addr:" + (remote or "unknown")
+
+
+class _SpaceSaving:
+    """Weighted top-k counts in fixed memory (Metwally et al.'s Space-Saving).
+
+    Each tracked key holds [count, error], and its true total lies within
+    [count - error, count].  A new key evicts the smallest counter and
+    inherits its count as error, so any key holding more than 1/capacity of
+    the total weight is always tracked.
+    """
+
+    __slots__ = ("capacity", "counters")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def add(self, key, weight):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[key] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def floor(self):
+        """Upper bound on the count of any key this summary is not tracking."""
+        if len(self.counters) < self.capacity:
+            return 0
+        return min(c[0] for c in self.counters.values())
+
+    @classmethod
+    def merged(cls, summaries, capacity):
+        """Combine summaries (Agarwal et al.): keys missing from one get its floor as count and error."""
+        out = cls(capacity)
+        floors = [s.floor() for s in summaries]
+        for key in set().union(*(s.counters for s in summaries)):
+            count = error = 0
+            for s, floor in zip(summaries, floors):
+                c = s.counters.get(key)
+                count += c[0] if c else floor
+                error += c[1] if c else floor
+            out.counters[key] = [count, error]
+        if len(out.counters) > capacity:
+            ranked = sorted(out.counters.items(), key=lambda kv: kv[1][0], reverse=True)
+            out.counters = dict(ranked[:capacity])
+        return out
+
+
+class _ClientAccounting:
+    """Tokens, generation seconds and requests per client over sliding windows, in bounded memory.
+
+    Each minute gets its own Space-Saving summary per metric (plus exact
+    totals); the last hour of minutes is kept and merged on demand, so a
+    window's top clients and their share come with an error bound, however
+    many distinct clients there are.
+    """
+
+    BUCKET = 60.0
+    BUCKETS = 60
+    CAPACITY = 64
+    METRICS = ("tokens", "generation_seconds", "requests")
+    WINDOWS = {"1m": 1, "5m": 5, "15m": 15, "1h": 60}
+
+    def __init__(self):
+        self._buckets = collections.deque(maxlen=self.BUCKETS)  # (start, {metric: summary}, {metric: total})
+        self._lock = threading.Lock()
+
+    def observe(self, record):
+        client = record.get("client")
+        if not client:
+            return
+        seconds = record.get("generation_time", record.get("decode_time", record.get("latency")))
+        values = {
+            "tokens": record.get("total_tokens") or 0,
+            "generation_seconds": seconds or 0.0,
+            "requests": 1,
+        }
+        start = time.time() // self.BUCKET * self.BUCKET
+        with self._lock:
+            if not self._buckets or self._buckets[-1][0] != start:
+                self._buckets.append((
+                    start,
+                    {m: _SpaceSaving(self.CAPACITY) for m in self.METRICS},
+                    dict.fromkeys(self.METRICS, 0),
+                ))
+            _, summaries, totals = self._buckets[-1]
+            for metric, value in values.items():
+                summaries[metric].add(client, value)
+                totals[metric] += value
+
+    def report(self, top=10, windows=None):
+        """Top clients by tokens and by generation seconds for each window."""
+        current = time.time() // self.BUCKET * self.BUCKET
+        result = {"bucket_seconds": self.BUCKET, "capacity": self.CAPACITY, "windows": {}}
+        with self._lock:
+            for name in windows or self.WINDOWS:
+                since = current - (self.WINDOWS[name] - 1) * self.BUCKET
+                recent = [b for b in self._buckets if b[0] >= since]
+                merged = {
+                    m: _SpaceSaving.merged([b[1][m] for b in recent], self.CAPACITY) for m in self.METRICS
+                }
+                totals = {m: sum(b[2][m] for b in recent) for m in self.METRICS}
+                result["windows"][name] = {
+                    "totals": {m: round(v, 3) for m, v in totals.items()},
+                    "clients": self._rows(merged, totals, top),
+                }
+        return result
+
+    def _rows(self, merged, totals, top):
+        keys = []
+        for metric in ("tokens", "generation_seconds"):
+            ranked = sorted(merged[metric].counters.items(), key=lambda kv: kv[1][0], reverse=True)
+            keys += [k for k, _ in ranked[:top] if k not in keys]
+        rows = []
+        for key in keys:
+            row = {"client": key}
+            for metric in self.METRICS:
+                c = merged[metric].counters.get(key)
+                row[metric] = {
+                    "value": round(c[0], 3),
+                    "error": round(c[1], 3),
+                    "share": round(c[0] / totals[metric], 3) if totals[metric] else None,
+                } if c else None
+            rows.append(row)
+        rows.sort(key=lambda r: r["tokens"]["value"] if r["tokens"] else 0, reverse=True)
+        return rows
+
+
+_clients = _ClientAccounting()
+
+
+def _scope_client(scope):
+    """_client_identity() for an ASGI request scope."""
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers") or ()}
+    client = scope.get("client")
+    return _client_identity(lambda name: headers.get(name.lower()), client[0] if client else None)
+
+
+class _MetricsRecorder:
+    """Contention-free front end to a metrics store.
+
+    Recording appends the finished record to one pending deque, which is a
+    single atomic operation under the GIL, so request threads (or the event
+    loop) take no lock and do no I/O.  A background tick, and every reader,
+    drains it in arrival order into the store (the in-process deque, or
+    shared memory with its flock) under one merge lock, so a snapshot never
+    races a writer.  Observers (alert rules, baselines) run on the tick thread.
+    """
+
+    TICK = 0.25
+
+    def __init__(self, store, observers=()):
+        self.store = store
+        self.observers = list(observers)
+        self._pending = collections.deque()
+        self._merge_lock = threading.Lock()
+        self._unobserved = collections.deque()
+        threading.Thread(target=self._tick_loop, name="mlx-cockpit-recorder", daemon=True).start()
+
+    def append(self, record):
+        self._pending.append(record)
+
+    def _merge(self):
+        """Move pending records into the store; the caller holds _merge_lock."""
+        drained = []
+        # popleft races only with append, and both are atomic on a deque
+        while self._pending:
+            drained.append(self._pending.popleft())
+        for record in drained:
+            self.store.append(record)
+        if self.observers:
+            self._unobserved.extend(drained)
+
+    def snapshot(self):
+        """Every stored record, including those finished since the last tick."""
+        with self._merge_lock:
+            self._merge()
+            return list(self.store)
+
+    def _tick_loop(self):
+        while True:
+            time.sleep(self.TICK)
+            try:
+                with self._merge_lock:
+                    self._merge()
+            except Exception:
+                logging.exception("Metrics recorder merge failed")
+            while self._unobserved:
+                record = self._unobserved.popleft()
+                for observe in self.observers:
+                    try:
+                        observe(record)
+                    except Exception:
+                        logging.exception("Metrics observer failed")
+
+
+def _weight_bytes(*models):
+    """Bytes of parameters held by the given models (None entries are skipped)."""
+    try:
+        from mlx.utils import tree_flatten
+        return sum(
+            p.nbytes for model in models if model is not None
+            for _, p in tree_flatten(model.parameters())
+        )
+    except Exception as e:
+        logging.debug(f"Weight size unavailable: {e}")
+        return None
+
+
+class _ColdStart:
+    """Model loads, and which requests ran cold because of one.
+
+    loaded() is called after every model (re)load with its wall time and the
+    bytes of weights it brought in, and starts a new load generation.  A
+    request is cold if a load finished while it ran (it waited for the
+    model) or it is among the first `cold_requests` to finish after the
+    latest load, which still pay for kernel compilation, first-touch
+    allocations and an empty prompt cache.  Records carry the flag, so
+    /v1/metrics can aggregate cold and warm requests apart.
+    """
+
+    HISTORY = 20
+
+    def __init__(self, cold_requests):
+        self.cold_requests = cold_requests
+        self.generation = 0
+        self._served = 0
+        self._loads = deque(maxlen=self.HISTORY)
+        self._lock = threading.Lock()
+
+    def loaded(self, model, seconds, weight_bytes):
+        with self._lock:
+            self.generation += 1
+            self._served = 0
+            self._loads.append({
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "model": model,
+                "load_time": round(seconds, 3),
+                "weight_bytes": weight_bytes,
+            })
+        size = f" ({weight_bytes / 2**30:.2f} GiB of weights)" if weight_bytes else ""
+        logging.info(f"Loaded {model} in {seconds:.2f}s{size}")
+
+    def claim(self, generation):
+        """Record fields for a request that started in load `generation`, now finishing."""
+        with self._lock:
+            waited = generation != self.generation and bool(self._loads)
+            cold = waited or self._served < self.cold_requests
+            self._served += 1
+            fields = {"cold": cold}
+            if waited:
+                fields["model_load_time"] = self._loads[-1]["load_time"]
+        return fields
+
+    @staticmethod
+    def _aggregate(records):
+        def avg(key, digits):
+            values = [r[key] for r in records if r.get(key) is not None]
+            return round(sum(values) / len(values), digits) if values else None
+        return {
+            "requests": len(records),
+            "avg_latency": avg("latency", 3),
+            "avg_ttft": avg("ttft", 3),
+            "avg_tokens_per_sec": avg("tokens_per_sec", 2),
+            "avg_model_load_time": avg("model_load_time", 3),
+        }
+
+    def summary(self, metrics):
+        """Cold and warm requests aggregated apart, plus recent model loads."""
+        with self._lock:
+            loads = list(self._loads)
+        return {
+            "cold_requests_per_load": self.cold_requests,
+            "cold": self._aggregate([m for m in metrics if m.get("cold")]),
+            "warm": self._aggregate([m for m in metrics if not m.get("cold")]),
+            "loads": loads,
+        }
+
+
+_cold = _ColdStart(cold_requests=int(os.environ.get("MLX_COCKPIT_COLD_REQUESTS", "1")))
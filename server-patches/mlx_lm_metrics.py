@@ -12,14 +12,51 @@ Server type: stdlib http.server (BaseHTTPRequestHandler / ThreadingHTTPServer)
 """
 
 # ---------------------------------------------------------------------------
-# 1. IMPORT
+# 1. IMPORTS
 # ---------------------------------------------------------------------------
-# The only extra import needed is `deque` from the collections module.
-# In the stock server.py this import already exists on the original line:
-#     from collections import deque
-# If it is not present, add it to the imports block at the top of the file.
+# The runtime every patch shares -- the metrics store, tracer, profiler,
+# service registry, alert rules, recorder, client accounting and cold-start
+# tracking -- lives in server-patches/_cockpit_common.py.  The patch script
+# inserts that file at the top of the metrics block (section 2), so the names
+# imported from it below are module globals in the patched server.py.
+#
+# The remaining imports are used by the stream writer, the baselines, the
+# KV-cache estimate and the new routes, and are inserted right after it.
 
+import atexit
+import collections
+import fcntl
+import importlib.metadata
+import json
+import logging
+import math
+import os
+import platform
+import re
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
 from collections import deque
+from urllib.parse import parse_qs, urlparse
+
+from _cockpit_common import (
+    _AlertEngine,
+    _client_identity,
+    _ClientAccounting,
+    _clients,
+    _cold,
+    _current_trace,
+    _MetricsRecorder,
+    _profiler,
+    _registry,
+    _SharedMetricsStore,
+    _tracer,
+    _weight_bytes,
+)
 
 # ---------------------------------------------------------------------------
 # 2. MODULE-LEVEL METRICS STORE
@@ -27,8 +64,24 @@ from collections import deque
 # INSERT after the top-level imports (after `from .utils import load, sharded_load`)
 # and before `def get_system_fingerprint():`.
 
-# Module-level store for recent request metrics (used by /dashboard and /v1/metrics)
-_metrics_store: deque = deque(maxlen=200)
+# By default each server process keeps its own deque.  When several processes
+# serve one port (uvicorn workers, a supervisor fanning out mlx_lm instances)
+# every /v1/metrics call would only see the slice held by whichever process
+# answered, so MLX_COCKPIT_SHM=<name> switches to a ring buffer in
+# multiprocessing.shared_memory that all processes on the host append to.
+# MLX_COCKPIT_SHM_SLOTS sets its capacity (default 200, like the deque).
+# _SharedMetricsStore is defined in _cockpit_common.py.
+
+# Module-level store for recent request metrics (used by /dashboard and /v1/metrics).
+# Set MLX_COCKPIT_SHM=<name> to share one store between every server process on
+# the host (e.g. several workers behind one port); otherwise it is per-process.
+if os.environ.get("MLX_COCKPIT_SHM"):
+    _metrics_store = _SharedMetricsStore(
+        os.environ["MLX_COCKPIT_SHM"],
+        capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+    )
+else:
+    _metrics_store: deque = deque(maxlen=200)
 
 
 # ---------------------------------------------------------------------------
@@ -246,37 +299,95 @@ setInterval(refresh, 2000);
 # flushed (after `self.wfile.flush()`), and before `def completion_usage_response`.
 #
 # At this point in the method the following variables are available:
-#   - start_time  (set at the top of handle_completion via time.perf_counter())
+#   - self._cockpit_start (perf_counter when the section 10 wrapper was entered;
+#                   stock mlx-lm keeps no start time of its own)
 #   - ctx.prompt  (the tokenized prompt list)
 #   - tokens      (the list of generated token ids)
+#   - finish_reason / stop_condition ("length" or "stop"; the stop condition
+#                   of the last token, if any)
 #   - self.requested_model (the model name from the request)
+#   - self.wfile  (the _StreamWriter installed by the section 10 wrapper)
+#   - self._cockpit_tokens (the _TokenStats fed by the section 10 loop hook)
 
-def _record_lm_metric_snippet(self, start_time, ctx_prompt, tokens):
+def _record_lm_metric_snippet(self, ctx, tokens, finish_reason):
     """
     This is NOT a real callable -- it shows the exact code to splice into
     handle_completion() after the final wfile.flush().
     """
-    import time, logging
+    # Push out any coalesced tail before measuring the request
+    self.wfile.drain()
+    if self.wfile.disconnected is not None:
+        termination = "client_disconnect"
+    else:
+        termination = _termination(finish_reason, locals().get("stop_condition"))
+    self._record_completion(self._cockpit_start, len(ctx.prompt), len(tokens), termination)
+
 
-    # Log per-request metrics
+# _record_completion() -- new method on APIHandler, inserted with the section
+# 10 wrapper.  The wrapper also calls it for requests the stock handler never
+# finishes (client_disconnect, error).
+
+def _record_completion(self, start_time, prompt_tokens, completion_tokens, termination):
+    """Build the request record, log it and hand it to the recorder."""
     latency = time.perf_counter() - start_time
-    prompt_tokens = len(ctx_prompt)
-    completion_tokens = len(tokens)
     total_tokens = prompt_tokens + completion_tokens
     tps = completion_tokens / latency if latency > 0 else 0
+    write_time = self.wfile.write_time
+    first = self._cockpit_tokens.first
+    ttft = first - start_time if first else None
     logging.info(
         f"prompt={prompt_tokens} completion={completion_tokens} "
-        f"total={total_tokens} | latency={latency:.1f}s | {tps:.2f} tok/s"
+        f"total={total_tokens} | latency={latency:.1f}s | {tps:.2f} tok/s "
+        f"| socket={write_time:.2f}s | {termination}"
+    )
+    if self._cockpit_trace is not None:
+        self._cockpit_trace.args.update(
+            model=self.requested_model,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            termination=termination,
+        )
+    # Canary probes (collector.py --canary) are timed by the collector as
+    # their own series, and the startup warm-up is not traffic at all; keep
+    # both out of the real-traffic metrics, the cold-request count and the
+    # speculative-decoding baseline
+    if _synthetic(self.headers):
+        return
+    draft_model, num_draft = _draft_config(self)
+    speculative = _speculative_fields(
+        self.requested_model, self._cockpit_tokens, draft_model, num_draft
     )
-    _metrics_store.append({
+    record = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "model": self.requested_model,
+        "client": _client_identity(self.headers.get, self.client_address[0]),  # section 20
         "prompt_tokens": prompt_tokens,
         "completion_tokens": completion_tokens,
         "total_tokens": total_tokens,
         "latency": round(latency, 2),
         "tokens_per_sec": round(tps, 2),
-    })
+        "ttft": round(ttft, 3) if ttft else None,
+        "prefill_tps": round(prompt_tokens / ttft, 1) if ttft else None,
+        "generation_time": round(latency - write_time, 3),
+        "write_time": round(write_time, 3),
+        "max_write_ms": round(self.wfile.max_write * 1000, 1),
+        "socket_writes": self.wfile.sends,
+        "slow_consumer": self.wfile.slow_consumer(latency),
+        "chunking": _stream_policy.describe() if self.stream else None,
+        "termination": termination,  # section 21
+        "avg_batch_size": self._cockpit_tokens.avg_batch(),  # section 22
+        **_context_fields(self, total_tokens),  # section 23
+        **speculative,
+        **_cold.claim(self._cockpit_generation),  # section 24
+    }
+    if termination == "client_disconnect":
+        # Tokens (and seconds) produced after the client was last reached:
+        # for a stream, since the last successful send; for a buffered
+        # response, all of it, since nothing was ever delivered
+        last_reached = self.wfile.delivered or start_time
+        record["wasted_tokens"] = completion_tokens - self.wfile.delivered_tokens
+        record["wasted_time"] = round(max(0.0, start_time + latency - last_reached), 3)
+    _recorder.append(record)
 
 
 # ---------------------------------------------------------------------------
@@ -295,7 +406,7 @@ def _record_lm_metric_snippet(self, start_time, ctx_prompt, tokens):
 # ---------------------------------------------------------------------------
 # 6. do_GET ROUTE ADDITIONS
 # ---------------------------------------------------------------------------
-# INSERT two new elif branches in `APIHandler.do_GET()`, after the existing
+# INSERT new elif branches in `APIHandler.do_GET()`, after the existing
 # `/health` check and before the 404 fallback.
 #
 # Original do_GET looks like:
@@ -315,6 +426,16 @@ def _record_lm_metric_snippet(self, start_time, ctx_prompt, tokens):
 #             self.handle_health_check()
 #         elif self.path == "/v1/metrics":        # <-- NEW
 #             self.handle_metrics_request()
+#         elif urlparse(self.path).path == "/v1/metrics/clients":  # <-- NEW (section 20)
+#             self.handle_clients_request()
+#         elif self.path == "/v1/trace":          # <-- NEW
+#             self.handle_trace_request()
+#         elif self.path.startswith("/v1/profile"):  # <-- NEW
+#             self.handle_profile_request()
+#         elif self.path == "/v1/registry":       # <-- NEW (section 16)
+#             self.handle_registry_request()
+#         elif self.path == "/v1/baselines":      # <-- NEW (section 18)
+#             self.handle_baselines_request()
 #         elif self.path == "/dashboard":          # <-- NEW
 #             self.handle_dashboard_request()
 #         else:
@@ -331,7 +452,7 @@ def handle_metrics_request(self):
     import json
     self._set_completion_headers(200)
     self.end_headers()
-    metrics = list(_metrics_store)
+    metrics = _recorder.snapshot()  # section 19
     total_requests = len(metrics)
     avg_tps = (
         sum(m["tokens_per_sec"] for m in metrics) / total_requests
@@ -340,6 +461,7 @@ def handle_metrics_request(self):
     )
     total_prompt = sum(m["prompt_tokens"] for m in metrics)
     total_completion = sum(m["completion_tokens"] for m in metrics)
+    batched = [m["avg_batch_size"] for m in metrics if m.get("avg_batch_size")]
     data = {
         "requests": metrics,
         "summary": {
@@ -347,7 +469,20 @@ def handle_metrics_request(self):
             "avg_tokens_per_sec": round(avg_tps, 2),
             "total_prompt_tokens": total_prompt,
             "total_completion_tokens": total_completion,
+            "total_write_time": round(sum(m.get("write_time", 0) for m in metrics), 3),
+            "slow_consumer_requests": sum(1 for m in metrics if m.get("slow_consumer")),
+            "stream_chunking": _stream_policy.describe(),
+            "speculative": _speculative_summary(metrics),
+            **_termination_summary(metrics),  # section 21
+            "avg_batch_size": round(sum(batched) / len(batched), 2) if batched else None,
+            "context": _context_summary(metrics),  # section 23
+            "cold_start": {**_cold.summary(metrics), "warmup": _warmup.describe()},  # section 24
+            "in_flight": _in_flight.count,  # section 24
         },
+        "batching": _batch_monitor.report(),  # section 22
+        "alerts": _alerts.snapshot(),  # section 17
+        "baselines": _baselines.report(),  # section 18
+        "clients": _clients.report(top=5, windows=("15m",)),  # section 20
     }
     self.wfile.write(json.dumps(data).encode())
     self.wfile.flush()
@@ -367,3 +502,1631 @@ def handle_dashboard_request(self):
     html = _DASHBOARD_HTML
     self.wfile.write(html.encode())
     self.wfile.flush()
+
+
+# ---------------------------------------------------------------------------
+# 9. REQUEST TRACING  (module level)
+# ---------------------------------------------------------------------------
+# Shared runtime: _Trace, _Tracer and _tracer are defined in _cockpit_common.py.
+#
+# A single latency number cannot say whether time went to the chat template,
+# prefill, decode or socket writes.  A configurable fraction of requests
+# (MLX_COCKPIT_TRACE_SAMPLE, 0.0-1.0, default 0 = off) gets stage spans that
+# are kept in a bounded buffer (MLX_COCKPIT_TRACE_EVENTS events) and served
+# from /v1/trace as Chrome trace-event JSON -- load it in https://ui.perfetto.dev.
+#
+# Chat templating and tokenization run in ResponseGenerator._tokenize() on
+# the generation thread.  The handle_completion() wrapper (section 10) puts
+# the trace in `_current_trace`; the stock `ResponseGenerator.generate()` and
+# `_tokenize()` are RENAMED to `_stock_generate()` / `_stock_tokenize()` behind
+# the wrappers below, which hand the trace across and give _tokenize() a
+# _TracedTokenizer, so "chat_template" and "tokenize" are separate spans
+# inside "prepare".  Servers without _tokenize() only get "prepare".
+
+class _TracedTokenizer:
+    """Tokenizer proxy that reports chat templating and tokenization as separate spans.
+
+    Stock _tokenize() renders and encodes in one apply_chat_template(tokenize=True)
+    call; for a sampled request that call is split into rendering (tokenize=False)
+    and encode(add_special_tokens=False), which is what the tokenizer does inside.
+    """
+
+    def __init__(self, tokenizer, trace):
+        self._tokenizer = tokenizer
+        self._trace = trace
+
+    def apply_chat_template(self, *args, tokenize=True, **kwargs):
+        with self._trace.stage("chat_template"):
+            text = self._tokenizer.apply_chat_template(*args, tokenize=False, **kwargs)
+        if not tokenize:
+            return text
+        with self._trace.stage("tokenize"):
+            return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def encode(self, *args, **kwargs):
+        with self._trace.stage("tokenize"):
+            return self._tokenizer.encode(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._tokenizer, name)
+
+
+# id(request) -> trace while ResponseGenerator.generate() waits for the
+# generation thread to tokenize it (only sampled requests are entered)
+_tokenize_traces = {}
+
+
+# ResponseGenerator: inserted before the renamed `def _stock_generate(` and
+# `def _stock_tokenize(` methods:
+
+def generate(self, request, *args, **kwargs):
+    """Run the stock generate (_stock_generate); a sampled request's trace follows it to _tokenize()."""
+    trace = _current_trace.get()
+    if trace is None:
+        return self._stock_generate(request, *args, **kwargs)
+    _tokenize_traces[id(request)] = trace
+    try:
+        return self._stock_generate(request, *args, **kwargs)
+    finally:
+        _tokenize_traces.pop(id(request), None)
+
+
+def _tokenize(self, tokenizer, request, *args):
+    """Run the stock tokenizer step (_stock_tokenize) with chat_template/tokenize spans when sampled."""
+    trace = _tokenize_traces.get(id(request))
+    if trace is not None:
+        tokenizer = _TracedTokenizer(tokenizer, trace)
+    return self._stock_tokenize(tokenizer, request, *args)
+
+
+# ---------------------------------------------------------------------------
+# 10. handle_completion() WRAPPER AND TOKEN LOOP HOOKS
+# ---------------------------------------------------------------------------
+# The stock `APIHandler.handle_completion()` is RENAMED to `_handle_completion()`
+# and the wrapper below is inserted under the original name (next to
+# handle_metrics_request), so do_POST keeps calling `handle_completion()`.
+#
+# Two hooks are inserted around the per-token loop of `_handle_completion()`
+# (`for gen in response:` on batched servers, `for gen_response in
+# stream_generate(...):` on older ones) to count tokens (section 15), split
+# prefill from decode and abandon the generation once the client has gone
+# (section 21):
+#
+#         self._cockpit_tokens.prompt = _prompt_length(locals())  # <-- NEW
+#         if self._cockpit_trace is not None:          # <-- NEW
+#             self._cockpit_trace.mark("generate")     # <-- NEW
+#         for gen in response:
+#             self._cockpit_tokens.add(gen)            # <-- NEW
+#             if self._cockpit_trace is not None:      # <-- NEW
+#                 self._cockpit_trace.token()          # <-- NEW
+#             if not self.wfile.alive():               # <-- NEW
+#                 _stop_generation(locals())           # <-- NEW
+#                 raise _ClientDisconnected()          # <-- NEW
+#             ...
+#
+# Resulting stages: "prepare" (request parsing, chat template, tokenization
+# and queueing, until response_generator.generate() returns), "prefill"
+# (until the first token), "decode" (first to last token; detokenization runs
+# inside the generator, so it is part of decode), plus one span per socket
+# send (section 14).
+
+def handle_completion(self, *args, **kwargs):
+    """Run the stock handler (_handle_completion) with socket timing, token stats and tracing.
+
+    Requests the stock handler does not finish are recorded here: a
+    client that hung up (generation is abandoned at the next token) and
+    an exception escaping generation.
+    """
+    # Stock handlers keep no start time of their own (mlx-lm 0.29+); record from here
+    self._cockpit_start = start = time.perf_counter()
+    trace = _tracer.begin("completion", path=self.path)
+    self._cockpit_trace = trace
+    trace_token = _current_trace.set(trace)
+    self._cockpit_generation = _cold.generation  # section 24
+    self._cockpit_tokens = _TokenStats()
+    wfile = self.wfile
+    self.wfile = _StreamWriter(
+        wfile, _stream_policy, trace, connection=self.connection, tokens=self._cockpit_tokens
+    )
+    synthetic = _synthetic(self.headers)
+    if not synthetic:
+        _in_flight.enter()
+    try:
+        return self._handle_completion(*args, **kwargs)
+    except _ClientDisconnected:
+        self.close_connection = True
+        tokens = self._cockpit_tokens
+        self._record_completion(start, tokens.prompt or 0, tokens.count, "client_disconnect")
+    except Exception:
+        tokens = self._cockpit_tokens
+        try:
+            self._record_completion(start, tokens.prompt or 0, tokens.count, "error")
+        except Exception as e:
+            logging.debug(f"Could not record failed completion: {e}")
+        raise
+    finally:
+        if not synthetic:
+            _in_flight.exit()
+        try:
+            self.wfile.finish()
+        except OSError:
+            pass
+        self.wfile = wfile
+        self._cockpit_trace = None
+        _current_trace.reset(trace_token)
+        if trace is not None:
+            trace.phase("prepare", "start", "generate")
+            trace.phase("prefill", "generate", "first_token")
+            trace.phase("decode", "first_token", "last_token")
+            _tracer.end(trace)
+
+
+# ---------------------------------------------------------------------------
+# 11. handle_trace_request() -- new method on APIHandler
+# ---------------------------------------------------------------------------
+# INSERT as a new method on the APIHandler class, after
+# handle_dashboard_request().
+
+def handle_trace_request(self):
+    """Return sampled request traces as Chrome trace-event JSON."""
+    import json
+    self._set_completion_headers(200)
+    self.end_headers()
+    self.wfile.write(json.dumps(_tracer.export()).encode())
+    self.wfile.flush()
+
+
+# ---------------------------------------------------------------------------
+# 12. SAMPLING PROFILER  (module level)
+# ---------------------------------------------------------------------------
+# Shared runtime: _SamplingProfiler and _profiler are defined in _cockpit_common.py.
+#
+# When a live server slows down there is no way to see where Python time goes
+# without restarting it under a profiler.  GET /v1/profile?seconds=N&hz=M
+# samples every thread for N seconds (default 10, max 120) at M Hz (default
+# 100) and returns collapsed stacks plus a top-functions summary; add
+# &format=collapsed for plain text that flamegraph.pl / speedscope read.
+# Disabled unless the server is started with MLX_COCKPIT_PROFILE=1: /v1/profile
+# lets anyone who can reach the port see code paths and stall the answering
+# thread for up to MAX_SECONDS.
+
+# ---------------------------------------------------------------------------
+# 13. handle_profile_request() -- new method on APIHandler
+# ---------------------------------------------------------------------------
+# INSERT as a new method on the APIHandler class, after
+# handle_trace_request().  The ThreadingHTTPServer answers it on its own
+# thread, so generation keeps running while the profile is taken.
+
+def handle_profile_request(self):
+    """Sample every thread's stack for ?seconds=N&hz=M (MLX_COCKPIT_PROFILE=1)."""
+    import json
+    query = parse_qs(urlparse(self.path).query)
+    if not _profiler.enabled:
+        status, data = 403, {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"}
+    else:
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+            hz = int(query.get("hz", ["100"])[0])
+        except ValueError:
+            seconds = hz = None
+        if seconds is None:
+            status, data = 400, {"error": "seconds and hz must be numbers"}
+        else:
+            data = _profiler.run(seconds=seconds, hz=hz)
+            status = 200 if data is not None else 409
+            if data is None:
+                data = {"error": "A profile is already running"}
+    if status == 200 and query.get("format", ["json"])[0] == "collapsed":
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self._set_cors_headers()
+        self.end_headers()
+        self.wfile.write(data["collapsed"].encode())
+    else:
+        self._set_completion_headers(status)
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode())
+    self.wfile.flush()
+
+
+# ---------------------------------------------------------------------------
+# 14. STREAM WRITER AND CHUNKING POLICY  (module level)
+# ---------------------------------------------------------------------------
+# INSERT after the request tracer (part of the section 2 block).  The section
+# 10 wrapper swaps it in for self.wfile while a completion runs.
+#
+# The stock handler writes and flushes once per token; with a slow or remote
+# client the socket applies backpressure and that time used to be counted as
+# generation.  Each record now carries generation_time vs write_time,
+# max_write_ms, socket_writes and a slow_consumer flag, plus the chunking
+# policy that was in effect.  Coalescing is opt-in:
+#   MLX_COCKPIT_STREAM_COALESCE_MS=20      send at most every 20 ms
+#   MLX_COCKPIT_STREAM_COALESCE_BYTES=4096 ... or once 4 KiB are pending
+
+class _StreamPolicy:
+    """How streamed tokens are pushed to the socket (per token, or coalesced)."""
+
+    def __init__(self, max_ms=0.0, max_bytes=0):
+        self.max_ms = max_ms
+        self.max_bytes = max_bytes
+        self.coalescing = max_ms > 0 or max_bytes > 0
+
+    def describe(self):
+        if not self.coalescing:
+            return {"mode": "per_token"}
+        return {"mode": "coalesce", "max_ms": self.max_ms, "max_bytes": self.max_bytes}
+
+
+_stream_policy = _StreamPolicy(
+    max_ms=float(os.environ.get("MLX_COCKPIT_STREAM_COALESCE_MS", "0")),
+    max_bytes=int(os.environ.get("MLX_COCKPIT_STREAM_COALESCE_BYTES", "0")),
+)
+
+
+class _StreamWriter:
+    """Stands in for the handler's wfile for the duration of one completion.
+
+    Every real socket write is timed, so time a slow or remote client spends
+    applying backpressure is reported as write time instead of being folded
+    into generation.  Under a coalescing policy, writes are buffered and
+    flush() only sends once `max_bytes` are pending or `max_ms` have passed
+    since the last send.  The first flush always goes out immediately so
+    headers and the first token are not delayed.  With `max_ms` set, a
+    flusher thread also sends whatever is still buffered once `max_ms` have
+    passed, so a stall between tokens does not hold back the tail.  Writes
+    from the handler, its keepalive callback and the flusher are serialized
+    by one lock.
+
+    A send that fails because the client hung up marks the writer
+    disconnected and later output is dropped; the token loop polls alive()
+    and abandons the generation instead of decoding to max_tokens.
+    """
+
+    CHECK_INTERVAL = 0.05
+
+    def __init__(self, wfile, policy, trace=None, connection=None, tokens=None):
+        self._wfile = wfile
+        self._policy = policy
+        self._trace = trace
+        self._connection = connection
+        self._tokens = tokens
+        self._lock = threading.RLock()
+        self._wake = threading.Condition(self._lock)
+        self._flusher = None
+        self._finished = False
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_send = None
+        self._next_check = 0.0
+        self.write_time = 0.0
+        self.max_write = 0.0
+        self.sends = 0
+        self.disconnected = None     # perf_counter() when the client was found gone
+        self.delivered = None        # perf_counter() of the last successful send
+        self.delivered_tokens = 0    # tokens generated by then
+
+    def write(self, data):
+        with self._lock:
+            if self._policy.coalescing:
+                self._pending.append(data)
+                self._pending_bytes += len(data)
+                if self._policy.max_ms > 0 and not self._finished:
+                    self._arm()
+                return len(data)
+            return self._send(data)
+
+    def flush(self):
+        with self._lock:
+            if self._pending and not self._due():
+                return
+            self.drain()
+
+    def drain(self):
+        """Send anything still buffered (end of request or error path)."""
+        with self._lock:
+            if self._pending:
+                data = b"".join(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+                self._send(data)
+
+    def finish(self):
+        """Drain and stop the flusher; the handler's own wfile takes over again."""
+        with self._lock:
+            self._finished = True
+            self._wake.notify()
+            self.drain()
+
+    def _arm(self):
+        """Start the deadline flusher, or wake it for newly buffered data; caller holds _lock."""
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._flush_at_deadline, name="mlx-cockpit-stream-flush", daemon=True
+            )
+            self._flusher.start()
+        else:
+            self._wake.notify()
+
+    def _flush_at_deadline(self):
+        with self._lock:
+            while not self._finished:
+                if not self._pending or self._last_send is None:
+                    self._wake.wait()
+                    continue
+                remaining = self._policy.max_ms / 1000 - (time.perf_counter() - self._last_send)
+                if remaining > 0:
+                    self._wake.wait(remaining)
+                    continue
+                try:
+                    self.drain()
+                except OSError:
+                    self._finished = True
+
+    def _due(self):
+        if self._last_send is None:
+            return True
+        if self._policy.max_bytes and self._pending_bytes >= self._policy.max_bytes:
+            return True
+        return (time.perf_counter() - self._last_send) * 1000 >= self._policy.max_ms > 0
+
+    def _send(self, data):
+        if self.disconnected is not None:
+            return len(data)
+        start = time.perf_counter()
+        try:
+            written = self._wfile.write(data)
+            self._wfile.flush()
+            self.delivered = time.perf_counter()
+            self.delivered_tokens = self._tokens.count if self._tokens is not None else 0
+            return written
+        except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+            self.disconnected = time.perf_counter()
+            return len(data)
+        finally:
+            end = time.perf_counter()
+            self._last_send = end
+            self.sends += 1
+            self.write_time += end - start
+            self.max_write = max(self.max_write, end - start)
+            if self._trace is not None:
+                self._trace.add_span("socket_write", start, end, bytes=len(data))
+
+    def alive(self):
+        """False once the client has gone: a send failed or its socket reads EOF.
+
+        The socket is peeked at most every CHECK_INTERVAL, so a non-streaming
+        request (or a coalesced stream with nothing due) notices a hang-up
+        without waiting for its next send.
+        """
+        if self.disconnected is not None:
+            return False
+        now = time.perf_counter()
+        if self._connection is None or now < self._next_check:
+            return True
+        self._next_check = now + self.CHECK_INTERVAL
+        try:
+            readable, _, _ = select.select([self._connection], [], [], 0)
+            if readable and not self._connection.recv(1, socket.MSG_PEEK):
+                self.disconnected = now
+        except (OSError, ValueError):
+            self.disconnected = now
+        return self.disconnected is None
+
+    def slow_consumer(self, latency):
+        """A client is slow if one send blocked >=100ms or sends took >=10% of the request."""
+        return self.max_write >= 0.1 or (latency > 0 and self.write_time >= 0.1 * latency)
+
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
+
+
+# ---------------------------------------------------------------------------
+# 15. TOKEN STATS AND SPECULATIVE DECODING  (module level)
+# ---------------------------------------------------------------------------
+# INSERT after the stream writer (part of the section 2 block).
+#
+# When the server runs with --draft-model, stream_generate() marks every
+# token the main model accepted from the draft with `from_draft=True`.  The
+# section 10 loop hook counts them per request, and section 4 adds to each
+# record:
+#   - decode_tps            tokens/s from first to last token (no prefill)
+#   - speculative           whether a draft model was loaded
+#   - draft_model, num_draft_tokens
+#   - draft_proposed        estimated: verify rounds x num_draft_tokens
+#   - draft_accepted        tokens with from_draft=True
+#   - acceptance_rate       draft_accepted / draft_proposed
+#   - baseline_tps          mean decode_tps of the last 20 non-speculative
+#                           requests for the same model (if any)
+#   - speculative_speedup   decode_tps / baseline_tps
+# /v1/metrics aggregates these per model under summary["speculative"].
+#
+# Servers with a ResponseGenerator copy each token into a `Response`
+# dataclass before the handler sees it, and that dataclass has no from_draft.
+# The patch adds the field and passes it through the single-request path
+# (the batched path never runs a draft model):
+#
+#     @dataclass
+#     class Response:
+#         ...
+#         from_draft: bool = False                                # <-- NEW
+#
+#     Response(
+#         gen.text,
+#         ...
+#         from_draft=getattr(gen, "from_draft", False),           # <-- NEW
+#     )
+#
+# The patch fails if it finds the dataclass but no such call to extend.  A
+# token that still arrives without the field makes the request's acceptance
+# unknown (None, with one warning in the log) instead of 0%.
+
+class _TokenStats:
+    """Per-request token counters fed from the generation loop.
+
+    Tracks when the first and last tokens arrived (so decode speed can be
+    separated from prefill), how many tokens came from the draft model, and
+    the decode batch each token was generated in (batched servers only).
+    `draft_unknown` is set when a token arrives without a from_draft field,
+    so acceptance is reported as unknown rather than 0%.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.from_draft = 0
+        self.draft_unknown = False
+        self.first = None
+        self.last = None
+        self.prompt = None
+        self.batch_sum = 0
+        self.batch_samples = 0
+
+    def add(self, gen):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+        from_draft = getattr(gen, "from_draft", None)
+        if from_draft is None:
+            self.draft_unknown = True
+        elif from_draft:
+            self.from_draft += 1
+        batch = _batch_monitor.current()
+        if batch:
+            self.batch_sum += batch
+            self.batch_samples += 1
+
+    def avg_batch(self):
+        if not self.batch_samples:
+            return None
+        return round(self.batch_sum / self.batch_samples, 2)
+
+    def decode_tps(self):
+        if self.count < 2 or self.last <= self.first:
+            return None
+        return (self.count - 1) / (self.last - self.first)
+
+
+def _model_provider(handler):
+    """The handler's ModelProvider (held directly, or by its ResponseGenerator)."""
+    provider = getattr(handler, "model_provider", None)
+    if provider is None:
+        provider = getattr(getattr(handler, "response_generator", None), "model_provider", None)
+    return provider
+
+
+def _draft_config(handler):
+    """Return (draft model name, num_draft_tokens), or (None, 0) without a draft model."""
+    provider = _model_provider(handler)
+    if provider is None or getattr(provider, "draft_model", None) is None:
+        return None, 0
+    cli_args = getattr(provider, "cli_args", None)
+    key = getattr(provider, "model_key", None) or ()
+    name = (key[2] if len(key) > 2 else None) or getattr(cli_args, "draft_model", None)
+    num_draft = getattr(handler, "num_draft_tokens", None)
+    if num_draft is None:
+        num_draft = getattr(cli_args, "num_draft_tokens", 0)
+    return (name or "draft").split("/")[-1], int(num_draft or 0)
+
+
+# Recent decode tok/s of non-speculative requests, per model; the baseline a
+# speculative request's speedup is measured against.
+_spec_baseline = {}
+_draft_unknown_logged = False
+
+
+def _speculative_fields(model, stats, draft_model, num_draft):
+    """Record fields describing speculative decoding for one request."""
+    decode_tps = stats.decode_tps()
+    fields = {
+        "decode_tps": round(decode_tps, 2) if decode_tps else None,
+        "speculative": draft_model is not None,
+    }
+    if draft_model is None:
+        if decode_tps:
+            _spec_baseline.setdefault(model, deque(maxlen=20)).append(decode_tps)
+        return fields
+    baseline = _spec_baseline.get(model)
+    baseline_tps = sum(baseline) / len(baseline) if baseline else None
+    if stats.draft_unknown:
+        # The tokens reached the handler without from_draft (e.g. a server
+        # whose Response dataclass the patch could not extend): counting them
+        # would report 0% acceptance for every request
+        global _draft_unknown_logged
+        if not _draft_unknown_logged:
+            _draft_unknown_logged = True
+            logging.warning("Generated tokens carry no from_draft flag; draft acceptance is not recorded")
+        proposed = accepted = None
+    else:
+        # Each verify round yields its accepted draft tokens plus one token from
+        # the main model, so main-model tokens count the rounds.  The final round
+        # may propose fewer than num_draft, making `proposed` an upper bound.
+        proposed = (stats.count - stats.from_draft) * num_draft
+        accepted = stats.from_draft
+    fields.update({
+        "draft_model": draft_model,
+        "num_draft_tokens": num_draft,
+        "draft_proposed": proposed,
+        "draft_accepted": accepted,
+        "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+        "baseline_tps": round(baseline_tps, 2) if baseline_tps else None,
+        "speculative_speedup": (
+            round(decode_tps / baseline_tps, 2) if decode_tps and baseline_tps else None
+        ),
+    })
+    return fields
+
+
+def _speculative_summary(metrics):
+    """Per-model speculative decoding aggregates for /v1/metrics."""
+    by_model = {}
+    for m in metrics:
+        by_model.setdefault(m["model"], []).append(m)
+    summary = {}
+    for model, records in by_model.items():
+        spec = [m for m in records if m.get("speculative")]
+        if not spec:
+            continue
+        plain = [m["decode_tps"] for m in records if not m.get("speculative") and m.get("decode_tps")]
+        counted = [m for m in spec if m.get("draft_accepted") is not None]
+        proposed = sum(m["draft_proposed"] for m in counted)
+        accepted = sum(m["draft_accepted"] for m in counted)
+        spec_tps = [m["decode_tps"] for m in spec if m.get("decode_tps")]
+        avg_tps = sum(spec_tps) / len(spec_tps) if spec_tps else None
+        if plain:
+            baseline_tps = sum(plain) / len(plain)
+        else:
+            recorded = [m["baseline_tps"] for m in spec if m.get("baseline_tps")]
+            baseline_tps = sum(recorded) / len(recorded) if recorded else None
+        summary[model] = {
+            "draft_model": spec[-1]["draft_model"],
+            "num_draft_tokens": spec[-1]["num_draft_tokens"],
+            "requests": len(spec),
+            "baseline_requests": len(plain),
+            "draft_proposed": proposed,
+            "draft_accepted": accepted,
+            "acceptance_rate": round(accepted / proposed, 3) if proposed else None,
+            "avg_decode_tps": round(avg_tps, 2) if avg_tps else None,
+            "baseline_tps": round(baseline_tps, 2) if baseline_tps else None,
+            "speedup": round(avg_tps / baseline_tps, 2) if avg_tps and baseline_tps else None,
+        }
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# 16. SERVICE REGISTRY  (module level + run() + /v1/registry)
+# ---------------------------------------------------------------------------
+# Shared runtime: _ServiceRegistry and _registry are defined in _cockpit_common.py.
+#
+# Patched servers announce themselves in ~/.mlx-cockpit/registry instead of
+# waiting to be found by a scan of ports 8080-8090, so servers on any port
+# are discovered and consumers only probe live servers.  The widget's
+# mlx-scan.sh reads the directory directly; the dashboard asks any patched
+# server for GET /v1/registry.  Both still scan 8080-8090 when nothing is
+# registered (and once a minute, for unpatched servers).
+#
+# INSERT right before `httpd.serve_forever()`, which is in run() or, on
+# mlx-lm 0.31+, in _run_http_server().  That function only gets the
+# response_generator, so the provider is `response_generator.model_provider`
+# there instead of `model_provider`:
+#
+#     _registry.register(
+#         "mlx_lm", "LLM", httpd.server_address[1],
+#         getattr(getattr(model_provider, "cli_args", None), "model", None),
+#     )
+#     _warmup.start(httpd.server_address)   # section 24
+#
+# do_GET route (section 6):
+#
+#     elif self.path == "/v1/registry":
+#         self.handle_registry_request()
+
+# MLX_COCKPIT_REGISTRY=<dir> moves the registry; MLX_COCKPIT_REGISTRY=off disables it.
+def handle_registry_request(self):
+    """Return the MLX servers registered on this host (self-registration)."""
+    import json
+    self._set_completion_headers(200)
+    self.end_headers()
+    self.wfile.write(json.dumps({"services": _registry.live()}).encode())
+    self.wfile.flush()
+
+
+# ---------------------------------------------------------------------------
+# 17. ALERT RULES  (module level)
+# ---------------------------------------------------------------------------
+# Shared runtime: _AlertEngine is defined in _cockpit_common.py; each server
+# creates its own _alerts instance, inserted after it.
+#
+# Every record appended in section 4 is fed to _alerts.observe(), which
+# updates each rule's per-model window in place (no rescans of the store)
+# and hands firing/resolved transitions to a delivery thread, so a slow
+# webhook never holds up a response.  handle_metrics_request() (section 7)
+# adds the current state as a top-level "alerts" key:
+#
+#   "alerts": {
+#     "rules": 3,
+#     "firing": [{"rule": "throughput_drop", "model": ..., "metric": "tokens_per_sec",
+#                 "stat": "mean", "value": 0.41, "op": "<", "threshold": 0.5,
+#                 "since": "2025-01-15 14:30:22"}],
+#     "events": [...last 50 transitions, as delivered...]
+#   }
+#
+# Rules are evaluated per process; with MLX_COCKPIT_SHM each worker alerts on
+# the requests it served itself.
+#
+# Environment:
+#   MLX_COCKPIT_ALERTS=<rules.json>      replace DEFAULT_RULES (a JSON list); "off" disables
+#   MLX_COCKPIT_ALERT_WEBHOOK=<url>      POST each event as JSON
+#   MLX_COCKPIT_ALERT_COMMAND=<command>  run with the event JSON on stdin
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_lm")
+
+
+# ---------------------------------------------------------------------------
+# 18. PERFORMANCE BASELINES AND REGRESSION DETECTION  (module level + /v1/baselines)
+# ---------------------------------------------------------------------------
+# INSERT after the alert rules (part of the section 2 block).
+#
+# Every record (section 4) adds its prefill tok/s (prompt tokens / ttft) and
+# decode tok/s to a baseline keyed by (model, mlx-lm version, hardware) and
+# prompt-length bucket, persisted in ~/.mlx-cockpit/baselines.json.  After
+# an upgrade (and re-running patch_mlx_lm.py, which prints the versions it
+# will compare against) the new version's numbers are compared with the
+# previous version's as soon as both have MIN_SAMPLES requests per bucket:
+# "faster" / "slower" needs |Welch t| >= 3 and a change of at least 3%.
+#
+# do_GET route (section 6):
+#
+#     elif self.path == "/v1/baselines":
+#         self.handle_baselines_request()
+#
+# handle_metrics_request() (section 7) adds the same report as a top-level
+# "baselines" key for the dashboard.
+#
+# Environment:
+#   MLX_COCKPIT_BASELINES=<file>   move the baselines file; "off" keeps them in memory only
+
+class _BaselineStore:
+    """Persistent speed baselines per (model, server version, hardware) and prompt-length bucket.
+
+    Prefill and decode tok/s are accumulated as Welford (n, mean, M2) triples
+    in ~/.mlx-cockpit/baselines.json, so they survive restarts and upgrades.
+    Once both sides have MIN_SAMPLES, the current environment is compared
+    with the most recently seen other version of the same model on the same
+    hardware (Welch's t), or failing that with another quantization of the
+    same base model (a quantization swap); within a version a two-sided CUSUM flags sustained
+    shifts as change points.  Each process merges only what it added since
+    its last save into the file, under an flock, so workers sharing a host
+    don't overwrite each other.
+    """
+
+    BUCKETS = (256, 1024, 4096, 16384)
+    METRICS = ("prefill_tps", "decode_tps")
+    MIN_SAMPLES = 5
+    T_SIGNIFICANT = 3.0      # |Welch t| needed to call a difference real
+    MIN_CHANGE = 0.03        # ...and at least a 3% change in the mean
+    CUSUM_K = 0.5            # slack, in standard deviations
+    CUSUM_H = 5.0            # alarm level, in standard deviations
+    SAVE_INTERVAL = 30.0
+    QUANT_SUFFIX = re.compile(r"[-_]([0-9.]+bit|bf16|fp16|f16|dwq|mxfp[0-9]+|awq|gptq|q[0-9]).*$", re.I)
+
+    def __init__(self, path, server, package):
+        self.path = path
+        self.env = {
+            "server": server,
+            "version": self._package_version(package),
+            "mlx": self._package_version("mlx"),
+            "hardware": self._hardware(),
+        }
+        self._series = {}    # series key -> entry as stored on disk
+        self._pending = {}   # (series key, bucket, metric) -> Welford triple not yet saved
+        self._cusum = {}     # (series key, bucket, metric) -> CUSUM state
+        self.change_points = collections.deque(maxlen=50)
+        self._lock = threading.Lock()
+        if self.path:
+            self._series = self._read().get("series", {})
+            threading.Thread(target=self._save_loop, name="mlx-cockpit-baselines", daemon=True).start()
+            atexit.register(self.save)
+
+    @staticmethod
+    def _package_version(package):
+        try:
+            return importlib.metadata.version(package)
+        except Exception:
+            return "unknown"
+
+    @staticmethod
+    def _hardware():
+        if sys.platform == "darwin":
+            try:
+                chip = subprocess.run(
+                    ["sysctl", "-n", "machdep.cpu.brand_string", "hw.memsize"],
+                    capture_output=True, text=True, timeout=2,
+                ).stdout.splitlines()
+                return f"{chip[0].strip()} {int(chip[1]) // 2**30}GB"
+            except Exception:
+                pass
+        return platform.processor() or platform.machine() or "unknown"
+
+    @classmethod
+    def bucket(cls, prompt_tokens):
+        lower = 0
+        for upper in cls.BUCKETS:
+            if prompt_tokens < upper:
+                return f"{lower}-{upper - 1}"
+            lower = upper
+        return f"{lower}+"
+
+    @staticmethod
+    def _merge(a, b):
+        """Combine two Welford (n, mean, M2) triples (Chan et al.)."""
+        n = a[0] + b[0]
+        if n == 0:
+            return [0, 0.0, 0.0]
+        delta = b[1] - a[1]
+        return [n, a[1] + delta * b[0] / n, a[2] + b[2] + delta * delta * a[0] * b[0] / n]
+
+    @staticmethod
+    def _stats(triple):
+        n, mean, m2 = triple
+        std = math.sqrt(m2 / (n - 1)) if n > 1 else 0.0
+        return {"n": n, "mean": round(mean, 2), "std": round(std, 2)}
+
+    def _key(self, model):
+        return "|".join((model, self.env["server"], self.env["version"], self.env["hardware"]))
+
+    def observe(self, record):
+        """Add one warm request's prefill/decode speeds to the current environment's baseline."""
+        if record.get("cold"):
+            return
+        model = record.get("model") or "unknown"
+        bucket = self.bucket(record.get("prompt_tokens") or 0)
+        key = self._key(model)
+        with self._lock:
+            entry = self._series.setdefault(key, {
+                "model": model,
+                "server": self.env["server"],
+                "version": self.env["version"],
+                "mlx": self.env["mlx"],
+                "hardware": self.env["hardware"],
+                "buckets": {},
+            })
+            entry["last_seen"] = time.time()
+            for metric in self.METRICS:
+                x = record.get(metric)
+                if not x:
+                    continue
+                stored = entry["buckets"].setdefault(bucket, {}).setdefault(metric, [0, 0.0, 0.0])
+                self._detect_change(model, key, bucket, metric, stored, x)
+                one = [1, float(x), 0.0]
+                stored[:] = self._merge(stored, one)
+                pending = self._pending.get((key, bucket, metric), [0, 0.0, 0.0])
+                self._pending[(key, bucket, metric)] = self._merge(pending, one)
+
+    def _detect_change(self, model, key, bucket, metric, stored, x):
+        # Two-sided CUSUM on values standardised against the baseline so far
+        n, mean, m2 = stored
+        if n < 2 * self.MIN_SAMPLES:
+            return
+        state = self._cusum.setdefault((key, bucket, metric), {
+            "ref": mean, "relearn": None, "hi": 0.0, "lo": 0.0,
+        })
+        if state["relearn"] is not None:
+            # After an alarm the next samples define the new level; report it then
+            state["relearn"].append(x)
+            if len(state["relearn"]) < 2 * self.MIN_SAMPLES:
+                return
+            before, state["ref"] = state["ref"], sum(state["relearn"]) / len(state["relearn"])
+            state["relearn"] = None
+            after = state["ref"]
+            if abs(after - before) >= self.MIN_CHANGE * abs(before):
+                self.change_points.append({
+                    "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "model": model,
+                    "bucket": bucket,
+                    "metric": metric,
+                    "direction": "faster" if after > before else "slower",
+                    "before": round(before, 2),
+                    "after": round(after, 2),
+                })
+                logging.warning(
+                    f"Baseline change point: {model} {metric} ({bucket} prompt tokens) "
+                    f"{before:.1f} -> {after:.1f} tok/s"
+                )
+            return
+        # Floor the spread at 1% of the mean so a very steady series doesn't alarm on noise
+        std = max(math.sqrt(m2 / (n - 1)), 0.01 * abs(mean))
+        if std <= 0:
+            return
+        z = (x - state["ref"]) / std
+        state["hi"] = max(0.0, state["hi"] + z - self.CUSUM_K)
+        state["lo"] = max(0.0, state["lo"] - z - self.CUSUM_K)
+        if max(state["hi"], state["lo"]) >= self.CUSUM_H:
+            state.update(relearn=[], hi=0.0, lo=0.0)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Merge this process's new samples into the baselines file."""
+        if not self.path:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            local = {key: dict(entry, buckets={}) for key, entry in self._series.items()}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                series = self._read().get("series", {})
+                for (key, bucket, metric), triple in pending.items():
+                    entry = series.setdefault(key, local[key])
+                    entry["last_seen"] = max(entry.get("last_seen", 0), local[key]["last_seen"])
+                    stored = entry["buckets"].setdefault(bucket, {}).get(metric, [0, 0.0, 0.0])
+                    entry["buckets"][bucket][metric] = self._merge(stored, triple)
+                tmp = f"{self.path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as f:
+                    json.dump({"version": 1, "series": series}, f)
+                os.replace(tmp, self.path)
+        except OSError as e:
+            logging.warning(f"Could not save baselines to {self.path}: {e}")
+            with self._lock:
+                for k, triple in pending.items():
+                    self._pending[k] = self._merge(self._pending.get(k, [0, 0.0, 0.0]), triple)
+            return
+        with self._lock:
+            # Adopt other workers' samples too, plus anything recorded here meanwhile
+            new_keys = set(self._series) - set(series)
+            for key in new_keys:
+                series[key] = self._series[key]
+            for (key, bucket, metric), triple in self._pending.items():
+                if key not in new_keys:
+                    metrics = series[key]["buckets"].setdefault(bucket, {})
+                    metrics[metric] = self._merge(metrics.get(metric, [0, 0.0, 0.0]), triple)
+            self._series = series
+
+    def _save_loop(self):
+        while True:
+            time.sleep(self.SAVE_INTERVAL)
+            self.save()
+
+    def verdicts(self):
+        """Current environment vs. the previous version of each model on this hardware."""
+        results = []
+        with self._lock:
+            for key, entry in self._series.items():
+                if key != self._key(entry["model"]):
+                    continue
+                previous = self._previous(entry)
+                by_size = sorted(entry["buckets"].items(), key=lambda b: int(b[0].split("-")[0].rstrip("+")))
+                for bucket, metrics in by_size:
+                    for metric, triple in sorted(metrics.items()):
+                        results.append(self._verdict(entry, previous, bucket, metric, triple))
+        return results
+
+    def _previous(self, entry):
+        """Same model under another server version, else another quantization of it."""
+        family = self.QUANT_SUFFIX.sub("", entry["model"].split("/")[-1])
+        upgrade, swap = None, None
+        for e in self._series.values():
+            if e is entry or e["server"] != entry["server"] or e["hardware"] != entry["hardware"]:
+                continue
+            if e["model"] == entry["model"]:
+                if upgrade is None or e.get("last_seen", 0) > upgrade.get("last_seen", 0):
+                    upgrade = e
+            elif self.QUANT_SUFFIX.sub("", e["model"].split("/")[-1]) == family:
+                if swap is None or e.get("last_seen", 0) > swap.get("last_seen", 0):
+                    swap = e
+        return upgrade or swap
+
+    def _verdict(self, entry, previous, bucket, metric, triple):
+        result = {
+            "model": entry["model"],
+            "bucket": bucket,
+            "metric": metric,
+            "version": entry["version"],
+            "current": self._stats(triple),
+            "previous": None,
+            "change_pct": None,
+            "t": None,
+            "verdict": "no previous version",
+        }
+        before = previous["buckets"].get(bucket, {}).get(metric) if previous else None
+        if not before:
+            return result
+        result["previous"] = dict(self._stats(before), model=previous["model"], version=previous["version"])
+        if triple[0] < self.MIN_SAMPLES or before[0] < self.MIN_SAMPLES:
+            result["verdict"] = "collecting"
+            return result
+        (n1, m1, v1), (n0, m0, v0) = triple, before
+        var = v1 / (n1 - 1) / n1 + v0 / (n0 - 1) / n0
+        change = (m1 - m0) / m0 if m0 else 0.0
+        t = (m1 - m0) / math.sqrt(var) if var > 0 else math.copysign(math.inf, m1 - m0)
+        result["change_pct"] = round(change * 100, 1)
+        result["t"] = round(t, 2) if math.isfinite(t) else None
+        significant = abs(t) >= self.T_SIGNIFICANT and abs(change) >= self.MIN_CHANGE
+        result["verdict"] = ("faster" if change > 0 else "slower") if significant else "no change"
+        return result
+
+    def report(self):
+        """Everything /v1/baselines returns."""
+        return {
+            "environment": self.env,
+            "verdicts": self.verdicts(),
+            "change_points": list(self.change_points),
+        }
+
+
+# MLX_COCKPIT_BASELINES=<file> moves the baselines file; MLX_COCKPIT_BASELINES=off disables it.
+_baselines = _BaselineStore(
+    None if os.environ.get("MLX_COCKPIT_BASELINES") == "off"
+    else os.path.expanduser(os.environ.get("MLX_COCKPIT_BASELINES") or "~/.mlx-cockpit/baselines.json"),
+    "mlx_lm",
+    "mlx-lm",
+)
+
+
+def handle_baselines_request(self):
+    """Return per-version speed baselines, regression verdicts and change points."""
+    import json
+    self._set_completion_headers(200)
+    self.end_headers()
+    self.wfile.write(json.dumps(_baselines.report()).encode())
+    self.wfile.flush()
+
+
+# ---------------------------------------------------------------------------
+# 19. CONTENTION-FREE RECORDING  (module level)
+# ---------------------------------------------------------------------------
+# Shared runtime: _MetricsRecorder is defined in _cockpit_common.py.
+#
+# ThreadingHTTPServer runs every request on its own thread.  Appending to the
+# deque from those threads while handle_metrics_request() iterates it can
+# raise "deque mutated during iteration", and with MLX_COCKPIT_SHM every
+# append waits on the store's flock.  Requests instead append to one pending
+# deque (section 4), an atomic operation that takes no lock.  It is drained
+# into _metrics_store in order on a background tick, and by every reader
+# (section 7), under one lock that only mergers take.  Alert rules
+# (section 17) and baselines (section 18) are fed from the tick thread.
+
+# _recorder itself is created at the end of section 20, once _clients exists.
+
+
+# ---------------------------------------------------------------------------
+# 20. PER-CLIENT ACCOUNTING  (module level + /v1/metrics/clients)
+# ---------------------------------------------------------------------------
+# Shared runtime: _client_identity, _SpaceSaving, _ClientAccounting and
+# _clients are defined in _cockpit_common.py.
+#
+# Shared servers need to show who is using the GPU.  Every record (section 4)
+# carries a client identity: the MLX_COCKPIT_CLIENT_HEADER header's value
+# (e.g. X-Tenant), else a short SHA-256 of the API key (Authorization:
+# Bearer or X-API-Key), else the remote address.  Tokens, generation seconds
+# and requests per client go into one Space-Saving summary per metric per
+# minute (64 counters each), kept for an hour and merged per window, so a
+# noisy batch client stands out whatever the number of distinct clients.
+#
+# do_GET route (section 6):
+#
+#     elif urlparse(self.path).path == "/v1/metrics/clients":
+#         self.handle_clients_request()
+
+# MLX_COCKPIT_CLIENT_HEADER=<header> names a header (e.g. X-Tenant) that identifies the client.
+def handle_clients_request(self):
+    """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+    try:
+        top = int(parse_qs(urlparse(self.path).query).get("top", ["10"])[0])
+    except ValueError:
+        top = 10
+    self._set_completion_headers(200)
+    self.end_headers()
+    report = _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+    self.wfile.write(json.dumps(report).encode())
+    self.wfile.flush()
+
+
+# Requests record through _recorder (section 19); alert rules, baselines and
+# client accounting see each record on its tick.
+_recorder = _MetricsRecorder(
+    _metrics_store, observers=(_alerts.observe, _baselines.observe, _clients.observe)
+)
+
+
+# ---------------------------------------------------------------------------
+# 21. CLIENT DISCONNECTS AND TERMINATION REASONS  (module level)
+# ---------------------------------------------------------------------------
+# INSERT after the token stats (part of the section 2 block).
+#
+# A client that hangs up used to be noticed only when the final response
+# failed to send, after decoding up to max_tokens, and the request was never
+# recorded.  Now the stream writer (section 14) marks itself disconnected on
+# a broken pipe or reset, and otherwise peeks the socket for EOF every 50 ms
+# from the token loop hook (section 10); the hook then stops the generator
+# and raises _ClientDisconnected, which the wrapper records.
+#
+# Every record carries `termination`: completed (EOS), stop_sequence,
+# length (max_tokens), client_disconnect or error.  Abandoned requests add
+#   - wasted_tokens   tokens generated after the client was last reached
+#                     (last successful send; a buffered response never was)
+#   - wasted_time     seconds of generation spent on them
+# /v1/metrics (section 7) adds summary["terminations"] and summary["wasted"].
+
+class _ClientDisconnected(ConnectionError):
+    """Raised from the token loop to abandon a generation nobody will read."""
+
+
+_TERMINATIONS = ("completed", "stop_sequence", "length", "client_disconnect", "error")
+
+
+def _termination(finish_reason, stop_condition=None):
+    """Map the stock handler's finish_reason onto a termination reason.
+
+    "stop" covers both EOS and stop sequences; only a stop sequence leaves a
+    suffix to trim off the output.
+    """
+    if finish_reason == "length":
+        return "length"
+    if getattr(stop_condition, "stop_met", False) and getattr(stop_condition, "trim_length", 0):
+        return "stop_sequence"
+    return "completed"
+
+
+def _prompt_length(scope):
+    """Prompt token count from the completion handler's locals (ctx.prompt or prompt)."""
+    ctx = scope.get("ctx")
+    prompt = getattr(ctx, "prompt", None) if ctx is not None else scope.get("prompt")
+    try:
+        return len(prompt)
+    except TypeError:
+        return None
+
+
+def _stop_generation(scope):
+    """Tell the generator behind the handler's token loop to stop.
+
+    Batched servers decode on their own thread, so leaving the loop is not
+    enough: ctx.stop() drops the request from the batch.  Closing the
+    response generator covers servers that generate inline.
+    """
+    for name, method in (("ctx", "stop"), ("response", "close")):
+        stop = getattr(scope.get(name), method, None)
+        if callable(stop):
+            try:
+                stop()
+            except Exception as e:
+                logging.debug(f"Stopping generation via {name}.{method}() failed: {e}")
+
+
+def _termination_summary(metrics):
+    """Requests per termination reason, and the compute spent on abandoned ones."""
+    counts = dict.fromkeys(_TERMINATIONS, 0)
+    for m in metrics:
+        reason = m.get("termination", "completed")
+        counts[reason] = counts.get(reason, 0) + 1
+    abandoned = [m for m in metrics if m.get("termination") == "client_disconnect"]
+    wasted_tokens = sum(m.get("wasted_tokens", 0) for m in abandoned)
+    total_completion = sum(m["completion_tokens"] for m in metrics)
+    return {
+        "terminations": counts,
+        "wasted": {
+            "requests": len(abandoned),
+            "tokens": wasted_tokens,
+            "generation_seconds": round(sum(m.get("wasted_time", 0) for m in abandoned), 3),
+            "share_of_completion_tokens": (
+                round(wasted_tokens / total_completion, 4) if total_completion else 0.0
+            ),
+        },
+    }
+
+
+# ---------------------------------------------------------------------------
+# 22. BATCH OCCUPANCY AND DECODE STEP TIMING  (module level + ResponseGenerator)
+# ---------------------------------------------------------------------------
+# INSERT after the speculative decoding helpers (part of the section 2 block).
+#
+# Servers with continuous batching decode every active request in one step
+# on the generation thread, so a request's tok/s drops as the batch grows
+# even though the server as a whole may be producing more.  The patch
+# rewrites every `batch_generator.next()` call inside class ResponseGenerator
+# (none on servers that do not batch):
+#
+#     prompt_responses, gen_responses = batch_generator.next()
+#     prompt_responses, gen_responses = _batch_monitor.step(batch_generator)   # <-- PATCHED
+#
+# step() times the call and counts the sequences that got a token.  The
+# section 15 token hook samples the current batch size as each token
+# arrives, so every record gets `avg_batch_size`.  /v1/metrics adds
+# summary["avg_batch_size"] and a top-level "batching" object with
+#   - series           5 s points over 15 min: avg/max batch, occupancy
+#                      (vs. --decode-concurrency), tokens, step_ms, busy
+#   - tokens_per_step, avg_step_ms, tokens_per_sec over that window
+#   - by_batch_size    per batch size (pure decode steps): step_ms, total
+#                      tokens/s and the tokens/s each request in it sees
+
+class _BatchMonitor:
+    """Decode-step sampling for servers that batch concurrent requests.
+
+    The patch routes the generation thread's `batch_generator.next()` through
+    step(), which times each call and counts the sequences that got a token
+    (the active batch) and those still in prefill.  Steps roll up into
+    BUCKET-second points for the occupancy time series, and pure decode
+    steps into per-batch-size totals, which show whether a bigger batch
+    still raises total tokens/s or only slows every request down.  Handler
+    threads read current() as each token arrives, so a record can carry the
+    batch size its request ran in.
+    """
+
+    BUCKET = 5.0     # seconds per time-series point
+    BUCKETS = 180    # 15 minutes of points
+    FRESH = 1.0      # no step for this long means no batch is running
+
+    def __init__(self):
+        self.capacity = None
+        self._active = 0
+        self._updated = 0.0
+        self._series = deque(maxlen=self.BUCKETS)
+        self._by_size = {}   # batch size -> [decode steps, seconds]
+        self._lock = threading.Lock()
+
+    def step(self, generator):
+        """Call generator.next() and account for the step it ran."""
+        start = time.perf_counter()
+        result = generator.next()
+        end = time.perf_counter()
+        # Newer BatchGenerators return (prompt responses, generation responses)
+        if isinstance(result, tuple) and len(result) == 2:
+            prefill, decoded = len(result[0]), len(result[1])
+        else:
+            prefill, decoded = 0, len(result)
+        if self.capacity is None:
+            self.capacity = getattr(generator, "completion_batch_size", None)
+        self._active, self._updated = decoded, end
+        elapsed = end - start
+        key = int(time.time() // self.BUCKET * self.BUCKET)
+        with self._lock:
+            if not self._series or self._series[-1][0] != key:
+                # time, steps, decode steps, batch sum, max batch, tokens, busy s, decode s
+                self._series.append([key, 0, 0, 0, 0, 0, 0.0, 0.0])
+            point = self._series[-1]
+            point[1] += 1
+            point[5] += decoded
+            point[6] += elapsed
+            if decoded:
+                point[2] += 1
+                point[3] += decoded
+                point[4] = max(point[4], decoded)
+                point[7] += elapsed
+                if not prefill:
+                    totals = self._by_size.setdefault(decoded, [0, 0.0])
+                    totals[0] += 1
+                    totals[1] += elapsed
+        return result
+
+    def current(self):
+        """Sequences in the latest decode step, or 0 when no batch is running."""
+        if time.perf_counter() - self._updated > self.FRESH:
+            return 0
+        return self._active
+
+    def report(self):
+        """Occupancy time series and tokens/step for /v1/metrics (None if never batched)."""
+        with self._lock:
+            series = [list(p) for p in self._series]
+            by_size = sorted((size, list(t)) for size, t in self._by_size.items())
+        if not series:
+            return None
+        points = []
+        for key, steps, decode_steps, batch_sum, max_batch, tokens, busy, decode_time in series:
+            points.append({
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(key)),
+                "steps": steps,
+                "avg_batch": round(batch_sum / decode_steps, 2) if decode_steps else 0,
+                "max_batch": max_batch,
+                "occupancy": (
+                    round(batch_sum / decode_steps / self.capacity, 3)
+                    if decode_steps and self.capacity else None
+                ),
+                "tokens": tokens,
+                "step_ms": round(decode_time / decode_steps * 1000, 2) if decode_steps else None,
+                "busy": round(min(1.0, busy / self.BUCKET), 3),
+            })
+        decode_steps = sum(p[2] for p in series)
+        tokens = sum(p[5] for p in series)
+        decode_time = sum(p[7] for p in series)
+        return {
+            "capacity": self.capacity,
+            "bucket_seconds": self.BUCKET,
+            "tokens_per_step": round(tokens / decode_steps, 2) if decode_steps else None,
+            "avg_step_ms": round(decode_time / decode_steps * 1000, 2) if decode_steps else None,
+            "tokens_per_sec": round(tokens / decode_time, 1) if decode_time else None,
+            "by_batch_size": [
+                {
+                    "batch_size": size,
+                    "steps": steps,
+                    "step_ms": round(seconds / steps * 1000, 2),
+                    # Whole batch vs. what each sequence in it sees
+                    "tokens_per_sec": round(size * steps / seconds, 1) if seconds else None,
+                    "per_request_tps": round(steps / seconds, 1) if seconds else None,
+                }
+                for size, (steps, seconds) in by_size
+            ],
+            "series": points,
+        }
+
+
+_batch_monitor = _BatchMonitor()
+
+
+# ---------------------------------------------------------------------------
+# 23. CONTEXT LENGTH AND KV-CACHE ESTIMATE  (module level)
+# ---------------------------------------------------------------------------
+# INSERT after the batch monitor (part of the section 2 block).
+#
+# Long conversations are what run big models out of memory, and prompt and
+# completion counts alone don't say how close a request came.  Every record
+# (section 4) now carries
+#   - context_tokens        prompt + completion: KV positions at the end
+#   - max_context           the model's max_position_embeddings (or equivalent)
+#   - context_utilization   context_tokens / max_context
+#   - kv_cache_bytes        estimated from layers, KV heads, head_dim, the
+#                           model's float dtype and --kv-bits/--kv-group-size
+# and /v1/metrics (section 7) adds summary["context"]: per model, average,
+# p95 and largest context, peak KV-cache bytes and a utilization histogram.
+
+# Config fields that give a model's trained context length, most specific first
+_CONTEXT_KEYS = (
+    "max_position_embeddings", "max_sequence_length", "max_seq_len",
+    "seq_length", "n_positions", "n_ctx",
+)
+
+
+def _config_value(config, *names):
+    """First of `names` set on a model config (object or dict), or on its text_config."""
+    sources = [config]
+    nested = config.get("text_config") if isinstance(config, dict) else getattr(config, "text_config", None)
+    if nested is not None:
+        sources.append(nested)
+    for source in sources:
+        for name in names:
+            value = source.get(name) if isinstance(source, dict) else getattr(source, name, None)
+            if value:
+                return value
+    return None
+
+
+class _KVCacheProfile:
+    """KV-cache footprint of a loaded model, from its config and cache layout.
+
+    Per token, each attention layer keeps keys and values for every KV head:
+    kv_heads x (head_dim + v_head_dim) elements in the model's float dtype,
+    or `kv_bits` bits plus a scale and bias per `kv_group_size` elements
+    once a --kv-bits cache passes --quantized-kv-start.  Caches grow in
+    STEP-token blocks; sliding-window layers (RotatingKVCache) stop at their
+    window, and recurrent-state layers (ArraysCache) are a fixed size and
+    left out.  An estimate of what a request's context occupies, not a
+    measurement of the allocator.
+    """
+
+    STEP = 256
+
+    def __init__(self, model, cli_args=None):
+        config = getattr(model, "args", None) or getattr(model, "config", None)
+        heads = _config_value(config, "num_attention_heads", "n_heads")
+        hidden = _config_value(config, "hidden_size", "dim")
+        self.kv_heads = _config_value(config, "num_key_value_heads", "n_kv_heads") or heads
+        self.head_dim = _config_value(config, "head_dim") or (hidden // heads if heads and hidden else None)
+        self.v_head_dim = _config_value(config, "v_head_dim") or self.head_dim
+        self.max_context = _config_value(config, *_CONTEXT_KEYS)
+        self.dtype_bytes = self._dtype_bytes(model)
+        self.full_layers, self.windows = self._layout(model)
+        self.kv_bits = getattr(cli_args, "kv_bits", None)
+        self.kv_group_size = getattr(cli_args, "kv_group_size", None) or 64
+        self.quantized_start = getattr(cli_args, "quantized_kv_start", None) or 0
+
+    @staticmethod
+    def _dtype_bytes(model):
+        """Bytes per element of the model's float dtype (keys/values are kept in it)."""
+        try:
+            import mlx.core as mx
+            from mlx.utils import tree_flatten
+            for _, p in tree_flatten(model.parameters()):
+                if mx.issubdtype(p.dtype, mx.floating):
+                    return p.dtype.size
+        except Exception:
+            pass
+        return 2
+
+    @staticmethod
+    def _layout(model):
+        """(layers whose cache grows with the context, window sizes of the bounded ones)."""
+        try:
+            caches = model.make_cache() if hasattr(model, "make_cache") else [None] * len(model.layers)
+        except Exception:
+            caches = [None] * len(getattr(model, "layers", ()))
+        full, windows = 0, []
+        pending = list(caches)
+        while pending:
+            cache = pending.pop()
+            kind = type(cache).__name__
+            if kind == "CacheList":
+                pending.extend(getattr(cache, "caches", ()))
+            elif kind in ("ArraysCache", "MambaCache"):
+                continue
+            elif getattr(cache, "max_size", None):
+                windows.append(cache.max_size)
+            else:
+                full += 1
+        return full, windows
+
+    def kv_bytes(self, tokens):
+        """Estimated KV-cache bytes for a context of `tokens` positions."""
+        if not (self.kv_heads and self.head_dim) or tokens <= 0:
+            return None
+        elements = self.kv_heads * (self.head_dim + self.v_head_dim)
+        if self.kv_bits and tokens >= self.quantized_start:
+            per_element = self.kv_bits / 8 + 2 * self.dtype_bytes / self.kv_group_size
+        else:
+            per_element = self.dtype_bytes
+        allocated = -(-tokens // self.STEP) * self.STEP
+        positions = self.full_layers * allocated + sum(min(allocated, w) for w in self.windows)
+        return int(positions * elements * per_element)
+
+
+_kv_profiles = {}   # id(model) -> (model, _KVCacheProfile); replaced when models swap
+
+
+def _kv_profile(handler):
+    """The _KVCacheProfile of the model the provider has loaded, built on first use."""
+    provider = _model_provider(handler)
+    model = getattr(provider, "model", None)
+    if model is None:
+        return None
+    entry = _kv_profiles.get(id(model))
+    if entry is None or entry[0] is not model:
+        try:
+            profile = _KVCacheProfile(model, getattr(provider, "cli_args", None))
+        except Exception as e:
+            logging.debug(f"KV-cache profile unavailable: {e}")
+            profile = None
+        # Only the loaded model matters; don't keep swapped-out ones alive
+        _kv_profiles.clear()
+        entry = _kv_profiles[id(model)] = (model, profile)
+    return entry[1]
+
+
+def _context_fields(handler, context_tokens):
+    """Record fields: context length, its share of the model's max, and KV-cache bytes."""
+    profile = _kv_profile(handler)
+    max_context = profile.max_context if profile else None
+    return {
+        "context_tokens": context_tokens,
+        "max_context": max_context,
+        "context_utilization": round(context_tokens / max_context, 4) if max_context else None,
+        "kv_cache_bytes": profile.kv_bytes(context_tokens) if profile else None,
+    }
+
+
+# Upper edges of the context-utilization histogram buckets
+_UTILIZATION_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+
+def _context_summary(metrics):
+    """Per-model context length, KV-cache peak and utilization histogram for /v1/metrics."""
+    labels, lower = [], 0
+    for upper in _UTILIZATION_BUCKETS:
+        labels.append(f"{round(lower * 100)}-{round(upper * 100)}%")
+        lower = upper
+    labels.append(f">{round(lower * 100)}%")
+    by_model = {}
+    for m in metrics:
+        if m.get("context_tokens") is not None:
+            by_model.setdefault(m["model"], []).append(m)
+    summary = {}
+    for model, records in by_model.items():
+        contexts = sorted(m["context_tokens"] for m in records)
+        kv = [m["kv_cache_bytes"] for m in records if m.get("kv_cache_bytes")]
+        histogram = dict.fromkeys(labels, 0)
+        for m in records:
+            u = m.get("context_utilization")
+            if u is None:
+                continue
+            i = 0
+            while i < len(_UTILIZATION_BUCKETS) and u > _UTILIZATION_BUCKETS[i]:
+                i += 1
+            histogram[labels[i]] += 1
+        summary[model] = {
+            "requests": len(records),
+            "max_context": records[-1].get("max_context"),
+            "avg_context_tokens": round(sum(contexts) / len(contexts)),
+            "p95_context_tokens": contexts[int(round(0.95 * (len(contexts) - 1)))],
+            "max_context_tokens": contexts[-1],
+            "peak_kv_cache_bytes": max(kv) if kv else None,
+            "utilization": histogram if any(histogram.values()) else None,
+        }
+    return summary
+
+
+# ---------------------------------------------------------------------------
+# 24. MODEL LOADS, COLD REQUESTS AND STARTUP WARM-UP  (module level + ModelProvider + run())
+# ---------------------------------------------------------------------------
+# Shared runtime: _weight_bytes, _ColdStart and _cold are defined in
+# _cockpit_common.py; _WarmUp below is specific to this server.
+#
+# The first request after a restart or a model swap pays for the load and
+# for kernel compilation, and its latency skews every average and alert.
+# The stock ModelProvider.load() is renamed to _load_model() behind a
+# wrapper that times each call that swaps a model in, sums the weight
+# bytes of the model (and draft model), and reports both to _cold.  Every
+# record (section 4) then carries
+#   - cold              a load finished while it ran, or it is one of the
+#                       first MLX_COCKPIT_COLD_REQUESTS (default 1) after one
+#   - model_load_time   seconds of load it waited for (only when it did)
+# Cold records are skipped by alert rules (section 17) and baselines
+# (section 18), and /v1/metrics (section 7) adds summary["cold_start"]:
+# cold and warm aggregates side by side, the last 20 loads and the
+# warm-up state.
+#
+# MLX_COCKPIT_WARMUP=<max tokens> sends one short chat completion to the
+# server right after it binds (section 16); the stock handle_health_check()
+# is renamed to _handle_health_check() and /health answers 503
+# {"status": "warming up"} until that request is done.
+#
+# The handle_completion() wrapper (section 10) also counts the real
+# completions still running in _in_flight, reported as summary["in_flight"].
+# collector.py --canary holds its probe while that is non-zero.  Canary and
+# warm-up requests (_synthetic()) are not counted.
+
+class _WarmUp:
+    """Optional startup warm-up (MLX_COCKPIT_WARMUP=<max tokens>).
+
+    Once the server is bound, a background thread sends it one short chat
+    completion so the first real request finds kernels compiled and buffers
+    allocated; /health answers 503 until that request has finished.  The
+    warm-up is not recorded and does not count as a cold request.
+    """
+
+    HEADER = "X-MLX-Cockpit-Warmup"
+    TIMEOUT = 600
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.running = False
+        self.state = "off" if tokens <= 0 else "pending"
+        self.seconds = None
+
+    def start(self, address):
+        if self.tokens <= 0:
+            return
+        self.running = True
+        threading.Thread(target=self._run, args=(address,), name="mlx-cockpit-warmup", daemon=True).start()
+
+    def _run(self, address):
+        host, port = address[0], address[1]
+        # A wildcard bind is reachable on loopback
+        host = {"": "127.0.0.1", "0.0.0.0": "127.0.0.1", "::": "::1"}.get(host, host)
+        if ":" in host:
+            host = f"[{host}]"
+        body = json.dumps({
+            "messages": [{"role": "user", "content": "Hello"}],
+            "max_tokens": self.tokens,
+            "temperature": 0.0,
+        }).encode()
+        request = urllib.request.Request(
+            f"http://{host}:{port}/v1/chat/completions", data=body,
+            headers={"Content-Type": "application/json", self.HEADER: "1"},
+        )
+        start = time.perf_counter()
+        try:
+            urllib.request.urlopen(request, timeout=self.TIMEOUT).read()
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            logging.warning(f"Warm-up request failed ({e}); reporting healthy anyway")
+        finally:
+            self.seconds = round(time.perf_counter() - start, 3)
+            self.running = False
+        if self.state == "done":
+            logging.info(f"Warm-up finished in {self.seconds:.2f}s")
+
+    def describe(self):
+        if self.tokens <= 0:
+            return None
+        return {
+            "max_tokens": self.tokens,
+            "state": "running" if self.running else self.state,
+            "seconds": self.seconds,
+        }
+
+
+_warmup = _WarmUp(tokens=int(os.environ.get("MLX_COCKPIT_WARMUP", "0")))
+
+
+def _synthetic(headers):
+    """A collector canary or the startup warm-up rather than real traffic."""
+    return bool(headers.get("X-MLX-Cockpit-Canary") or headers.get(_WarmUp.HEADER))
+
+
+class _InFlight:
+    """Real completions still being generated, reported as summary["in_flight"].
+
+    Finished records only show work that is over; the collector's canary
+    (collector.py --canary) also waits while this is non-zero, so a long
+    generation still running defers the probe instead of sharing the GPU
+    with it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def enter(self):
+        with self._lock:
+            self.count += 1
+
+    def exit(self):
+        with self._lock:
+            self.count -= 1
+
+
+_in_flight = _InFlight()
+
+
+# ModelProvider: the stock `def load(self, model_path, ...)` becomes
+# `def _load_model(self, model_path, ...)`, preceded by:
+
+def load(self, *args, **kwargs):
+    """Run the stock loader (_load_model), timing it whenever it swaps a model in."""
+    before = getattr(self, "model", None)
+    start = time.perf_counter()
+    result = self._load_model(*args, **kwargs)
+    if self.model is not None and self.model is not before:
+        name = (getattr(self, "model_key", None) or (None,))[0]
+        if name in (None, "default_model"):
+            name = getattr(self.cli_args, "model", None) or "default_model"
+        _cold.loaded(
+            name,
+            time.perf_counter() - start,
+            _weight_bytes(self.model, getattr(self, "draft_model", None)),
+        )
+    return result
+
+
+# APIHandler: the stock `def handle_health_check(self)` becomes
+# `def _handle_health_check(self)`, preceded by:
+
+def handle_health_check(self):
+    """Answer 503 while the startup warm-up runs, then defer to the stock check."""
+    if _warmup.running:
+        self._set_completion_headers(503)
+        self.end_headers()
+        self.wfile.write(json.dumps({"status": "warming up"}).encode())
+        self.wfile.flush()
+        return
+    return self._handle_health_check()
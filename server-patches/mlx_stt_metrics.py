@@ -0,0 +1,549 @@
+"""
+mlx_stt_metrics.py  --  Metrics additions for mlx_audio/server.py
+=================================================================
+
+This module contains every metrics-related addition that must be patched into
+the stock mlx-audio server (mlx_audio/server.py) to monitor speech-to-text
+(Whisper and friends).  Each section is annotated with the exact insertion
+point so the changes can be applied manually or with a script.
+
+Unlike the mlx_vlm patch, no endpoint bodies are edited: an ASGI middleware
+scopes per-request stats and the loaded models' generate() is wrapped, so
+every transcription is recorded automatically.
+
+Target file: mlx_audio/server.py
+Server type: FastAPI + Uvicorn (async)
+"""
+
+# ---------------------------------------------------------------------------
+# 1. IMPORTS
+# ---------------------------------------------------------------------------
+# Inserted together with the store (section 3), after the runtime shared with
+# the other patches, which lives in _cockpit_common.py.
+
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from collections import deque
+
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from _cockpit_common import (
+    _AlertEngine,
+    _clients,
+    _MetricsRecorder,
+    _profiler,
+    _registry,
+    _scope_client,
+    _tracer,
+)
+
+
+# ---------------------------------------------------------------------------
+# 2. CORS MIDDLEWARE
+# ---------------------------------------------------------------------------
+# The stock mlx_audio server already installs CORSMiddleware.  If it does not,
+# INSERT right after the `app = FastAPI(...)` declaration:
+#
+#   app.add_middleware(
+#       CORSMiddleware,
+#       allow_origins=["*"],
+#       allow_methods=["GET"],
+#       allow_headers=["*"],
+#   )
+
+
+# ---------------------------------------------------------------------------
+# 3. METRICS STORE, REQUEST MIDDLEWARE AND RECORDING FUNCTION
+# ---------------------------------------------------------------------------
+# INSERT before the first `@app.` route, i.e. after `app = FastAPI(...)`,
+# its middleware and `model_provider = ModelProvider()`.
+
+# The optional shared-memory store is the `_SharedMetricsStore` class from
+# _cockpit_common.py, which the patch inserts ahead of this block.
+#
+#   if os.environ.get("MLX_COCKPIT_SHM"):
+#       _stt_metrics_store = _SharedMetricsStore(
+#           os.environ["MLX_COCKPIT_SHM"],
+#           capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+#       )
+#   else:
+#       _stt_metrics_store: deque = deque(maxlen=200)
+_stt_metrics_store: deque = deque(maxlen=200)
+
+# Each record keeps the common fields (prompt_tokens is always 0, and
+# completion_tokens counts the decoded text tokens of all segments, or the
+# streamed chunks when they carry no token ids) plus:
+#   - audio_duration  seconds of input audio (soundfile/wave header, sample
+#                     count of a raw array, or the last segment's end)
+#   - decode_time     seconds spent in model.generate(), plus iterating its
+#                     result when the model streams a generator
+#   - rtf             real-time factor, decode_time / audio_duration;
+#                     below 1 is faster than real time
+#   - segments, language
+
+_STT_PATHS = ("/audio/transcriptions", "/audio/translations")
+_STT_SAMPLE_RATE = 16000  # what STT models resample to; used for raw arrays
+
+_current_stt = contextvars.ContextVar("mlx_cockpit_stt", default=None)
+
+
+class _STTStats:
+    """What one transcription request decoded, filled in by the model wrapper."""
+
+    __slots__ = ("model", "client", "audio_duration", "decode_time", "result", "calls", "chunks", "trace")
+
+    def __init__(self):
+        self.model = None
+        self.client = None
+        self.audio_duration = 0.0
+        self.decode_time = 0.0
+        self.result = None
+        self.calls = 0
+        self.chunks = 0
+        self.trace = None  # sampled _Trace; rides with the stats onto decode threads
+
+
+def _audio_duration(audio):
+    """Seconds of audio in a file path or a raw sample array, or None."""
+    if isinstance(audio, (str, os.PathLike)):
+        try:
+            import soundfile
+            return soundfile.info(audio).duration
+        except Exception:
+            pass
+        try:
+            import wave
+            with wave.open(os.fspath(audio), "rb") as w:
+                return w.getnframes() / w.getframerate()
+        except Exception:
+            return None
+    shape = getattr(audio, "shape", None)
+    if shape:
+        return max(shape) / _STT_SAMPLE_RATE
+    return None
+
+
+def _transcript_fields(result):
+    """Segments, output tokens, language and covered duration of an STT result."""
+    get = result.get if isinstance(result, dict) else (lambda key: getattr(result, key, None))
+    segments = [s for s in (get("segments") or []) if isinstance(s, dict)]
+    return {
+        "segments": len(segments),
+        "output_tokens": sum(len(s.get("tokens") or []) for s in segments),
+        "language": get("language"),
+        "end": max((s.get("end") or 0.0 for s in segments), default=0.0),
+    }
+
+
+def _record_stt_metric(stats, latency):
+    """Append one transcription request's metrics to the ring buffer."""
+    fields = _transcript_fields(stats.result)
+    # Fall back to the last segment's end when the input could not be measured
+    audio = stats.audio_duration or fields["end"]
+    decode = stats.decode_time
+    # Streamed text carries no token ids: count its chunks instead
+    tokens = fields["output_tokens"] or stats.chunks
+    record = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "model": (stats.model.split("/")[-1] if stats.model else "unknown"),
+        "client": stats.client,  # section 9
+        "prompt_tokens": 0,
+        "completion_tokens": tokens,
+        "total_tokens": tokens,
+        "latency": round(latency, 2),
+        "tokens_per_sec": round(tokens / decode, 2) if decode > 0 else 0,
+        "audio_duration": round(audio, 2),
+        "decode_time": round(decode, 3),
+        "rtf": round(decode / audio, 3) if audio > 0 else None,
+        "segments": fields["segments"],
+        "language": fields["language"],
+    }
+    _stt_recorder.append(record)  # section 8; feeds _alerts
+    _registry.set_model(stats.model)
+
+
+class _STTMiddleware:
+    """ASGI middleware giving each transcription request its own stats, recorded on success."""
+
+    _unseen_logged = False
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+            # No --port on the command line: register from the first request's socket
+            _registry.register("mlx_audio", "STT", scope["server"][1])
+        if (
+            scope["type"] != "http"
+            or scope.get("method") != "POST"
+            or not scope.get("path", "").endswith(_STT_PATHS)
+        ):
+            return await self.app(scope, receive, send)
+        stats = _STTStats()
+        stats.client = _scope_client(scope)  # section 9
+        stats.trace = trace = _tracer.begin("request", path=scope.get("path"))  # section 10
+        status = {}
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            if trace is None or message["type"] != "http.response.body":
+                return await send(message)
+            sent = time.perf_counter()
+            try:
+                await send(message)
+            finally:
+                trace.add_span(
+                    "socket_write", sent, time.perf_counter(),
+                    bytes=len(message.get("body", b"")),
+                )
+
+        start = time.perf_counter()
+        token = _current_stt.set(stats)
+        try:
+            await self.app(scope, receive, capture_send)
+        finally:
+            _current_stt.reset(token)
+            _tracer.end(trace)
+        if status.get("code", 500) >= 400:
+            return
+        if stats.calls:
+            _record_stt_metric(stats, time.perf_counter() - start)
+        elif not _STTMiddleware._unseen_logged:
+            _STTMiddleware._unseen_logged = True
+            logging.warning(
+                f"mlx-cockpit: {scope['path']} finished without an instrumented generate() "
+                "call; this server version decodes somewhere the patch does not reach, "
+                "so transcriptions are not recorded"
+            )
+
+
+
+# Registered right after the class:
+#
+#   app.add_middleware(_STTMiddleware)
+
+
+# ---------------------------------------------------------------------------
+# 4. MODEL INSTRUMENTATION
+# ---------------------------------------------------------------------------
+# INSERT with section 3.  `_instrument_stt_models()` wraps
+# ModelProvider.load_model() (and module-level load_model/load_stt_model
+# helpers, if the server version has them) so each model they return gets a
+# timed generate().  On mlx-audio 0.5+, where an InferenceBroker decodes on
+# its own thread, it also wraps InferenceBroker.submit() and
+# STTExecutionAdapter.run_serial() so the request's stats travel with the
+# work item.  It is CALLED once at the end of the module, just before
+# `if __name__ == "__main__":`:
+#
+#   # Time every STT model's generate() per request
+#   _instrument_stt_models()
+
+def _timed_stream(chunks, stats):
+    """Pass a streaming generate() result through, timing each decode step.
+
+    Streaming models return a generator and decode as it is consumed, so the
+    time spent in generate() itself is only setup. The chunks seen are kept as
+    the request's result once the stream ends or is abandoned.
+    """
+    segments = []
+    language = None
+    first = last = None
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                last = time.perf_counter()
+                first = first or start
+                stats.decode_time += last - start
+            stats.chunks += 1
+            if not isinstance(chunk, str):
+                language = getattr(chunk, "language", None) or language
+                if getattr(chunk, "is_final", True) is not False:
+                    segments.append({
+                        "start": getattr(chunk, "start_time", None),
+                        "end": getattr(chunk, "end_time", None),
+                        "tokens": list(getattr(chunk, "tokens", None) or []),
+                    })
+            yield chunk
+    finally:
+        stats.result = {"segments": segments, "language": language}
+        if stats.trace is not None and first is not None:
+            stats.trace.add_span("decode", first, last, chunks=stats.chunks)
+
+
+def _instrument_stt_model(model, name):
+    """Time model.generate() and keep its result for the current request."""
+    if model is None or getattr(model, "_cockpit_timed", False) or not hasattr(model, "generate"):
+        return
+    base = type(model)
+
+    # wraps() keeps generate()'s signature visible: servers filter kwargs by it
+    @functools.wraps(base.generate)
+    def generate(self, audio, *args, **kwargs):
+        stats = _current_stt.get()
+        if stats is None:
+            return base.generate(self, audio, *args, **kwargs)
+        duration = _audio_duration(audio)
+        start = time.perf_counter()
+        result = base.generate(self, audio, *args, **kwargs)
+        end = time.perf_counter()
+        stats.decode_time += end - start
+        if stats.trace is not None:
+            stats.trace.add_span("generate", start, end, audio_seconds=duration)
+        stats.audio_duration += duration or 0.0
+        stats.model = stats.model or self._cockpit_model_name
+        stats.calls += 1
+        if hasattr(result, "__next__"):
+            return _timed_stream(result, stats)
+        stats.result = result
+        return result
+
+    model.__class__ = type(base.__name__, (base,), {"generate": generate, "_cockpit_timed": True})
+    model._cockpit_model_name = name
+
+
+def _instrument_stt_broker():
+    """Carry request stats across the inference broker (mlx-audio 0.5+).
+
+    The broker decodes on its own worker thread, which the request's context
+    never reaches: the stats ride on the submitted payload and are restored
+    around the STT adapter's run.
+    """
+    broker = globals().get("InferenceBroker")
+    submit = getattr(broker, "submit", None)
+    if submit is not None:
+        def submit_with_stats(self, *args, **kwargs):
+            stats = _current_stt.get()
+            payload = kwargs.get("payload")
+            if stats is not None and payload is not None:
+                try:
+                    payload._cockpit_stt = stats
+                except AttributeError:
+                    pass  # slotted payload: the request goes unrecorded
+            return submit(self, *args, **kwargs)
+        broker.submit = submit_with_stats
+
+    adapter = globals().get("STTExecutionAdapter")
+    run_serial = getattr(adapter, "run_serial", None)
+    if run_serial is not None:
+        def run_serial_with_stats(self, request, *args, **kwargs):
+            token = _current_stt.set(getattr(getattr(request, "payload", None), "_cockpit_stt", None))
+            try:
+                return run_serial(self, request, *args, **kwargs)
+            finally:
+                _current_stt.reset(token)
+        adapter.run_serial = run_serial_with_stats
+
+
+def _instrument_stt_models():
+    """Wrap the server's model loaders so every loaded model is timed (called at module end)."""
+    def first_str(args):
+        return next((a for a in args if isinstance(a, str)), None)
+
+    _instrument_stt_broker()
+
+    provider = globals().get("ModelProvider")
+    method = getattr(provider, "load_model", None)
+    if method is not None:
+        def load_model(self, *args, **kwargs):
+            model = method(self, *args, **kwargs)
+            _instrument_stt_model(model, first_str(args) or kwargs.get("model_name"))
+            return model
+        provider.load_model = load_model
+
+    for name in ("load_model", "load_stt_model"):
+        loader = globals().get(name)
+        if not callable(loader):
+            continue
+
+        def instrumented(*args, _loader=loader, **kwargs):
+            model = _loader(*args, **kwargs)
+            _instrument_stt_model(model, first_str(args))
+            return model
+        globals()[name] = instrumented
+
+
+# ---------------------------------------------------------------------------
+# 5. /v1/metrics AND /dashboard ENDPOINTS
+# ---------------------------------------------------------------------------
+# INSERT right after section 3, before the server's first route.
+#
+#   @app.get("/v1/metrics")
+async def metrics_endpoint():
+    """Return recent transcription metrics and summary."""
+    # Merging may wait on the shared-memory flock; keep it off the event loop
+    requests_list = await asyncio.to_thread(_stt_recorder.snapshot)  # section 8
+    total = len(requests_list)
+    audio = sum(r["audio_duration"] for r in requests_list)
+    decode = sum(r["decode_time"] for r in requests_list)
+    return {
+        "requests": requests_list,
+        "summary": {
+            "total_requests": total,
+            "avg_tokens_per_sec": (
+                round(sum(r["tokens_per_sec"] for r in requests_list) / total, 2) if total else 0
+            ),
+            "total_prompt_tokens": 0,
+            "total_completion_tokens": sum(r["completion_tokens"] for r in requests_list),
+            "total_audio_seconds": round(audio, 2),
+            "total_decode_time": round(decode, 3),
+            # Aggregate RTF (decode seconds per audio second); <1 is faster than real time
+            "avg_rtf": round(decode / audio, 3) if audio > 0 else None,
+            "total_segments": sum(r["segments"] for r in requests_list),
+        },
+        "alerts": _alerts.snapshot(),  # section 7
+        "clients": _clients.report(top=5, windows=("15m",)),  # section 9
+    }
+
+
+# The dashboard route serves dashboard/index.html, embedded as
+# _STT_DASHBOARD_HTML, exactly like the mlx_vlm patch:
+#
+#   @app.get("/dashboard", response_class=HTMLResponse)
+#   async def dashboard_endpoint():
+#       """Serve a live HTML dashboard that polls /v1/metrics."""
+#       return _STT_DASHBOARD_HTML
+
+
+# ---------------------------------------------------------------------------
+# 6. SERVICE REGISTRY AND /v1/registry ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_ServiceRegistry`, `_registry` and `_cli_port` are defined
+# in _cockpit_common.py.  The server announces itself in
+# ~/.mlx-cockpit/registry (same format as the mlx_lm patch) so the widget and
+# dashboard find it on any port without scanning.
+#
+# The port comes from `--port` on the command line, registered at the end of
+# the module (after _instrument_stt_models()):
+#
+#   # Publish this server in the service registry (see _ServiceRegistry)
+#   _registry.register("mlx_audio", "STT", _cli_port())
+#
+# Without `--port` (e.g. the default port), _STTMiddleware (section 3) registers
+# from the first request's socket instead, at the top of __call__:
+#
+#   if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+#       _registry.register("mlx_audio", "STT", scope["server"][1])
+#
+# _record_stt_metric() also calls `_registry.set_model(...)` so the entry names the
+# model that is actually serving.
+
+# MLX_COCKPIT_REGISTRY=<dir> moves the registry; MLX_COCKPIT_REGISTRY=off disables it.
+#   @app.get("/v1/registry")
+async def registry_endpoint():
+    """Return the MLX servers registered on this host (self-registration)."""
+    return {"services": _registry.live()}
+
+
+# ---------------------------------------------------------------------------
+# 7. ALERT RULES
+# ---------------------------------------------------------------------------
+# INSERT with section 3.  The `_AlertEngine` class is defined in
+# _cockpit_common.py (threshold and rate-of-change rules per model, with
+# hysteresis, delivered to MLX_COCKPIT_ALERT_WEBHOOK /
+# MLX_COCKPIT_ALERT_COMMAND from a background thread).
+#
+# The recorder (section 8) feeds each new record to the rules, and
+# /v1/metrics reports the state as a top-level "alerts" key.
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_audio")
+
+
+# ---------------------------------------------------------------------------
+# 8. CONTENTION-FREE RECORDING
+# ---------------------------------------------------------------------------
+# INSERT with section 3, after the alert rules (section 7).  The
+# `_MetricsRecorder` class is defined in _cockpit_common.py.
+#
+# The middleware records on the event loop, so _record_stt_metric() only
+# appends to the recorder's pending deque.  A background tick drains it into
+# _stt_metrics_store and feeds the alert rules; /v1/metrics merges on a
+# worker thread (asyncio.to_thread).
+
+# Recording never blocks the event loop; alert rules see each record on the recorder's tick.
+_stt_recorder = _MetricsRecorder(_stt_metrics_store, observers=(_alerts.observe, _clients.observe))
+
+
+# ---------------------------------------------------------------------------
+# 9. PER-CLIENT ACCOUNTING AND /v1/metrics/clients ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_client_identity`, `_SpaceSaving`, `_ClientAccounting`,
+# `_clients` and `_scope_client` (which identifies an ASGI request from its
+# scope) are defined in _cockpit_common.py.  The recorder (section 8) feeds
+# `_clients.observe`.
+#
+# _STTStats has a `client` slot, which the middleware (section 3) fills in
+# before calling the app and _record_stt_metric() copies into the record.
+#
+# /v1/metrics (section 5) adds the last 15 minutes' top 5 as "clients", and
+# the full report has its own route:
+#
+#   @app.get("/v1/metrics/clients")
+#   async def clients_endpoint(top: int = 10):
+#       """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+#       return _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+
+
+# ---------------------------------------------------------------------------
+# 10. REQUEST TRACING AND /v1/trace ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_Trace`, `_Tracer` and `_tracer` are defined in
+# _cockpit_common.py.  Sampling is controlled by MLX_COCKPIT_TRACE_SAMPLE
+# (0.0-1.0, default 0 = off).
+#
+# _STTMiddleware (section 3) opens the trace and times each ASGI body send as
+# a "socket_write" span.  The trace rides in the `trace` slot of _STTStats
+# rather than in `_current_trace`, so it reaches the inference broker's thread
+# with the stats (section 4), where the model wrapper adds:
+#   - generate   the generate() call itself
+#   - decode     first to last step of a streamed result, with its chunk count
+#
+# The route sits next to /v1/metrics:
+
+async def trace_endpoint():
+    """
+    Return sampled request traces as Chrome trace-event JSON.
+
+    Register with:  @app.get("/v1/trace")
+    """
+    return _tracer.export()
+
+
+# ---------------------------------------------------------------------------
+# 11. SAMPLING PROFILER AND /v1/profile ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_SamplingProfiler` and `_profiler` are defined in
+# _cockpit_common.py.  Disabled unless the server is started with
+# MLX_COCKPIT_PROFILE=1.  Sampling runs on a worker thread, so the event loop
+# thread -- and, on mlx-audio 0.5+, the inference broker's thread -- show up
+# in the profile.
+
+async def profile_endpoint(seconds: float = 10.0, hz: int = 100, format: str = "json"):
+    """
+    Sample every thread's stack (MLX_COCKPIT_PROFILE=1); format=collapsed for flamegraphs.
+
+    Register with:  @app.get("/v1/profile")
+    """
+    if not _profiler.enabled:
+        return JSONResponse(
+            {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"},
+            status_code=403,
+        )
+    # Sample from a worker thread so the event loop itself shows up in the profile
+    data = await asyncio.to_thread(_profiler.run, seconds, hz)
+    if data is None:
+        return JSONResponse({"error": "A profile is already running"}, status_code=409)
+    if format == "collapsed":
+        return PlainTextResponse(data["collapsed"])
+    return data
@@ -22,8 +22,31 @@ Server type: FastAPI + Uvicorn (async)
 #   from collections import deque
 #   from fastapi.middleware.cors import CORSMiddleware
 
+import asyncio
+import contextvars
+import os
+import sys
 import time
 from collections import deque
+from contextlib import contextmanager, nullcontext
+
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+# The runtime shared with the other patches lives in _cockpit_common.py; the
+# patch script inserts it at the top of the section 3 block.
+from _cockpit_common import (
+    _AlertEngine,
+    _clients,
+    _cold,
+    _current_trace,
+    _MetricsRecorder,
+    _profiler,
+    _registry,
+    _scope_client,
+    _trace_stage,
+    _tracer,
+    _weight_bytes,
+)
 
 
 # ---------------------------------------------------------------------------
@@ -54,21 +77,42 @@ from collections import deque
 # before the first class/function definition (e.g. before FlexibleBaseModel
 # or load_model_resources).
 
+# The optional shared-memory store is the `_SharedMetricsStore` class from
+# _cockpit_common.py, which the patch inserts ahead of this block.  Under `uvicorn --workers N` each worker is a
+# separate process, so without it /v1/metrics only reports one worker's slice.
+
 # --- Metrics store (mirrors mlx_lm server format) ---
+# Set MLX_COCKPIT_SHM=<name> to share one store between all uvicorn workers on
+# the host; otherwise each worker only sees the requests it served itself.
+#
+#   if os.environ.get("MLX_COCKPIT_SHM"):
+#       _vlm_metrics_store = _SharedMetricsStore(
+#           os.environ["MLX_COCKPIT_SHM"],
+#           capacity=int(os.environ.get("MLX_COCKPIT_SHM_SLOTS", "200")),
+#       )
+#   else:
+#       _vlm_metrics_store: deque = deque(maxlen=200)
 _vlm_metrics_store: deque = deque(maxlen=200)
 
 
 def _record_vlm_metric(model, prompt_tokens, completion_tokens, latency, tokens_per_sec):
-    """Append one request's metrics to the in-memory ring buffer."""
-    _vlm_metrics_store.append({
+    """Append one request's metrics (plus its vision stage stats) to the ring buffer."""
+    record = {
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
         "model": (model.split("/")[-1] if model else "unknown"),
+        "client": _current_client.get(),  # section 16
         "prompt_tokens": int(prompt_tokens or 0),
         "completion_tokens": int(completion_tokens or 0),
         "total_tokens": int((prompt_tokens or 0) + (completion_tokens or 0)),
         "latency": round(latency, 2),
         "tokens_per_sec": round(tokens_per_sec or 0, 2),
-    })
+    }
+    vision = _current_vision.get()
+    if vision is not None:
+        record.update(vision.fields())
+    record.update(_cold.claim(_current_load.get(_cold.generation)))  # section 17
+    _vlm_recorder.append(record)  # section 15; feeds _alerts
+    _registry.set_model(record["model"])
 
 
 # ---------------------------------------------------------------------------
@@ -183,7 +227,8 @@ async def metrics_endpoint():
 
     Register with:  @app.get("/v1/metrics")
     """
-    requests_list = list(_vlm_metrics_store)
+    # Merging may wait on the shared-memory flock; keep it off the event loop
+    requests_list = await asyncio.to_thread(_vlm_recorder.snapshot)  # section 15
     total = len(requests_list)
     if total > 0:
         avg_tps = sum(r["tokens_per_sec"] for r in requests_list) / total
@@ -193,6 +238,10 @@ async def metrics_endpoint():
         avg_tps = 0
         total_prompt = 0
         total_completion = 0
+    vision = [r for r in requests_list if r.get("image_count")]
+
+    def vision_avg(key):
+        return round(sum(r.get(key, 0) for r in vision) / len(vision), 3) if vision else 0
 
     return {
         "requests": requests_list,
@@ -201,5 +250,474 @@ async def metrics_endpoint():
             "avg_tokens_per_sec": round(avg_tps, 2),
             "total_prompt_tokens": total_prompt,
             "total_completion_tokens": total_completion,
+            "image_requests": len(vision),
+            "total_images": sum(r["image_count"] for r in vision),
+            "avg_image_pixels": int(vision_avg("image_pixels")),
+            "avg_image_load_time": vision_avg("image_load_time"),
+            "avg_preprocess_time": vision_avg("preprocess_time"),
+            "avg_vision_encode_time": vision_avg("vision_encode_time"),
+            "cold_start": _cold.summary(requests_list),  # section 17
         },
+        "alerts": _alerts.snapshot(),  # section 14
+        "clients": _clients.report(top=5, windows=("15m",)),  # section 16
     }
+
+
+# ---------------------------------------------------------------------------
+# 9. REQUEST TRACING
+# ---------------------------------------------------------------------------
+# Shared runtime: `_Trace`, `_Tracer`, `_tracer`, `_current_trace` and the
+# `_trace_stage` / `_trace_mark` / `_trace_token` hooks are defined in
+# _cockpit_common.py.  Sampling is controlled by
+# MLX_COCKPIT_TRACE_SAMPLE (0.0-1.0, default 0 = off).
+#
+# Sampled POST requests get a root span from the request middleware plus one
+# span per ASGI body send (the socket writes).  The finer stages come from the
+# wrappers `_instrument_vision_pipeline()` (section 12) puts around the
+# server's own functions, so the endpoints need no hooks:
+#   - load_model      get_cached_model() (or load_model_resources())
+#   - chat_template   apply_chat_template()
+#   - image_load, preprocess, vision_encode
+#                     load_image(), prepare_inputs(), the vision tower
+#   - prefill/decode  stream_generate(): its first chunk ends prefill, its last
+#                     ends decode
+#   - generate        generate() (non-streaming; not split into prefill/decode)
+# `_trace_stage()` / `_trace_mark()` / `_trace_token()` stay available for
+# stages a server version adds outside these functions.
+
+# Sampled traces are opened by `_RequestMiddleware` (section 12), which also
+# times each ASGI body send as a "socket_write" span.
+
+
+# ---------------------------------------------------------------------------
+# 10. /v1/trace ENDPOINT
+# ---------------------------------------------------------------------------
+# INSERT next to /v1/metrics.
+
+async def trace_endpoint():
+    """
+    Return sampled request traces as Chrome trace-event JSON.
+
+    Register with:  @app.get("/v1/trace")
+    """
+    return _tracer.export()
+
+
+# ---------------------------------------------------------------------------
+# 11. SAMPLING PROFILER AND /v1/profile ENDPOINT
+# ---------------------------------------------------------------------------
+# INSERT the `_SamplingProfiler` class and `_profiler` instance (identical to
+# section 12 of mlx_lm_metrics.py) after the tracer, and the route next to
+# /v1/metrics.  Disabled unless the server is started with
+# MLX_COCKPIT_PROFILE=1.  Sampling runs on a worker thread, so the event loop
+# thread is itself visible in the profile -- which is what you want when a
+# handler blocks the loop.
+
+async def profile_endpoint(seconds: float = 10.0, hz: int = 100, format: str = "json"):
+    """
+    Sample every thread's stack (MLX_COCKPIT_PROFILE=1); format=collapsed for flamegraphs.
+
+    Register with:  @app.get("/v1/profile")
+    """
+    if not _profiler.enabled:
+        return JSONResponse(
+            {"error": "Profiling is disabled; start the server with MLX_COCKPIT_PROFILE=1"},
+            status_code=403,
+        )
+    # Sample from a worker thread so the event loop itself shows up in the profile
+    data = await asyncio.to_thread(_profiler.run, seconds, hz)
+    if data is None:
+        return JSONResponse({"error": "A profile is already running"}, status_code=409)
+    if format == "collapsed":
+        return PlainTextResponse(data["collapsed"])
+    return data
+
+
+# ---------------------------------------------------------------------------
+# 12. VISION PIPELINE METRICS
+# ---------------------------------------------------------------------------
+# INSERT after the profiler (part of the section 3 block).
+#
+# Records used to carry only token counts and generation_tps, so for
+# image-heavy traffic there was no way to tell how much time went to fetching
+# and decoding images, preprocessing, or the vision encoder.  Every record now
+# also carries image_count, image_bytes (encoded input size, when known),
+# image_pixels, image_dims and image_load_time / preprocess_time /
+# vision_encode_time, and /v1/metrics summarizes them.
+#
+# `_RequestMiddleware` (always installed) gives each POST a fresh
+# `_VisionStats` in a context variable, which `_record_vlm_metric()` reads, so
+# the section 4-7 call sites need no changes.  The stages are filled in
+# automatically by `_instrument_vision_pipeline()`, which the patch calls at
+# the end of the module (just before `if __name__ == "__main__":`):
+#   - mlx_vlm.utils.load_image       -> image_load (+ count, bytes, dims)
+#   - mlx_vlm.utils.prepare_inputs   -> preprocess (net of image loading)
+#   - model.vision_tower.__call__    -> vision_encode, wrapped as each model is
+#     returned by get_cached_model()/load_model_resources(); the output is
+#     evaluated eagerly so the time is real compute, not graph building.
+#
+# If a server version loads images some other way, the same numbers can be
+# recorded by hand:
+#
+#     with _vision_stage("image_load"):
+#         images = [load_image(u) for u in image_urls]
+#     _vision_images(images)
+
+class _RequestMiddleware:
+    """ASGI middleware giving each POST its own vision stats (and trace, if sampled)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+            # No --port on the command line: register from the first request's socket
+            _registry.register("mlx_vlm", "Vision", scope["server"][1])
+        if scope["type"] != "http" or scope.get("method") != "POST":
+            return await self.app(scope, receive, send)
+        trace = _tracer.begin("request", path=scope.get("path"))
+        if trace is not None:
+            send = self._traced_send(send, trace)
+        vision_token = _current_vision.set(_VisionStats())
+        client_token = _current_client.set(_scope_client(scope))  # section 16
+        trace_token = _current_trace.set(trace)
+        load_token = _current_load.set(_cold.generation)  # section 17
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current_load.reset(load_token)
+            _current_trace.reset(trace_token)
+            _current_client.reset(client_token)
+            _current_vision.reset(vision_token)
+            if trace is not None:
+                trace.phase("prefill", "generate", "first_token")
+                trace.phase("decode", "first_token", "last_token")
+                _tracer.end(trace)
+
+    @staticmethod
+    def _traced_send(send, trace):
+        async def traced_send(message):
+            start = time.perf_counter()
+            try:
+                await send(message)
+            finally:
+                if message["type"] == "http.response.body":
+                    trace.add_span(
+                        "socket_write", start, time.perf_counter(),
+                        bytes=len(message.get("body", b"")),
+                    )
+        return traced_send
+
+
+# Registered right after the class:
+#
+#   app.add_middleware(_RequestMiddleware)
+
+
+_current_vision = contextvars.ContextVar("mlx_cockpit_vision", default=None)
+_current_client = contextvars.ContextVar("mlx_cockpit_client", default=None)
+# Load generation (see _ColdStart, section 17) when the request arrived; no
+# default, so requests outside the middleware count as arriving after the
+# latest load
+_current_load = contextvars.ContextVar("mlx_cockpit_load")
+
+
+class _VisionStats:
+    """Images and vision-pipeline stage timings for one request."""
+
+    __slots__ = ("image_count", "image_bytes", "image_pixels", "image_dims", "stages")
+
+    MAX_DIMS = 8
+
+    def __init__(self):
+        self.image_count = 0
+        self.image_bytes = 0
+        self.image_pixels = 0
+        self.image_dims = []
+        self.stages = {}
+
+    def add_image(self, image, nbytes=None):
+        self.image_count += 1
+        if nbytes:
+            self.image_bytes += nbytes
+        size = getattr(image, "size", None)
+        if isinstance(size, tuple) and len(size) == 2:
+            self.image_pixels += size[0] * size[1]
+            if len(self.image_dims) < self.MAX_DIMS:
+                self.image_dims.append(f"{size[0]}x{size[1]}")
+
+    def add_time(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def fields(self):
+        if not self.image_count and not self.stages:
+            return {}
+        return {
+            "image_count": self.image_count,
+            "image_bytes": self.image_bytes,
+            "image_pixels": self.image_pixels,
+            "image_dims": self.image_dims,
+            "image_load_time": round(self.stages.get("image_load", 0.0), 3),
+            "preprocess_time": round(self.stages.get("preprocess", 0.0), 3),
+            "vision_encode_time": round(self.stages.get("vision_encode", 0.0), 3),
+        }
+
+
+def _traced_tokens(trace, chunks):
+    """Pass stream_generate() output through, marking the request's first and last token."""
+    trace.mark("generate")
+    for chunk in chunks:
+        trace.token()
+        yield chunk
+
+
+@contextmanager
+def _vision_stage(name):
+    """Time a vision stage into the current request (and its trace, if sampled)."""
+    stats = _current_vision.get()
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if stats is not None:
+            stats.add_time(name, end - start)
+        if trace is not None:
+            trace.add_span(name, start, end)
+
+
+def _vision_images(images):
+    """Manual hook: count already-loaded images (PIL) for the current request."""
+    stats = _current_vision.get()
+    if stats is not None:
+        for image in images or []:
+            stats.add_image(image)
+
+
+def _image_source_bytes(source):
+    """Encoded size of an image argument: raw bytes, a local path or a base64 data URI."""
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, str):
+        if source.startswith("data:"):
+            return len(source.partition(",")[2]) * 3 // 4
+        if os.path.isfile(source):
+            return os.path.getsize(source)
+    read = getattr(source, "getbuffer", None)
+    return read().nbytes if read is not None else None
+
+
+def _replace_function(original, replacement):
+    """Rebind every mlx_vlm module global (and ours) that still points at `original`."""
+    modules = [m for name, m in list(sys.modules.items()) if name.startswith("mlx_vlm")]
+    for module in modules + [sys.modules[__name__]]:
+        for attr, value in list(vars(module).items()):
+            if value is original:
+                setattr(module, attr, replacement)
+
+
+def _instrument_vision_tower(model):
+    """Time the vision encoder by evaluating its output eagerly (MLX is lazy)."""
+    tower = getattr(model, "vision_tower", None) or getattr(model, "vision_model", None)
+    if tower is None or getattr(tower, "_cockpit_timed", False):
+        return
+    base = type(tower)
+
+    def __call__(self, *args, **kwargs):
+        with _vision_stage("vision_encode"):
+            out = base.__call__(self, *args, **kwargs)
+            import mlx.core as mx
+            mx.eval(out)
+        return out
+
+    tower.__class__ = type(base.__name__, (base,), {"__call__": __call__, "_cockpit_timed": True})
+
+
+def _instrument_vision_pipeline():
+    """Wrap image loading, preprocessing, model loading and generation (called at module end).
+
+    Every wrapper times into the request's _VisionStats and, for sampled
+    requests, its trace, so the endpoints need no manual _trace_stage() hooks.
+    """
+    try:
+        from mlx_vlm import utils as vlm_utils
+    except ImportError:
+        return
+    load_image = getattr(vlm_utils, "load_image", None)
+    if load_image is not None:
+        def timed_load_image(source, *args, **kwargs):
+            with _vision_stage("image_load"):
+                image = load_image(source, *args, **kwargs)
+            stats = _current_vision.get()
+            if stats is not None:
+                stats.add_image(image, _image_source_bytes(source))
+            return image
+        _replace_function(load_image, timed_load_image)
+
+    prepare_inputs = getattr(vlm_utils, "prepare_inputs", None)
+    if prepare_inputs is not None:
+        def timed_prepare_inputs(*args, **kwargs):
+            # prepare_inputs() loads images itself; report preprocessing net of that
+            stats = _current_vision.get()
+            loaded = stats.stages.get("image_load", 0.0) if stats is not None else 0.0
+            trace = _current_trace.get()
+            start = time.perf_counter()
+            try:
+                return prepare_inputs(*args, **kwargs)
+            finally:
+                end = time.perf_counter()
+                if stats is not None:
+                    stats.add_time("preprocess", end - start - (stats.stages.get("image_load", 0.0) - loaded))
+                if trace is not None:
+                    trace.add_span("preprocess", start, end)
+        _replace_function(prepare_inputs, timed_prepare_inputs)
+
+    # Loads are timed at the outermost loader: get_cached_model() only loads
+    # when the requested model differs from the cached one
+    timed = "get_cached_model" if "get_cached_model" in globals() else "load_model_resources"
+    for name in ("get_cached_model", "load_model_resources"):
+        loader = globals().get(name)
+        if loader is None:
+            continue
+
+        def instrumented(*args, _loader=loader, _timed=(name == timed), **kwargs):
+            before = (globals().get("model_cache") or {}).get("model")
+            start = time.perf_counter()
+            with _trace_stage("load_model") if _timed else nullcontext():
+                result = _loader(*args, **kwargs)
+            model = result[0] if isinstance(result, tuple) else result
+            if _timed and model is not None and model is not before:
+                path = args[0] if args else kwargs.get("model_path")
+                _cold.loaded(path or "unknown", time.perf_counter() - start, _weight_bytes(model))
+            _instrument_vision_tower(model)
+            return result
+        globals()[name] = instrumented
+
+    # The endpoints call these through this module's globals; mlx_vlm's own
+    # generate() -> stream_generate() call is left alone so nothing is counted twice
+    chat_template = globals().get("apply_chat_template")
+    if callable(chat_template):
+        def traced_chat_template(*args, **kwargs):
+            with _trace_stage("chat_template"):
+                return chat_template(*args, **kwargs)
+        globals()["apply_chat_template"] = traced_chat_template
+
+    stream = globals().get("stream_generate")
+    if callable(stream):
+        def traced_stream_generate(*args, **kwargs):
+            trace = _current_trace.get()
+            chunks = stream(*args, **kwargs)
+            return _traced_tokens(trace, chunks) if trace is not None else chunks
+        globals()["stream_generate"] = traced_stream_generate
+
+    generate = globals().get("generate")
+    if callable(generate):
+        def traced_generate(*args, **kwargs):
+            with _trace_stage("generate"):
+                return generate(*args, **kwargs)
+        globals()["generate"] = traced_generate
+
+
+# ---------------------------------------------------------------------------
+# 13. SERVICE REGISTRY AND /v1/registry ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_ServiceRegistry`, `_registry` and `_cli_port` are defined
+# in _cockpit_common.py.  The server announces itself in
+# ~/.mlx-cockpit/registry (same format as the mlx_lm patch) so the widget and
+# dashboard find it on any port without scanning.
+#
+# The port comes from `--port` on the command line, registered at the end of
+# the module (after _instrument_vision_pipeline()):
+#
+#   # Publish this server in the service registry (see _ServiceRegistry)
+#   _registry.register("mlx_vlm", "Vision", _cli_port())
+#
+# Without `--port` (e.g. the default port), _RequestMiddleware (section 12) registers
+# from the first request's socket instead, at the top of __call__:
+#
+#   if _registry.entry is None and scope["type"] == "http" and scope.get("server"):
+#       _registry.register("mlx_vlm", "Vision", scope["server"][1])
+#
+# _record_vlm_metric() also calls `_registry.set_model(...)` so the entry names the
+# model that is actually serving.
+
+# MLX_COCKPIT_REGISTRY=<dir> moves the registry; MLX_COCKPIT_REGISTRY=off disables it.
+#   @app.get("/v1/registry")
+async def registry_endpoint():
+    """Return the MLX servers registered on this host (self-registration)."""
+    return {"services": _registry.live()}
+
+
+# ---------------------------------------------------------------------------
+# 14. ALERT RULES
+# ---------------------------------------------------------------------------
+# INSERT with section 3.  The `_AlertEngine` class is defined in
+# _cockpit_common.py (threshold and rate-of-change rules per model, with
+# hysteresis, delivered to MLX_COCKPIT_ALERT_WEBHOOK /
+# MLX_COCKPIT_ALERT_COMMAND from a background thread).
+#
+# The recorder (section 15) feeds each new record to the rules, and
+# /v1/metrics reports the state as a top-level "alerts" key.
+
+# MLX_COCKPIT_ALERTS=<rules.json> replaces the default rules; MLX_COCKPIT_ALERTS=off disables them.
+_alerts = _AlertEngine.from_env("mlx_vlm")
+
+
+# ---------------------------------------------------------------------------
+# 15. CONTENTION-FREE RECORDING
+# ---------------------------------------------------------------------------
+# INSERT with section 3, after the alert rules (section 14).  The
+# `_MetricsRecorder` class is defined in _cockpit_common.py.
+#
+# _record_vlm_metric() runs on the event loop for async endpoints, so it only
+# appends to the recorder's pending deque: no lock, no flock, no alert
+# evaluation.  A background tick drains it into _vlm_metrics_store and feeds
+# the alert rules; /v1/metrics merges on a worker thread (asyncio.to_thread).
+
+# Recording never blocks the event loop; alert rules see each record on the recorder's tick.
+_vlm_recorder = _MetricsRecorder(_vlm_metrics_store, observers=(_alerts.observe, _clients.observe))
+
+
+# ---------------------------------------------------------------------------
+# 16. PER-CLIENT ACCOUNTING AND /v1/metrics/clients ENDPOINT
+# ---------------------------------------------------------------------------
+# Shared runtime: `_client_identity`, `_SpaceSaving`, `_ClientAccounting`,
+# `_clients` and `_scope_client` (which identifies an ASGI request from its
+# scope) are defined in _cockpit_common.py.  The recorder (section 15) feeds
+# `_clients.observe`.
+#
+# The request middleware (section 12) sets `_current_client` for the
+# duration of each POST, and _record_vlm_metric() (section 3) adds it to
+# the record.
+#
+# /v1/metrics (section 8) adds the last 15 minutes' top 5 as "clients", and
+# the full report has its own route:
+#
+#   @app.get("/v1/metrics/clients")
+#   async def clients_endpoint(top: int = 10):
+#       """Heavy hitters: top clients by tokens and generation seconds over sliding windows."""
+#       return _clients.report(top=max(1, min(top, _ClientAccounting.CAPACITY)))
+
+
+# ---------------------------------------------------------------------------
+# 17. MODEL LOADS AND COLD REQUESTS
+# ---------------------------------------------------------------------------
+# Shared runtime: `_weight_bytes`, `_ColdStart` and `_cold` are defined in
+# _cockpit_common.py.
+#
+# The server loads models lazily, per request, so the first request for a
+# model, after a swap or after POST /unload, waits for the load and then
+# runs cold.  _instrument_vision_pipeline() (section 12) times every
+# get_cached_model() call that brings in a different model and reports the
+# load time and weight bytes to _cold; the request middleware notes the
+# load generation each POST arrived in (`_current_load`), and
+# _record_vlm_metric() (section 3) adds `cold` and, when the request waited
+# for a load, `model_load_time` (not included in its latency).  Alert rules
+# skip cold records, and /v1/metrics (section 8) adds summary["cold_start"]
+# with cold and warm aggregates and the last 20 loads.
+#
+# There is no startup warm-up here (MLX_COCKPIT_WARMUP is mlx_lm only): no
+# model is loaded until a request names one.
+#
+#   _cold = _ColdStart(cold_requests=int(os.environ.get("MLX_COCKPIT_COLD_REQUESTS", "1")))
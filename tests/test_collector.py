@@ -0,0 +1,256 @@
+"""Scrape stub /v1/metrics servers on loopback with scripts/collector.py."""
+
+import importlib.util
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), "..", "scripts")
+
+
+def _load_collector():
+    spec = importlib.util.spec_from_file_location("collector", os.path.join(SCRIPTS, "collector.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["collector"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+collector = _load_collector()
+
+
+class StubServer:
+    """A patched server's /v1/metrics on a loopback port; `requests` is its ring buffer."""
+
+    def __init__(self, model="stub-model", capacity=200):
+        self.model = model
+        self.capacity = capacity
+        self.requests = []
+        self.in_flight = 0
+        self.status = 200
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path != "/v1/metrics" or stub.status != 200:
+                    self.send_error(404 if self.path != "/v1/metrics" else stub.status)
+                    return
+                body = json.dumps({
+                    "requests": stub.requests[-stub.capacity:],
+                    "summary": {"total_requests": len(stub.requests), "in_flight": stub.in_flight},
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05,), daemon=True).start()
+
+    def serve(self, latencies):
+        """Append one request record per latency."""
+        for latency in latencies:
+            self.requests.append({
+                "timestamp": f"2025-01-01 00:00:{len(self.requests):02d}",
+                "model": self.model,
+                "latency": latency,
+                "tokens_per_sec": 50.0,
+            })
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def servers():
+    started = []
+
+    def start(**kwargs):
+        server = StubServer(**kwargs)
+        started.append(server)
+        return server
+
+    yield start
+    for server in started:
+        server.stop()
+
+
+@pytest.fixture
+def make_collector():
+    made = []
+
+    def make(targets, **kwargs):
+        c = collector.Collector(targets, timeout=kwargs.pop("timeout", 2.0), workers=4, **kwargs)
+        made.append(c)
+        return c
+
+    yield make
+    for c in made:
+        c.executor.shutdown(wait=False)
+        if c.canary_executor:
+            c.canary_executor.shutdown(wait=False)
+
+
+def test_fleet_quantiles_merge_every_host(servers, make_collector):
+    a, b = servers(), servers()
+    a.serve(range(1, 101))
+    b.serve(range(101, 201))
+    c = make_collector([("127.0.0.1", [a.port]), ("localhost", [b.port])])
+    c.scrape()
+    fleet = c.fleet()
+    assert fleet["fleet"]["hosts_up"] == 2
+    assert fleet["fleet"]["requests"] == 200
+    latency = fleet["fleet"]["quantiles"]["latency"]
+    assert latency["count"] == 200
+    # DDSketch quantiles are within alpha (1%) of the exact order statistic
+    assert latency["p50"] == pytest.approx(100.5, rel=0.02)
+    assert latency["p90"] == pytest.approx(180, rel=0.02)
+    assert latency["p99"] == pytest.approx(198, rel=0.02)
+    per_host = {h["host"]: h["quantiles"]["latency"] for h in fleet["hosts"]}
+    assert per_host["127.0.0.1"]["p50"] == pytest.approx(50.5, rel=0.02)
+    assert per_host["localhost"]["p50"] == pytest.approx(150.5, rel=0.02)
+
+
+def test_records_are_counted_once_across_scrapes(servers, make_collector):
+    server = servers(capacity=10)
+    server.serve([1.0] * 4)
+    c = make_collector([("127.0.0.1", [server.port])])
+    c.scrape()
+    c.scrape()
+    assert c.fleet()["fleet"]["requests"] == 4
+
+    server.serve([2.0, 3.0])
+    c.scrape()
+    assert c.fleet()["fleet"]["requests"] == 6
+
+    # The server's ring buffer wraps: only the records past the last one seen are new
+    server.serve([4.0] * 7)
+    c.scrape()
+    c.scrape()
+    fleet = c.fleet()
+    assert fleet["fleet"]["requests"] == 13
+    assert fleet["fleet"]["quantiles"]["latency"]["count"] == 13
+
+
+def test_unanswered_server_is_kept_and_marked_stale(servers, make_collector):
+    busy, healthy = servers(model="busy"), servers(model="healthy")
+    busy.serve([1.0])
+    healthy.serve([1.0])
+    c = make_collector([("127.0.0.1", [busy.port, healthy.port])])
+    c.scrape()
+    assert [s["stale"] for s in c.fleet()["services"]] == [False, False]
+
+    busy.status = 503
+    c.scrape()
+    services = {s["model"]: s for s in c.fleet()["services"]}
+    assert services["busy"]["stale"] is True
+    assert services["busy"]["metrics"]["requests"][0]["latency"] == 1.0
+    assert services["healthy"]["stale"] is False
+    assert c.fleet()["hosts"][0]["status"] == "up"
+    widget = {s["model"]: s for s in c.services()["services"]}
+    assert widget["busy"]["metrics"]["busy"] is True
+
+    busy.status = 200
+    c.scrape()
+    assert all(not s["stale"] for s in c.fleet()["services"])
+
+
+def test_stopped_server_is_forgotten(servers, make_collector):
+    server = servers()
+    server.serve([1.0])
+    c = make_collector([("127.0.0.1", [server.port])])
+    c.scrape()
+    assert c.fleet()["fleet"]["servers"] == 1
+    server.stop()
+    c.scrape()
+    fleet = c.fleet()
+    assert fleet["fleet"]["servers"] == 0
+    # Refused connections prove the host is up: no backoff
+    assert fleet["hosts"][0]["status"] == "no servers"
+    assert fleet["hosts"][0]["retry_in"] is None
+
+
+def test_unreachable_host_backs_off(servers, make_collector, monkeypatch):
+    # Accepts connections but never answers, like a host that has gone away mid-scrape
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(16)
+    server = servers()
+    server.serve([1.0])
+    c = make_collector(
+        [("127.0.0.1", [blackhole.getsockname()[1]]), ("localhost", [server.port])],
+        timeout=0.2,
+    )
+    try:
+        before = time.time()
+        c.scrape()
+        down = c.hosts[0]
+        assert down.status == "unreachable"
+        assert down.failures == 1
+        assert before + collector.BACKOFF_BASE <= down.retry_at <= time.time() + collector.BACKOFF_BASE
+        assert c.hosts[1].status == "up"
+
+        probed = []
+        original = c._probe
+        monkeypatch.setattr(c, "_probe", lambda host, port: probed.append(host.name) or original(host, port))
+        c.scrape()
+        assert "127.0.0.1" not in probed
+        assert "localhost" in probed
+        assert down.failures == 1
+
+        # Retry due: each further failure doubles the wait, up to BACKOFF_MAX
+        down.retry_at = 0.0
+        before = time.time()
+        c.scrape()
+        assert down.failures == 2
+        assert down.retry_at >= before + 2 * collector.BACKOFF_BASE
+        assert down.retry_at < before + 4 * collector.BACKOFF_BASE
+
+        down.failures = 20
+        down.retry_at = 0.0
+        before = time.time()
+        c.scrape()
+        assert before + collector.BACKOFF_MAX <= down.retry_at <= time.time() + collector.BACKOFF_MAX
+    finally:
+        blackhole.close()
+
+
+def test_canary_waits_for_generations_in_flight(servers, make_collector, monkeypatch):
+    server = servers()
+    server.serve([1.0])
+    c = make_collector([("127.0.0.1", [server.port])], canary=60)
+    probes = []
+    monkeypatch.setattr(c.canary_executor, "submit", lambda fn, *job: probes.append(job))
+
+    # A long generation holds no new records yet, only the server's in-flight count
+    server.in_flight = 1
+    c.scrape()
+    canary = c.hosts[0].canaries[server.port]
+    assert probes == []
+    assert canary.skipped == 1
+    assert canary.delay == 2 * 60
+
+    canary.next_at = 0.0
+    server.in_flight = 0
+    c.scrape()
+    assert [(h.name, port, model) for h, port, model, _ in probes] == [("127.0.0.1", server.port, "stub-model")]
+
+
+def test_parse_targets():
+    assert collector.parse_targets("a, b:9000-9002+9005\n# comment\nc:1") == [
+        ("a", collector.DEFAULT_PORTS),
+        ("b", [9000, 9001, 9002, 9005]),
+        ("c", [1]),
+    ]
@@ -0,0 +1,66 @@
+"""The sampling profiler shared by every patch (server-patches/_cockpit_common.py)."""
+
+import importlib.util
+import os
+import sys
+import threading
+
+import pytest
+
+COMMON = os.path.join(os.path.dirname(__file__), "..", "server-patches", "_cockpit_common.py")
+
+
+@pytest.fixture(scope="module")
+def common():
+    os.environ.setdefault("MLX_COCKPIT_REGISTRY", "off")
+    spec = importlib.util.spec_from_file_location("_cockpit_common", COMMON)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["_cockpit_common"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _spin_a(stop):
+    while not stop.is_set():
+        pass
+
+
+def _spin_b(stop):
+    while not stop.is_set():
+        pass
+
+
+def test_collapsed_output_has_one_line_per_stack(common):
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_spin_a, args=(stop,), name="spin-a"),
+        threading.Thread(target=_spin_b, args=(stop,), name="spin-b"),
+    ]
+    for t in threads:
+        t.start()
+    try:
+        data = common._SamplingProfiler(enabled=True).run(seconds=0.2, hz=200)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+    lines = data["collapsed"].split("\n")
+    assert "\\n" not in data["collapsed"]
+    assert len(lines) == len(set(lines)) >= 2
+    for line in lines:
+        # flamegraph.pl format: "thread;frame;frame <count>"
+        stack, _, count = line.rpartition(" ")
+        assert stack and int(count) > 0
+    assert sum(int(line.rpartition(" ")[2]) for line in lines) == data["stack_samples"]
+    assert any(line.startswith("spin-a;") and "_spin_a (" in line for line in lines)
+    assert any(line.startswith("spin-b;") and "_spin_b (" in line for line in lines)
+
+
+def test_only_one_profile_runs_at_a_time(common):
+    profiler = common._SamplingProfiler(enabled=True)
+    assert profiler._busy.acquire(blocking=False)
+    try:
+        assert profiler.run(seconds=0.1) is None
+    finally:
+        profiler._busy.release()
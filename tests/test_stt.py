@@ -0,0 +1,332 @@
+"""Patch stub mlx_audio servers with scripts/patch_mlx_stt.py and check what they record.
+
+The stubs reproduce the two ways mlx_audio runs a transcription: 0.4.x calls
+generate() inside the request (streaming through a StreamingResponse), 0.5.x
+hands the request to an InferenceBroker that decodes on its own thread.
+"""
+
+import importlib.util
+import inspect
+import os
+import sys
+import wave
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient  # noqa: E402
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), "..", "scripts")
+
+AUDIO_SECONDS = 2.0
+
+# Shared by both stubs: a model whose generate() takes real time and can stream
+STUB_MODEL = '''
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
+
+
+@dataclass
+class StreamingResult:
+    text: str
+    tokens: list
+    is_final: bool
+    start_time: float
+    end_time: float
+    language: str = "en"
+
+
+class StubModel:
+    def generate(self, audio, max_tokens=64, stream=False):
+        self.max_tokens = max_tokens
+        time.sleep(0.02)
+        if stream:
+            return self._stream()
+        return {
+            "text": "hello world",
+            "segments": [
+                {"start": 0.0, "end": 1.0, "tokens": [1, 2]},
+                {"start": 1.0, "end": 2.0, "tokens": [3]},
+            ],
+            "language": "en",
+        }
+
+    def _stream(self):
+        for i in range(3):
+            time.sleep(0.02)
+            yield StreamingResult("partial", [], False, float(i), float(i) + 0.5)
+            yield StreamingResult("word", [i, i], True, float(i), float(i) + 0.5)
+
+
+class ModelProvider:
+    def __init__(self):
+        self.models = {}
+
+    def load_model(self, model_name):
+        if model_name not in self.models:
+            self.models[model_name] = StubModel()
+        return self.models[model_name]
+
+
+app = FastAPI()
+model_provider = ModelProvider()
+
+
+def _save(data):
+    path = f"/tmp/mlx-cockpit-test-{time.time()}.wav"
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _chunk_data(chunk):
+    if isinstance(chunk, str):
+        return {"text": chunk}
+    return {"text": chunk.text, "end": chunk.end_time}
+'''
+
+# mlx_audio 0.4.x: generate() runs inside the streamed body generator
+STUB_INLINE = STUB_MODEL + '''
+
+def generate_transcription_stream(stt_model, tmp_path, gen_kwargs):
+    try:
+        result = stt_model.generate(tmp_path, **gen_kwargs)
+        if hasattr(result, "__iter__") and hasattr(result, "__next__"):
+            for chunk in result:
+                yield json.dumps(_chunk_data(chunk)) + "\\n"
+        else:
+            yield json.dumps(result) + "\\n"
+    finally:
+        os.remove(tmp_path)
+
+
+@app.post("/v1/audio/transcriptions")
+async def stt_transcriptions(
+    file: UploadFile = File(...),
+    model: str = Form(...),
+    stream: bool = Form(False),
+):
+    tmp_path = _save(await file.read())
+    stt_model = model_provider.load_model(model)
+    return StreamingResponse(
+        generate_transcription_stream(stt_model, tmp_path, {"stream": stream}),
+        media_type="application/x-ndjson",
+    )
+
+
+if __name__ == "__main__":
+    pass
+'''
+
+# mlx_audio 0.5.x: the endpoint submits to a broker that decodes on a worker thread
+STUB_BROKER = STUB_MODEL + '''
+
+@dataclass
+class TranscriptionTaskPayload:
+    path: str
+    max_tokens: int
+    stream: bool
+
+
+class InferenceRequest:
+    def __init__(self, model_name, payload):
+        self.model_name = model_name
+        self.payload = payload
+        self.result_queue = queue.Queue()
+
+
+class STTExecutionAdapter:
+    def run_serial(self, request):
+        payload = request.payload
+        stt_model = model_provider.load_model(request.model_name)
+        gen_kwargs = {"max_tokens": payload.max_tokens, "stream": payload.stream, "bogus": 1}
+        signature = inspect.signature(stt_model.generate)
+        gen_kwargs = {k: v for k, v in gen_kwargs.items() if k in signature.parameters}
+        try:
+            result = stt_model.generate(payload.path, **gen_kwargs)
+            if hasattr(result, "__iter__") and hasattr(result, "__next__"):
+                for chunk in result:
+                    request.result_queue.put(_chunk_data(chunk))
+            else:
+                request.result_queue.put(result)
+        finally:
+            os.remove(payload.path)
+            request.result_queue.put(None)
+
+
+class InferenceBroker:
+    def __init__(self):
+        self._adapters = {"stt": STTExecutionAdapter()}
+        self._work = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, *, endpoint_kind, model_name, payload, stream=False):
+        request = InferenceRequest(model_name, payload)
+        self._work.put((self._adapters[endpoint_kind], request))
+        return request
+
+    def _run(self):
+        while True:
+            adapter, request = self._work.get()
+            adapter.run_serial(request)
+
+
+broker = InferenceBroker()
+
+
+@app.post("/v1/audio/transcriptions")
+async def stt_transcriptions(
+    file: UploadFile = File(...),
+    model: str = Form(...),
+    stream: bool = Form(False),
+    max_tokens: int = Form(64),
+):
+    payload = TranscriptionTaskPayload(_save(await file.read()), max_tokens, stream)
+    handle = broker.submit(endpoint_kind="stt", model_name=model, payload=payload, stream=stream)
+    chunks = []
+    while True:
+        chunk = handle.result_queue.get(timeout=5)
+        if chunk is None:
+            break
+        chunks.append(chunk)
+    return {"chunks": chunks}
+
+
+if __name__ == "__main__":
+    pass
+'''
+
+
+def _load(path, name):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def patcher():
+    return _load(os.path.join(SCRIPTS, "patch_mlx_stt.py"), "patch_mlx_stt")
+
+
+@pytest.fixture
+def wav_bytes(tmp_path):
+    path = tmp_path / "clip.wav"
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(16000)
+        w.writeframes(b"\0\0" * int(16000 * AUDIO_SECONDS))
+    return path.read_bytes()
+
+
+@pytest.fixture(params=["inline", "broker"])
+def server(request, tmp_path, patcher, monkeypatch, capsys):
+    monkeypatch.setenv("MLX_COCKPIT_REGISTRY", "off")
+    monkeypatch.setenv("MLX_COCKPIT_ALERTS", "off")
+    monkeypatch.delenv("MLX_COCKPIT_SHM", raising=False)
+    path = tmp_path / "server.py"
+    path.write_text(STUB_INLINE if request.param == "inline" else STUB_BROKER)
+    assert patcher.patch(str(path))
+    assert "WARNING" not in capsys.readouterr().out
+    module = _load(str(path), f"stub_stt_server_{request.param}")
+    yield module
+    sys.modules.pop(module.__name__, None)
+
+
+def _transcribe(client, wav_bytes, **form):
+    response = client.post(
+        "/v1/audio/transcriptions",
+        files={"file": ("clip.wav", wav_bytes, "audio/wav")},
+        data={"model": "org/stub-whisper", **form},
+    )
+    assert response.status_code == 200
+    return response
+
+
+def _records(client):
+    return client.get("/v1/metrics").json()["requests"]
+
+
+def test_patched_server_records_transcription(server, wav_bytes):
+    client = TestClient(server.app)
+    _transcribe(client, wav_bytes)
+    [record] = _records(client)
+    assert record["model"] == "stub-whisper"
+    assert record["audio_duration"] == AUDIO_SECONDS
+    assert record["decode_time"] >= 0.02
+    assert record["segments"] == 2
+    assert record["completion_tokens"] == 3
+    assert record["language"] == "en"
+    # rtf is computed before decode_time is rounded
+    assert record["rtf"] == pytest.approx(record["decode_time"] / AUDIO_SECONDS, abs=1e-3)
+
+
+def test_streamed_transcription_times_the_iteration(server, wav_bytes):
+    client = TestClient(server.app)
+    body = _transcribe(client, wav_bytes, stream="true").text
+    assert body.count("word") == 3
+    [record] = _records(client)
+    # Three 20 ms steps after generate() returned its generator
+    assert record["decode_time"] >= 0.08
+    assert record["segments"] == 3
+    assert record["completion_tokens"] == 6
+    assert record["rtf"] is not None and record["rtf"] > 0
+
+
+def test_wrapped_generate_keeps_its_signature(server, wav_bytes):
+    client = TestClient(server.app)
+    _transcribe(client, wav_bytes)
+    model = server.model_provider.models["org/stub-whisper"]
+    assert type(model).generate is not server.StubModel.generate
+    # Servers drop generate() kwargs its signature does not name
+    assert "max_tokens" in inspect.signature(model.generate).parameters
+
+
+def test_failed_request_is_not_recorded(server, wav_bytes):
+    client = TestClient(server.app, raise_server_exceptions=False)
+    response = client.post("/v1/audio/transcriptions", data={"model": "org/stub-whisper"})
+    assert response.status_code == 422
+    assert _records(client) == []
+
+
+def test_metrics_summary_aggregates_rtf(server, wav_bytes):
+    client = TestClient(server.app)
+    _transcribe(client, wav_bytes)
+    _transcribe(client, wav_bytes, stream="true")
+    summary = client.get("/v1/metrics").json()["summary"]
+    assert summary["total_requests"] == 2
+    assert summary["total_audio_seconds"] == 2 * AUDIO_SECONDS
+    assert summary["total_segments"] == 5
+    assert summary["avg_rtf"] == pytest.approx(
+        summary["total_decode_time"] / summary["total_audio_seconds"], abs=1e-3
+    )
+
+
+def test_trace_route_exports_sampled_transcriptions(server, wav_bytes):
+    server._tracer.sample_rate = 1.0
+    client = TestClient(server.app)
+    _transcribe(client, wav_bytes, stream="true")
+    events = client.get("/v1/trace").json()["traceEvents"]
+    names = [e["name"] for e in events]
+    assert names.count("request") == 1
+    assert {"generate", "decode"} <= set(names)
+    [decode] = [e for e in events if e["name"] == "decode"]
+    assert decode["args"]["chunks"] == 6
+
+
+def test_profile_route_is_off_by_default(server):
+    client = TestClient(server.app)
+    response = client.get("/v1/profile", params={"seconds": 0.1})
+    assert response.status_code == 403
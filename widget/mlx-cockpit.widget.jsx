@@ -86,7 +86,11 @@ export const init = (dispatch) => {
     const el = document.querySelector('[id*="mlx-server-stats"]');
     if (!el || !el.contains(e.target)) return;
     if (_wasDrag) { _wasDrag = false; return; }
-    // Open dashboard on first discovered port (stored by render)
+    // Open the collector's fleet dashboard, else the first discovered port's (stored by render)
+    if (window._mlxCollector) {
+      run(`open ${window._mlxCollector}/dashboard`);
+      return;
+    }
     const port = window._mlxFirstPort || 8080;
     run(`open http://localhost:${port}/dashboard`);
   });
@@ -105,7 +109,7 @@ const describeArc = (cx, cy, r, startAngle, endAngle) => {
   return `M ${start.x} ${start.y} A ${r} ${r} 0 ${largeArc} 0 ${end.x} ${end.y}`;
 };
 
-const Gauge = ({ value, max, size, label, unit, color }) => {
+const Gauge = ({ value, max, size, label, unit, color, digits = 1 }) => {
   const cx = size / 2;
   const cy = size / 2;
   const r = size / 2 - 10;
@@ -132,7 +136,7 @@ const Gauge = ({ value, max, size, label, unit, color }) => {
       ticks.push(
         <text key={`l${i}`} x={labelPos.x} y={labelPos.y} fill="rgba(255,255,255,0.3)"
           fontSize="7" textAnchor="middle" dominantBaseline="middle">
-          {Math.round((i / tickCount) * max)}
+          {max < 4 ? ((i / tickCount) * max).toFixed(1) : Math.round((i / tickCount) * max)}
         </text>
       );
     }
@@ -170,7 +174,7 @@ const Gauge = ({ value, max, size, label, unit, color }) => {
         <text x={cx} y={cy + 18} fill="white" fontSize="18" fontWeight="600"
           textAnchor="middle" dominantBaseline="middle"
           style={{ fontVariantNumeric: "tabular-nums" }}>
-          {typeof value === "number" ? value.toFixed(1) : value}
+          {typeof value === "number" ? value.toFixed(digits) : value}
         </text>
         <text x={cx} y={cy + 30} fill="rgba(255,255,255,0.4)" fontSize="8"
           textAnchor="middle" dominantBaseline="middle" textTransform="uppercase"
@@ -201,9 +205,13 @@ const Pill = ({ label, value, icon }) => (
 );
 
 // --- Model Section ---
-const ModelSection = ({ title, color, latencyColor, dotColor, modelName, online, busy, tps, latencyVal, summary, tag }) => {
+const ModelSection = ({ title, color, latencyColor, dotColor, modelName, online, busy, tps, latencyVal, summary, alerts, tag }) => {
   const tpsMax = Math.max(20, Math.ceil((tps || 0) / 10) * 10 + 10);
   const latMax = Math.max(5, Math.ceil(latencyVal || 0) + 2);
+  // STT servers report real-time factor (decode seconds per audio second) instead of tok/s
+  const isSTT = summary && summary.total_audio_seconds !== undefined;
+  const rtf = isSTT ? summary.avg_rtf || 0 : 0;
+  const rtfMax = Math.max(1, Math.ceil(rtf * 2) / 2);
 
   return (
     <div style={{ flex: 1, minWidth: "240px" }}>
@@ -219,6 +227,13 @@ const ModelSection = ({ title, color, latencyColor, dotColor, modelName, online,
             {modelName}
           </div>
         </div>
+        {alerts && alerts.length > 0 && (
+          <div title={alerts.map(a => `${a.rule}: ${a.metric} ${a.stat} ${a.value}`).join("\n")} style={{
+            fontSize: "8px", color: "#f85149", background: "#f8514926",
+            padding: "2px 6px", borderRadius: "4px", fontWeight: 600,
+            textTransform: "uppercase", letterSpacing: "0.08em",
+          }}>{"! "}{alerts.length === 1 ? alerts[0].rule.replace(/_/g, " ") : `${alerts.length} alerts`}</div>
+        )}
         <div style={{
           fontSize: "8px", color: color, background: `${color}15`,
           padding: "2px 6px", borderRadius: "4px", fontWeight: 600,
@@ -229,13 +244,23 @@ const ModelSection = ({ title, color, latencyColor, dotColor, modelName, online,
       {online && summary && tps !== undefined ? (
         <div>
           <div style={{ display: "flex", justifyContent: "center", gap: "4px" }}>
-            <Gauge value={tps} max={tpsMax} size={115} label="Speed" unit="tok/s" color={color} />
+            {isSTT
+              ? <Gauge value={rtf} max={rtfMax} size={115} label="RTF" unit="decode / audio" color={color} digits={3} />
+              : <Gauge value={tps} max={tpsMax} size={115} label="Speed" unit="tok/s" color={color} />}
             <Gauge value={latencyVal} max={latMax} size={115} label="Latency" unit="seconds" color={latencyColor || "#f0883e"} />
           </div>
           <div style={{ display: "flex", gap: "4px", marginTop: "8px" }}>
             <Pill icon={"+"} label="Requests" value={summary.total_requests} />
-            <Pill icon={">"} label="Prompt" value={summary.total_prompt_tokens.toLocaleString()} />
-            <Pill icon={"<"} label="Output" value={summary.total_completion_tokens.toLocaleString()} />
+            {isSTT ? (
+              <Pill icon={">"} label="Audio" value={`${(summary.total_audio_seconds / 60).toFixed(1)} min`} />
+            ) : (
+              <Pill icon={">"} label="Prompt" value={summary.total_prompt_tokens.toLocaleString()} />
+            )}
+            {isSTT ? (
+              <Pill icon={"<"} label="Segments" value={summary.total_segments.toLocaleString()} />
+            ) : (
+              <Pill icon={"<"} label="Output" value={summary.total_completion_tokens.toLocaleString()} />
+            )}
           </div>
         </div>
       ) : online ? (
@@ -282,12 +307,15 @@ export const render = ({ output }) => {
       tps: hasMetrics ? m.summary.avg_tokens_per_sec : 0,
       latency: latest ? latest.latency : 0,
       summary: hasMetrics ? m.summary : null,
+      alerts: hasMetrics && m.alerts ? m.alerts.firing : [],
     };
   });
 
-  // Store first port for click-to-open-dashboard
-  if (services.length > 0) {
-    window._mlxFirstPort = services[0].port;
+  // Store first port (or the collector) for click-to-open-dashboard
+  window._mlxCollector = data.collector || null;
+  const local = services.find(s => !s.host || s.host === "localhost");
+  if (local) {
+    window._mlxFirstPort = local.port;
   }
 
   const containerBase = {
@@ -317,13 +345,13 @@ export const render = ({ output }) => {
     <div style={containerBase}>
       <div style={{ display: "flex", gap: "16px", flexWrap: "wrap" }}>
         {services.map((svc, i) => (
-          <div key={svc.port} style={{ display: "contents" }}>
+          <div key={`${svc.host || "localhost"}:${svc.port}`} style={{ display: "contents" }}>
             {i > 0 && (
               <div style={{ width: "1px", background: "rgba(255,255,255,0.08)", alignSelf: "stretch" }} />
             )}
             <ModelSection
               title={svc.type}
-              tag={svc.type}
+              tag={svc.host && svc.host !== "localhost" ? `${svc.type} · ${svc.host}` : svc.type}
               color={svc.color}
               latencyColor={theme.latencyColor}
               dotColor={svc.online || svc.busy ? "#3fb950" : "#f85149"}
@@ -333,6 +361,7 @@ export const render = ({ output }) => {
               tps={svc.tps}
               latencyVal={svc.latency}
               summary={svc.summary}
+              alerts={svc.alerts}
             />
           </div>
         ))}
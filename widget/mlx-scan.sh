@@ -1,15 +1,84 @@
 #!/bin/bash
-# MLX Server Discovery — scans ports 8080-8090 for MLX servers
+# MLX Server Discovery — finds running MLX servers for the Übersicht widget
 # Called by the Übersicht widget every 5 seconds
+# Patched servers register themselves in ~/.mlx-cockpit/registry, so only their
+# ports are probed; ports 8080-8090 are scanned (at most once a minute) to pick
+# up unpatched servers, or every time if nothing is registered.
 # Caches last-known metrics so busy servers still show data during generation
+# With a collector configured (MLX_COCKPIT_COLLECTOR or ~/.mlx-cockpit/collector,
+# e.g. http://studio1:9100), its /v1/services lists every host's servers instead
 
 CACHE_DIR="$HOME/.mlx-cockpit/cache"
+REGISTRY_DIR="${MLX_COCKPIT_REGISTRY:-$HOME/.mlx-cockpit/registry}"
+SCAN_PORTS="8080 8081 8082 8083 8084 8085 8086 8087 8088 8089 8090"
+SCAN_INTERVAL=60
 mkdir -p "$CACHE_DIR"
 
-procs=$(ps ax -o args= 2>/dev/null | grep -E 'mlx_(lm|vlm)\.server' | grep -v grep | grep -v 'bash -c')
+# --- Fleet mode: scripts/collector.py already scrapes every host ---
+COLLECTOR="${MLX_COCKPIT_COLLECTOR:-$(cat "$HOME/.mlx-cockpit/collector" 2>/dev/null)}"
+if [ -n "$COLLECTOR" ] && [ "$COLLECTOR" != "off" ]; then
+  COLLECTOR="${COLLECTOR%/}"
+  fleet=$(curl -s --connect-timeout 1 --max-time 5 "$COLLECTOR/v1/services" 2>/dev/null | tr -d '\n')
+  if echo "$fleet" | grep -q '"services"'; then
+    echo "{\"collector\":\"$COLLECTOR\",${fleet#\{}"
+    exit 0
+  fi
+  # Collector not answering: show this Mac's servers instead
+fi
+
+json_field() {
+  # json_field <json> <key> — string or number value of a flat JSON field
+  echo "$1" | grep -oE "\"$2\"[[:space:]]*:[[:space:]]*(\"[^\"]*\"|[0-9]+)" | head -1 \
+    | sed -E 's/^"[^"]*"[[:space:]]*:[[:space:]]*//;s/^"//;s/"$//'
+}
+
+# --- Registered servers (one line per server: port|type|model) ---
+registry=""
+if [ -d "$REGISTRY_DIR" ] && [ "$REGISTRY_DIR" != "off" ]; then
+  # Heartbeats rewrite each entry every 10s; anything untouched for a minute is stale
+  find "$REGISTRY_DIR" -name '*.json' -mmin +1 -delete 2>/dev/null
+  for f in "$REGISTRY_DIR"/*.json; do
+    [ -f "$f" ] || continue
+    entry=$(tr -d '\n' < "$f")
+    pid=$(json_field "$entry" pid)
+    if [ -z "$pid" ] || ! kill -0 "$pid" 2>/dev/null; then
+      rm -f "$f"
+      continue
+    fi
+    rport=$(json_field "$entry" port)
+    [ -n "$rport" ] || continue
+    echo "$registry" | grep -q "^$rport|" && continue
+    registry="$registry$rport|$(json_field "$entry" type)|$(json_field "$entry" model)
+"
+  done
+fi
+reg_ports=$(echo "$registry" | cut -d'|' -f1 | grep -E '^[0-9]+$')
+
+# --- Unregistered servers: fall back to scanning ---
+extra_ports=""
+now=$(date +%s)
+last_scan=$(cat "$CACHE_DIR/last-scan" 2>/dev/null || echo 0)
+if [ -z "$reg_ports" ] || [ $((now - last_scan)) -ge $SCAN_INTERVAL ]; then
+  for port in $SCAN_PORTS; do
+    echo "$reg_ports" | grep -qx "$port" && continue
+    nc -z localhost $port 2>/dev/null && extra_ports="$extra_ports $port"
+  done
+  echo "$extra_ports" > "$CACHE_DIR/extra-ports"
+  echo "$now" > "$CACHE_DIR/last-scan"
+else
+  # Between scans, keep probing the unregistered ports found last time
+  extra_ports=$(cat "$CACHE_DIR/extra-ports" 2>/dev/null)
+fi
+
+# Process parsing is only needed for servers that did not register themselves
+procs=""
+[ -n "$extra_ports" ] && procs=$(ps ax -o args= 2>/dev/null | grep -E 'mlx_(lm|vlm|audio)\.server' | grep -v grep | grep -v 'bash -c')
+
 echo '{"services":['
 first=1
-for port in 8080 8081 8082 8083 8084 8085 8086 8087 8088 8089 8090; do
+for port in $(printf '%s\n' $reg_ports $extra_ports | sort -un); do
+  reg=$(echo "$registry" | grep "^$port|" | head -1)
+  health=""
   metrics=$(curl -s --connect-timeout 1 --max-time 5 "http://localhost:$port/v1/metrics" 2>/dev/null | tr -d '\n')
   if [ -n "$metrics" ] && echo "$metrics" | grep -q '"summary"'; then
     # Got fresh metrics — cache them
@@ -20,7 +89,8 @@ for port in 8080 8081 8082 8083 8084 8085 8086 8087 8088 8089 8090; do
       hmodel=$(echo "$health" | grep -oE '"model"[[:space:]]*:[[:space:]]*"[^"]*"' | sed 's/"model"[[:space:]]*:[[:space:]]*"//;s/"$//')
       [ -n "$hmodel" ] && metrics=$(printf '{"summary":null,"health_model":"%s"}' "$hmodel") || metrics='{"summary":null}'
     elif nc -z localhost $port 2>/dev/null; then
-      echo "$procs" | grep -q -- "--port $port" || continue
+      # A registered server's pid is known to be alive; otherwise it must be an MLX process
+      [ -n "$reg" ] || echo "$procs" | grep -q -- "--port $port" || continue
       # Server is busy generating — use cached metrics if available
       if [ -f "$CACHE_DIR/$port.json" ]; then
         metrics=$(cat "$CACHE_DIR/$port.json")
@@ -33,13 +103,21 @@ for port in 8080 8081 8082 8083 8084 8085 8086 8087 8088 8089 8090; do
       continue
     fi
   fi
-  proc=$(echo "$procs" | grep -- "--port $port" | head -1)
   model="unknown"; stype="LLM"
-  if [ -n "$proc" ]; then
-    m=$(echo "$proc" | grep -oE '\-\-model [^ ]+' | head -1 | sed 's/--model //')
+  if [ -n "$reg" ]; then
+    stype=$(echo "$reg" | cut -d'|' -f2)
+    m=$(echo "$reg" | cut -d'|' -f3)
+    [ -n "$stype" ] || stype="LLM"
     [ -n "$m" ] && model="$m"
-    if echo "$proc" | grep -q 'mlx_vlm'; then stype="Vision"
-    elif echo "$model" | grep -qi 'vl\|vision'; then stype="Vision"; fi
+  else
+    proc=$(echo "$procs" | grep -- "--port $port" | head -1)
+    if [ -n "$proc" ]; then
+      m=$(echo "$proc" | grep -oE '\-\-model [^ ]+' | head -1 | sed 's/--model //')
+      [ -n "$m" ] && model="$m"
+      if echo "$proc" | grep -q 'mlx_vlm'; then stype="Vision"
+      elif echo "$proc" | grep -q 'mlx_audio'; then stype="STT"
+      elif echo "$model" | grep -qi 'vl\|vision'; then stype="Vision"; fi
+    fi
   fi
   if [ "$model" = "unknown" ]; then
     # Check health_model from fallback metrics